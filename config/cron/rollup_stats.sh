@@ -0,0 +1,6 @@
+#!/bin/bash
+# run every five minutes: */5 * * * *
+cd /var/praekelt/txtalert/production/current/txtalert && \
+    source ve/bin/activate && \
+        ./manage.py rollup_stats --settings=environments.production > /dev/null && \
+    deactivate
@@ -0,0 +1,34 @@
+from django.db.models.query import QuerySet
+from django.utils import simplejson
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+from piston.emitters import Emitter
+
+
+class JSONStreamEmitter(Emitter):
+    """
+    JSON emitter that writes out querysets one record at a time instead of
+    serializing all of them into one string first, the records are read
+    from the database with `iterator()` so they aren't cached either.
+    Anything other than a queryset is emitted as the regular JSON emitter
+    would.
+    """
+    def render(self, request):
+        if isinstance(self.data, QuerySet):
+            return self.render_queryset(self.data)
+        return self.dumps(self.construct())
+
+    def render_queryset(self, queryset):
+        yield '['
+        separator = ''
+        for instance in queryset.iterator():
+            self.data = instance
+            yield separator + self.dumps(self.construct())
+            separator = ','
+        yield ']'
+
+    def dumps(self, data):
+        return simplejson.dumps(data, cls=DateTimeAwareJSONEncoder,
+                                    ensure_ascii=False)
+
+Emitter.register('json-stream', JSONStreamEmitter,
+                    'application/json; charset=utf-8')
@@ -1,15 +1,20 @@
 # from django.contrib.auth.decorators import permission_required
 from django.shortcuts import get_object_or_404
+from django.db import transaction, IntegrityError
+from django.conf import settings
 
 from piston.handler import BaseHandler
-from piston.utils import rc, require_mime, throttle
+from piston.utils import rc, require_mime
 
-from txtalert.apps.gateway.models import SendSMS, PleaseCallMe
+from txtalert.apps.gateway.models import SendSMS, SMSJob, PleaseCallMe
+from txtalert.apps.gateway import outbox
 from txtalert.apps.gateway import gateway, sms_receipt_handler
-from txtalert.core.models import Patient, Visit, MSISDN
+from txtalert.core.models import Patient, Visit, MSISDN, VisitStatistics
 from txtalert.core.models import PleaseCallMe as CorePleaseCallMe
 from txtalert.core.utils import normalize_msisdn
+from txtalert.core.signals import deferred_pcm_tracking
 from txtalert.core.forms import RequestCallForm
+from txtalert.apps.api.throttling import rate_limit
 
 from datetime import datetime, timedelta, date
 import logging
@@ -38,14 +43,62 @@ def handle_voicemail_message(message):
             return dictionary['msisdn'], timestamp
 
 
+class RecentKeys(object):
+    """An in-process record of the dedupe keys of recently received PCMs so
+    resubmissions can be rejected without hitting the database. Keys older
+    than the window are pruned once the record grows beyond `max_size`."""
+    
+    def __init__(self, window, max_size=1000):
+        self.window = window
+        self.max_size = max_size
+        self.keys = {}
+    
+    def seen(self, key, now):
+        timestamp = self.keys.get(key)
+        return timestamp is not None and timestamp > now - self.window
+    
+    def add(self, key, timestamp):
+        self.keys[key] = timestamp
+        if len(self.keys) > self.max_size:
+            cutoff = timestamp - self.window
+            for stale_key, seen_at in self.keys.items():
+                if seen_at <= cutoff:
+                    del self.keys[stale_key]
+    
+    def clear(self):
+        self.keys.clear()
+
+API_PAGE_SIZE = getattr(settings, 'API_PAGE_SIZE', 1000)
+SMS_MAX_PARTS = getattr(settings, 'SMS_MAX_PARTS', 6)
+
+def paginate(request, queryset):
+    """Keyset pagination for list reads, returns at most `limit` records
+    with a pk greater than `since_id` in order of pk. Clients continue from
+    the pk of the last record they received. Reads that give neither get
+    all the records, as `since` reads did before pagination."""
+    if 'since_id' not in request.GET and 'limit' not in request.GET:
+        return queryset
+    try:
+        since_id = int(request.GET.get('since_id', 0))
+        limit = min(int(request.GET.get('limit', API_PAGE_SIZE)),
+                    API_PAGE_SIZE)
+    except ValueError:
+        return rc.BAD_REQUEST
+    return queryset.filter(pk__gt=since_id).order_by('pk')[:max(limit, 0)]
+
+# PCMs from the same sender with the same message within this window are
+# treated as duplicate submissions
+DUPLICATE_PCM_WINDOW = PleaseCallMe.DEDUPE_WINDOW
+recent_pcm_keys = RecentKeys(DUPLICATE_PCM_WINDOW)
+
 
 class SMSHandler(BaseHandler):
     allowed_methods = ('POST', 'GET')
-    fields = ('identifier', 'delivery', 'expiry', 'delivery_timestamp',
+    fields = ('id', 'identifier', 'delivery', 'expiry', 'delivery_timestamp',
                 'status', 'status_display', 'msisdn')
     model = SendSMS
 
-    @throttle(10, 60)
+    @rate_limit('SMSHandler.read')
     def read(self, request, msisdn=None, identifier=None):
         if not request.user.has_perm('gateway.can_view_sms_statistics'):
             return rc.FORBIDDEN
@@ -61,12 +114,15 @@ class SMSHandler(BaseHandler):
             # remove timezone info since MySQL is not able to handle that
             # assume input it UTC
             since = iso8601.parse_date(request.GET['since']).replace(tzinfo=None)
-            return SendSMS.objects.filter(delivery__gte=since, user=request.user)
+            return paginate(request, SendSMS.objects.filter(
+                                    delivery__gte=since, user=request.user))
+        elif 'since_id' in request.GET:
+            return paginate(request, SendSMS.objects.filter(user=request.user))
         else:
             return rc.BAD_REQUEST
 
 
-    @throttle(10, 60)
+    @rate_limit('SMSHandler.create')
     @require_mime('json')
     def create(self, request):
         if not request.user.has_perm('gateway.can_send_sms'):
@@ -84,6 +140,78 @@ class SMSHandler(BaseHandler):
         return instance.get_status_display()
 
 
+class SMSJobHandler(BaseHandler):
+    """Bulk submission of personalised messages. The messages are queued in
+    the outbound queue and sent asynchronously by `send_queued_sms`, the
+    job id returned can be used to follow their progress."""
+    allowed_methods = ('POST', 'GET')
+    model = SMSJob
+
+    @rate_limit('SMSJobHandler.read')
+    def read(self, request, job_id=None):
+        if not request.user.has_perm('gateway.can_view_sms_statistics'):
+            return rc.FORBIDDEN
+        if job_id is None:
+            return rc.BAD_REQUEST
+
+        job = get_object_or_404(SMSJob, pk=job_id, user=request.user)
+        statuses = job.status_counts()
+        return {
+            'id': job.pk,
+            'created_at': job.created_at,
+            'total': sum(statuses.values()),
+            'queued': sum([statuses.get(status, 0) for status in
+                            (outbox.QUEUED, outbox.IN_PROGRESS, outbox.UNSENT)]),
+            'statuses': statuses,
+            'messages': [dict(zip(('id', 'msisdn', 'status', 'identifier'),
+                            values)) for values in job.messages.order_by('id')
+                            .values_list('id', 'msisdn', 'status',
+                                            'identifier')],
+        }
+
+    @rate_limit('SMSJobHandler.create')
+    @require_mime('json')
+    def create(self, request):
+        """
+        Accepts a list of messages, either as is or as `messages` in a dict:
+
+            [{"msisdn": "27761234567", "smstext": "Hi Jane"}, ...]
+
+        Messages longer than a single SMS are sent as concatenated SMSs of
+        at most SMS_MAX_PARTS parts.
+        """
+        if not request.user.has_perm('gateway.can_send_sms'):
+            return rc.FORBIDDEN
+
+        messages = request.data
+        if isinstance(messages, dict):
+            messages = messages.get('messages')
+        if not isinstance(messages, list) or not messages:
+            return rc.BAD_REQUEST
+
+        msisdns, smstexts = [], []
+        for index, message in enumerate(messages):
+            try:
+                msisdn, smstext = str(message['msisdn']), message['smstext']
+            except (KeyError, TypeError, UnicodeError):
+                msisdn, smstext = '', ''
+            if not (msisdn.isdigit() and len(msisdn) <= 12 and smstext and
+                    isinstance(smstext, basestring) and
+                    outbox.message_parts(smstext) <= SMS_MAX_PARTS):
+                resp = rc.BAD_REQUEST
+                resp.write(': invalid message at index %s' % index)
+                return resp
+            msisdns.append(msisdn)
+            smstexts.append(smstext)
+
+        job = SMSJob.objects.create(user=request.user)
+        outbox.enqueue(request.user, msisdns, smstexts, job=job)
+        return {
+            'id': job.pk,
+            'total': len(msisdns),
+        }
+
+
 class SMSReceiptHandler(BaseHandler):
     """This is completely handed off to the specified gateway, it should
     specify the sms_receipt_handler, this can be a regular Django view
@@ -96,14 +224,15 @@ class SMSReceiptHandler(BaseHandler):
 
 class PCMHandler(BaseHandler):
     allowed_methods = ('POST', 'GET')
-    fields = ('sms_id', 'sender_msisdn', 'recipient_msisdn', 'created_at')
+    fields = ('id', 'sms_id', 'sender_msisdn', 'recipient_msisdn', 'created_at')
     model = PleaseCallMe
 
-    @throttle(10, 60)
+    @rate_limit('PCMHandler.read')
     def read(self, request):
         """
         Return the list of PleaseCallMe's received since the timestamp specified
-        in the `since` parameter.
+        in the `since` parameter or after the one with the id specified in the
+        `since_id` parameter, see `paginate`.
         """
         if not request.user.has_perm('gateway.can_view_pcm_statistics'):
             return rc.FORBIDDEN
@@ -112,11 +241,17 @@ class PCMHandler(BaseHandler):
             # remove timezone info since MySQL is not able to handle that
             # assume input it UTC
             since = iso8601.parse_date(request.GET['since']).replace(tzinfo=None)
-            return PleaseCallMe.objects.filter(user=request.user, created_at__gte=since)
+            return paginate(request, PleaseCallMe.objects.filter(
+                                    user=request.user, created_at__gte=since))
+        elif 'since_id' in request.GET:
+            return paginate(request, 
+                            PleaseCallMe.objects.filter(user=request.user))
         else:
             return rc.BAD_REQUEST
 
-    def write_sms(self, user, sms_id, sender_msisdn, recipient_msisdn, message):
+    def clean_message(self, sender_msisdn, message):
+        """Returns the sender & message to store for a PCM, voicemail
+        notifications are registered as coming from the caller."""
         if isinstance(message, unicode):
             message = message.encode('unicode_escape')
 
@@ -125,26 +260,121 @@ class PCMHandler(BaseHandler):
             if match:
                 sender_msisdn, date = match
                 message = "Missed call from %s, left at %s." % (sender_msisdn, date)
+        return sender_msisdn, message
+
+    def is_duplicate(self, dedupe_keys, now):
+        return bool([dedupe_key for dedupe_key in dedupe_keys
+                        if recent_pcm_keys.seen(dedupe_key, now)])
+
+    def remember_keys(self, new_keys):
+        """Add the dedupe keys of the PCMs created to the keys recently seen,
+        only once their transaction has committed so keys of PCMs that were
+        rolled back don't reject the resubmission."""
+        for dedupe_key, created_at in new_keys:
+            recent_pcm_keys.add(dedupe_key, created_at)
+
+    def create_pcm(self, user, dedupe_keys, sms_id, sender_msisdn,
+                    recipient_msisdn, message):
+        """Store the PCM unless one with the same dedupe key got there first,
+        the unique key settles concurrent submissions. Returns the PCM or
+        None for a duplicate."""
+        sid = transaction.savepoint()
+        try:
+            pcm = PleaseCallMe.objects.create(user=user, sms_id=sms_id,
+                                        sender_msisdn=sender_msisdn,
+                                        recipient_msisdn=recipient_msisdn,
+                                        message=message,
+                                        dedupe_key=dedupe_keys[0])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return None
+        return pcm
 
-        # check for duplicate submissions
-        if PleaseCallMe.objects.filter(
-            sender_msisdn=sender_msisdn,
-            message=message,
-            created_at__gt=datetime.now() - timedelta(hours=2)).exists():
+    @transaction.commit_on_success
+    def write_sms(self, user, sms_id, sender_msisdn, recipient_msisdn, message,
+                    new_keys):
+        """Register a single PCM, the dedupe key of the PCM created is
+        appended to `new_keys` as a (key, created_at) tuple."""
+        sender_msisdn, message = self.clean_message(sender_msisdn, message)
+
+        # check for duplicate submissions, first in the keys this process
+        # has seen, then against the dedupe key index and finally by the
+        # unique dedupe key when the PCM is stored
+        now = datetime.now()
+        dedupe_keys = PleaseCallMe.dedupe_keys_for(sender_msisdn, message,
+                                                    now)
+        if self.is_duplicate(dedupe_keys, now) or \
+            PleaseCallMe.objects.filter(dedupe_key__in=dedupe_keys,
+                created_at__gt=now - DUPLICATE_PCM_WINDOW).exists():
+            pcm = None
+        else:
+            pcm = self.create_pcm(user, dedupe_keys, sms_id, sender_msisdn,
+                                    recipient_msisdn, message)
+        if pcm is None:
             resp = rc.DUPLICATE_ENTRY
             resp.content = ''
             resp['Content-Length'] = 0
             return resp
+        new_keys.append((dedupe_keys[0], pcm.created_at))
 
-        pcm = PleaseCallMe.objects.create(user=user, sms_id=sms_id,
-                                        sender_msisdn=sender_msisdn,
-                                        recipient_msisdn=recipient_msisdn,
-                                        message=message)
         resp = rc.CREATED
         resp.content = 'Please Call Me registered'
         resp['Content-Length'] = len(resp.content)
         return resp
 
+    @transaction.commit_on_success
+    def write_batch(self, user, messages, new_keys, chunk_size=500):
+        """Register a list of PCMs, each either in the Vumi message format or
+        with the FrontlineSMS parameters as keys. Duplicates are checked for
+        within the batch and against the database in one go and the PCMs
+        are tracked back to their patients together. The dedupe keys of the
+        PCMs created are appended to `new_keys`. Returns a list with the
+        sms_id & status of each; created, duplicate or invalid."""
+        now = datetime.now()
+        results, pcms = [], []
+        for message in messages:
+            try:
+                if 'message_id' in message:
+                    fields = [message['message_id'], message['from_addr'],
+                                message['to_addr'], message['content']]
+                else:
+                    fields = [message['sms_id'], message['sender_msisdn'],
+                                message['recipient_msisdn'],
+                                message.get('message', '')]
+            except (KeyError, TypeError):
+                results.append({'sms_id': None, 'status': 'invalid'})
+                continue
+            sms_id, sender_msisdn, recipient_msisdn, message = fields
+            sender_msisdn, message = self.clean_message(sender_msisdn, message)
+            result = {'sms_id': sms_id, 'status': 'created'}
+            results.append(result)
+            pcms.append((result, PleaseCallMe.dedupe_keys_for(sender_msisdn,
+                            message, now), [sms_id, sender_msisdn,
+                            recipient_msisdn, message]))
+
+        dedupe_keys = list(set(sum([keys for _, keys, _ in pcms], [])))
+        seen = set([dedupe_key for dedupe_key in dedupe_keys
+                    if recent_pcm_keys.seen(dedupe_key, now)])
+        for i in range(0, len(dedupe_keys), chunk_size):
+            seen.update(PleaseCallMe.objects.filter(
+                dedupe_key__in=dedupe_keys[i:i + chunk_size],
+                created_at__gt=now - DUPLICATE_PCM_WINDOW).values_list(
+                'dedupe_key', flat=True))
+
+        with deferred_pcm_tracking():
+            for result, keys, fields in pcms:
+                if seen.intersection(keys):
+                    pcm = None
+                else:
+                    pcm = self.create_pcm(user, keys, *fields)
+                if pcm is None:
+                    result['status'] = 'duplicate'
+                    continue
+                seen.add(keys[0])
+                new_keys.append((keys[0], pcm.created_at))
+        return results
+
 
     def create(self, request):
         """
@@ -171,6 +401,8 @@ class PCMHandler(BaseHandler):
         if not request.user.has_perm('gateway.can_place_pcm'):
             return rc.FORBIDDEN
 
+        # the dedupe keys of the PCMs created, remembered once committed
+        new_keys = []
         if ('sms_id' in request.POST
             and 'sender_msisdn' in request.POST
             and 'recipient_msisdn' in request.POST):
@@ -178,15 +410,24 @@ class PCMHandler(BaseHandler):
             sender_msisdn = request.POST.get('sender_msisdn')
             recipient_msisdn = request.POST.get('recipient_msisdn')
             message = request.POST.get('message', '')
-            return self.write_sms(request.user, sms_id, sender_msisdn,
-                                    recipient_msisdn, message)
+            resp = self.write_sms(request.user, sms_id, sender_msisdn,
+                                    recipient_msisdn, message, new_keys)
         else:
             try:
                 msg = json.loads(request.raw_post_data)
-                return self.write_sms(request.user, msg['message_id'],
-                        msg['from_addr'], msg['to_addr'], msg['content'])
-            except Exception, e:
+                if not isinstance(msg, list):
+                    fields = [msg['message_id'], msg['from_addr'],
+                                msg['to_addr'], msg['content']]
+            except (ValueError, KeyError, TypeError):
                 return rc.BAD_REQUEST
+            # FrontlineSMS replays everything it has queued up in one go
+            # after an outage, a list of PCMs is registered as a batch
+            if isinstance(msg, list):
+                resp = self.write_batch(request.user, msg, new_keys)
+            else:
+                resp = self.write_sms(request.user, *(fields + [new_keys]))
+        self.remember_keys(new_keys)
+        return resp
 
 class PatientHandler(BaseHandler):
     allowed_methods = ('GET',)
@@ -201,38 +442,29 @@ class PatientHandler(BaseHandler):
                 normalized_msisdn = normalize_msisdn(msisdn)
                 patient = Patient.objects.get(active_msisdn__msisdn=normalized_msisdn,
                                                 te_id=patient_id)
-                try:
-                    visit = patient.next_visit()
-                    visit_info = [visit.date.year, visit.date.month, visit.date.day]
-                    clinic_name = visit.clinic.name
-                except Visit.DoesNotExist:
-                    visit = None
+                statistics = VisitStatistics.objects.for_patient(patient)
+                if statistics.next_visit_date:
+                    next_date = statistics.next_visit_date
+                    visit_info = [next_date.year, next_date.month, 
+                                    next_date.day]
+                    clinic_name = statistics.next_visit_clinic.name
+                else:
                     visit_info = []
                     clinic_name = ''
 
-                visits = patient.visit_set.all()
-                attended = visits.filter(status='a').count()
-                rescheduled = visits.filter(status='r').count()
-                missed = visits.filter(status='m').count()
-                total = visits.filter(date__lt=date.today()).count()
-                if total:
-                    attendance = int(float(attended) / float(total) * 100)
-                else:
-                    attendance = 0.0
-
                 return {
                     'msisdn': msisdn,
                     'patient_id': patient_id,
                     'name': patient.name,
                     'surname': patient.surname,
                     'next_appointment': visit_info,
-                    'visit_id': visit.pk if visit else '',
+                    'visit_id': statistics.next_visit_id or '',
                     'clinic': clinic_name,
-                    'attendance': attendance,
-                    'total': total,
-                    'attended': attended,
-                    'rescheduled': rescheduled,
-                    'missed': missed,
+                    'attendance': statistics.attendance,
+                    'total': statistics.past_visits,
+                    'attended': statistics.attended,
+                    'rescheduled': statistics.rescheduled,
+                    'missed': statistics.missed,
                 }
             except Patient.DoesNotExist:
                 pass
@@ -5,18 +5,30 @@ from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.utils import simplejson
 from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.conf import settings
 from txtalert.apps.gateway.backends.opera.utils import element_to_namedtuple, OPERA_TIMESTAMP_FORMAT
 from txtalert.apps.gateway.models import SendSMS, PleaseCallMe
 from txtalert.core.models import Visit, ChangeRequest, PleaseCallMe as CorePleaseCallMe
+from txtalert.core.models import Patient, Clinic, VisitStatistics
+from txtalert.apps.api.handlers import recent_pcm_keys, PCMHandler
+from txtalert.apps.api import handlers
+from txtalert.apps.api import throttling
 
 import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 import base64
+import tempfile
+import shutil
 import iso8601
 import json
 from txtalert.apps import gateway
+from txtalert.apps.gateway import outbox
 backend, gateway, receipt_handler = gateway.load_backend('txtalert.apps.gateway.backends.dummy')
 
+# keep the rate limits in memory rather than in files that outlive the tests
+throttling.backend = throttling.LocalBackend()
+
 def basic_auth_string(username, password):
     """
     Encode a username and password for use in an HTTP Basic Authentication
@@ -264,6 +276,27 @@ class OperaTestCase(TestCase):
 
 
 
+    def test_bulk_receipt_processing(self):
+        """receipts are matched with one query and applied with one update
+        per distinct status & timestamp"""
+        from txtalert.apps.gateway.backends.opera.utils import (Receipt, 
+                                                            process_receipts)
+        for i in range(3):
+            SendSMS.objects.create(user=self.user, msisdn='2776123456%s' % i,
+                identifier='ref%s' % i, delivery=datetime.now(), 
+                expiry=datetime.now() + timedelta(days=1))
+        receipts = [Receipt('%s' % i, 'ref%s' % i, '+2776123456%s' % i, 'D', 
+                        '20080831T15:59:24', 'NO') for i in range(3)]
+        receipts.append(Receipt('4', 'ref4', '+27761234564', 'D', 
+                        '20080831T15:59:24', 'NO'))
+        
+        self.assertNumQueries(2, process_receipts, receipts)
+        success, fail = process_receipts(receipts)
+        self.assertEquals(success, receipts[:3])
+        self.assertEquals(fail, receipts[3:])
+        self.assertEquals(SendSMS.objects.filter(status='D', 
+            delivery_timestamp=datetime(2008, 8, 31, 15, 59, 24)).count(), 3)
+
 class SmsGatewayTestCase(TestCase):
     """Testing the opera gateway interactions"""
 
@@ -370,6 +403,55 @@ class SmsGatewayTestCase(TestCase):
         for receipt in data:
             self.assertTrue(receipt['msisdn'] in ['27123456789', '27123456781'])
 
+    def test_bulk_sms_job(self):
+        add_perms_to_user('user', 'can_send_sms')
+        add_perms_to_user('user', 'can_view_sms_statistics')
+        submit = lambda messages: self.client.post(
+            reverse('api-sms-job', kwargs={'emitter_format': 'json'}),
+            simplejson.dumps(messages),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=basic_auth_string('user','password'))
+
+        # one invalid message rejects the whole job
+        response = submit([
+            {'msisdn': '27123456789', 'smstext': 'hello'},
+            {'msisdn': '27123456781', 'smstext': 'a' * 153 * 7},
+        ])
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(submit([
+            {'msisdn': '27123456789', 'smstext': 12345},
+        ]).status_code, 400)
+        self.assertEquals(SendSMS.objects.count(), 0)
+
+        response = submit({'messages': [
+            {'msisdn': '27123456789', 'smstext': 'hello Jane'},
+            {'msisdn': '27123456781', 'smstext': 'a' * 161}, # concatenated
+        ]})
+        self.assertEquals(response.status_code, 200)
+        job_id = simplejson.loads(response.content)['id']
+        self.assertEquals(SendSMS.objects.filter(job=job_id, 
+                                            status=outbox.QUEUED).count(), 2)
+
+        def progress():
+            response = self.client.get(reverse('api-sms-job', kwargs={
+                    'job_id': job_id, 'emitter_format': 'json'}),
+                HTTP_AUTHORIZATION=basic_auth_string('user','password'))
+            self.assertEquals(response.status_code, 200)
+            return simplejson.loads(response.content)
+
+        data = progress()
+        self.assertEquals((data['total'], data['queued']), (2, 2))
+        self.assertEquals([message['msisdn'] for message in data['messages']],
+                            ['27123456789', '27123456781'])
+
+        worker = outbox.Worker(gateway)
+        self.assertEquals(worker.run_once(), (2, 0))
+        data = progress()
+        self.assertEquals((data['total'], data['queued']), (2, 0))
+        self.assertEquals(data['statuses'], {'v': 2})
+        self.assertTrue(all([message['identifier'] 
+                                for message in data['messages']]))
+
     def test_send_too_large_sms(self):
         add_perms_to_user('user', 'can_send_sms')
 
@@ -396,10 +478,14 @@ class PcmAutomationTestCase(TestCase):
         # we don't want to be bogged down with signal receivers in this test
         self.original_post_save_receivers = post_save.receivers
         post_save.receivers = []
+        # don't let PCMs received in earlier tests count as duplicates
+        recent_pcm_keys.clear()
 
     def tearDown(self):
         # restore signals
         post_save.receivers = self.original_post_save_receivers
+        # reads are throttled per username, which all these tests share
+        throttling.backend.clear()
 
     def test_pcm_receiving(self):
         """We're assuming that FrontlineSMS or some other SMS receiving app
@@ -426,6 +512,146 @@ class PcmAutomationTestCase(TestCase):
         for key, value in parameters.items():
             self.assertEquals(getattr(pcm, key), value)
 
+    def test_duplicate_pcm_receiving(self):
+        add_perms_to_user('user', 'can_place_pcm')
+
+        parameters = {
+            'sender_msisdn': '27123456789',
+            'recipient_msisdn': '27123456780',
+            'sms_id': 'doesntmatteratm',
+            'message': 'Please Call: Test User at 27123456789'
+        }
+
+        def submit():
+            return self.client.post(reverse('api-pcm',kwargs={'emitter_format':'json'}),
+                parameters,
+                HTTP_AUTHORIZATION=basic_auth_string('user','password')
+            )
+
+        self.assertEquals(submit().status_code, 201) # Created
+        self.assertEquals(submit().status_code, 409) # Duplicate
+        # also rejected by the database check when this process hasn't
+        # seen it before
+        recent_pcm_keys.clear()
+        self.assertEquals(submit().status_code, 409)
+        self.assertEquals(PleaseCallMe.objects.count(), 1)
+
+        # the same message from a different sender isn't a duplicate
+        parameters['sender_msisdn'] = '27123456788'
+        self.assertEquals(submit().status_code, 201)
+
+        # concurrent submissions both pass the checks, only one is stored
+        user = User.objects.get(username='user')
+        dedupe_keys = PleaseCallMe.dedupe_keys_for('27123456787',
+                                            'Please Call', datetime.now())
+        handler = PCMHandler()
+        self.assertTrue(handler.create_pcm(user, dedupe_keys, '1',
+                        '27123456787', '27123456780', 'Please Call'))
+        self.assertEquals(handler.create_pcm(user, dedupe_keys, '2',
+                        '27123456787', '27123456780', 'Please Call'), None)
+        self.assertEquals(PleaseCallMe.objects.filter(
+                            sender_msisdn='27123456787').count(), 1)
+
+    def test_pcm_dedupe_keys(self):
+        now = datetime(2011, 8, 1, 12, 30)
+        current, previous = PleaseCallMe.dedupe_keys_for(u'27123',
+                                                        u'caf\xe9', now)
+        self.assertNotEquals(current, previous)
+        # the bytes & the unicode of a message give the same key
+        self.assertEquals(PleaseCallMe.dedupe_keys_for('27123',
+                            u'caf\xe9'.encode('utf-8'), now)[0], current)
+        # the current key is the previous key of the next period
+        self.assertEquals(PleaseCallMe.dedupe_keys_for(u'27123', u'caf\xe9',
+                            now + PleaseCallMe.DEDUPE_WINDOW)[1], current)
+
+    def test_batch_pcm_receiving(self):
+        add_perms_to_user('user', 'can_place_pcm')
+        # one PCM that has been received before
+        self.client.post(reverse('api-pcm', kwargs={'emitter_format': 'json'}),
+            {
+                'sender_msisdn': '27123456781',
+                'recipient_msisdn': '27123456780',
+                'sms_id': '0',
+                'message': 'Please Call: Test User at 27123456781',
+            },
+            HTTP_AUTHORIZATION=basic_auth_string('user','password'))
+
+        def vumi_message(message_id, from_addr):
+            return {
+                "message_id": message_id,
+                "to_addr": "27123456780",
+                "from_addr": from_addr,
+                "content": "Please Call: Test User at %s" % from_addr,
+                "transport_name": "sms_transport",
+                "transport_type": "sms",
+                "transport_metadata": {}
+            }
+
+        response = self.client.post(reverse('api-pcm', kwargs={'emitter_format': 'json'}),
+            json.dumps([
+                vumi_message("1", "27123456781"),
+                vumi_message("2", "27123456782"),
+                vumi_message("3", "27123456782"),
+                {
+                    'sender_msisdn': '27123456783',
+                    'recipient_msisdn': '27123456780',
+                    'sms_id': '4',
+                    'message': 'Please Call: Test User at 27123456783',
+                },
+                {'message_id': '5'},
+            ]),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=basic_auth_string('user','password'))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.content), [
+            {'sms_id': '1', 'status': 'duplicate'},
+            {'sms_id': '2', 'status': 'created'},
+            {'sms_id': '3', 'status': 'duplicate'},
+            {'sms_id': '4', 'status': 'created'},
+            {'sms_id': None, 'status': 'invalid'},
+        ])
+        self.assertEquals(
+            list(PleaseCallMe.objects.values_list('sms_id', flat=True)),
+            ['0', '2', '4']
+        )
+
+    def test_failed_batch_keys_arent_remembered(self):
+        """A batch that fails is rolled back, its dedupe keys mustn't make
+        the resubmission a duplicate."""
+        user = User.objects.get(username='user')
+        handler = PCMHandler()
+        create_pcm = handler.create_pcm
+        def failing_create_pcm(*args):
+            if PleaseCallMe.objects.exists():
+                raise RuntimeError('database went away')
+            return create_pcm(*args)
+        handler.create_pcm = failing_create_pcm
+        messages = [{
+            'sender_msisdn': '2712345678%s' % i,
+            'recipient_msisdn': '27123456780',
+            'sms_id': str(i),
+            'message': 'Please Call',
+        } for i in range(2)]
+        new_keys = []
+        self.assertRaises(RuntimeError, handler.write_batch, user, messages,
+                            new_keys)
+        self.assertEquals(len(new_keys), 1)
+        self.assertFalse(handler.is_duplicate([new_keys[0][0]],
+                                                datetime.now()))
+        # the keys are only remembered once committed
+        handler.remember_keys(new_keys)
+        self.assertTrue(handler.is_duplicate([new_keys[0][0]],
+                                                datetime.now()))
+
+    def test_invalid_pcm_json(self):
+        add_perms_to_user('user', 'can_place_pcm')
+        for content in ['not json', '42', '{"message_id": "1"}']:
+            response = self.client.post(
+                reverse('api-pcm', kwargs={'emitter_format': 'json'}),
+                content, content_type='application/json',
+                HTTP_AUTHORIZATION=basic_auth_string('user','password'))
+            self.assertEquals(response.status_code, 400)
+
     def test_voicemail_message_receiving(self):
         add_perms_to_user('user', 'can_place_pcm')
 
@@ -555,6 +781,39 @@ class PcmAutomationTestCase(TestCase):
         for key in ('sms_id', 'sender_msisdn', 'recipient_msisdn'):
             self.assertEquals(parameters[key], first_item[key])
 
+    def test_pcm_statistics_pagination(self):
+        add_perms_to_user('user', 'can_view_pcm_statistics')
+        pcms = [PleaseCallMe.objects.create(user=self.user, sms_id=str(i),
+                    sender_msisdn='2712345678%s' % i,
+                    recipient_msisdn='27123456780')
+                for i in range(5)]
+
+        def read(emitter_format='json', **parameters):
+            response = self.client.get(
+                reverse('api-pcm', kwargs={'emitter_format': emitter_format}),
+                parameters,
+                HTTP_AUTHORIZATION=basic_auth_string('user','password'))
+            self.assertEquals(response.status_code, 200)
+            return [pcm['sms_id'] for pcm in json.loads(response.content)]
+
+        self.assertEquals(read(since_id=0, limit=2), ['0', '1'])
+        self.assertEquals(read(since_id=pcms[1].pk, limit=2), ['2', '3'])
+        self.assertEquals(read(since_id=pcms[3].pk, limit=2), ['4'])
+        yesterday = datetime.now() - timedelta(days=1)
+        self.assertEquals(read('json-stream', 
+            since=yesterday.strftime(SendSMS.TIMESTAMP_FORMAT), 
+            since_id=pcms[0].pk), ['1', '2', '3', '4'])
+        self.assertEquals(read('json-stream', since_id=pcms[4].pk), [])
+        # reads by `since` alone aren't cut off at a page
+        page_size = handlers.API_PAGE_SIZE
+        handlers.API_PAGE_SIZE = 2
+        try:
+            since = yesterday.strftime(SendSMS.TIMESTAMP_FORMAT)
+            self.assertEquals(read(since=since), ['0', '1', '2', '3', '4'])
+            self.assertEquals(read(since=since, limit=10), ['0', '1'])
+        finally:
+            handlers.API_PAGE_SIZE = page_size
+
     def test_pcm_statistics_bad_request(self):
         add_perms_to_user('user', 'can_place_pcm')
         add_perms_to_user('user', 'can_view_pcm_statistics')
@@ -628,3 +887,110 @@ class CallRequestTestCase(TestCase):
         self.assertEquals(pcm.msisdn.msisdn, '27761234567')
         self.assertEquals(pcm.user, self.user)
 
+
+class PatientTestCase(TestCase):
+
+    fixtures = ['contacts.json', 'patients.json', 'clinics.json', 
+                'visits.json']
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', \
+                                                email='user@domain.com', \
+                                                password='password')
+        self.patient = Patient.objects.all()[0]
+        self.patient.save() # specify the active_msisdn
+
+    def test_patient_statistics(self):
+        visit = self.patient.visit_set.create(
+            clinic=Clinic.objects.all()[0],
+            date=date.today() + timedelta(days=1),
+            status='s'
+        )
+        response = self.client.get(
+            reverse('api-patient', kwargs={'emitter_format':'json'}), {
+                'patient_id': self.patient.te_id,
+                'msisdn': self.patient.active_msisdn.msisdn,
+            }, HTTP_AUTHORIZATION=basic_auth_string('user','password')
+        )
+        data = json.loads(response.content)
+        statistics = VisitStatistics.objects.get(patient=self.patient)
+        self.assertEquals(data['visit_id'], visit.pk)
+        self.assertEquals(data['clinic'], visit.clinic.name)
+        self.assertEquals(data['attended'], statistics.attended)
+        self.assertEquals(data['total'], statistics.past_visits)
+
+
+class RateLimitTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user',
+                                                email='user@domain.com',
+                                                password='password')
+
+    def tearDown(self):
+        cache.clear()
+        throttling.backend.clear()
+
+    def assertBucket(self, backend):
+        # a bucket of 2 requests per 10 seconds
+        consume = lambda now: backend.consume('user:limit', 2, 10, now)
+        self.assertTrue(consume(1000))
+        self.assertTrue(consume(1000))
+        self.assertFalse(consume(1000))
+        # one token is back after 5 seconds
+        self.assertTrue(consume(1005))
+        self.assertFalse(consume(1005))
+        # and never more than the bucket holds
+        self.assertTrue(consume(2000))
+        self.assertTrue(consume(2000))
+        self.assertFalse(consume(2000))
+
+    def test_local_backend(self):
+        self.assertBucket(throttling.LocalBackend())
+
+    def test_file_backend(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertBucket(throttling.FileBackend(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cache_backend(self):
+        backend = throttling.CacheBackend()
+        consume = lambda now: backend.consume('user:limit', 2, 10, now)
+        self.assertTrue(consume(1000))
+        self.assertTrue(consume(1001))
+        self.assertFalse(consume(1009))
+        # the next window
+        self.assertTrue(consume(1010))
+
+    def test_limits_by_permission(self):
+        original_limits = getattr(settings, 'API_RATE_LIMITS', None)
+        settings.API_RATE_LIMITS = {'default': (10, 60)}
+        settings.API_RATE_LIMITS_BY_PERMISSION = (
+            ('gateway.can_send_sms', {'SMSHandler.create': (100, 60)}),
+        )
+        try:
+            self.assertEquals(throttling.limit_for(self.user, 
+                                'SMSHandler.create'), (10, 60))
+            add_perms_to_user('user', 'can_send_sms')
+            user = User.objects.get(username='user')
+            self.assertEquals(throttling.limit_for(user, 
+                                'SMSHandler.create'), (100, 60))
+            self.assertEquals(throttling.limit_for(user, 
+                                'PCMHandler.read'), (10, 60))
+        finally:
+            settings.API_RATE_LIMITS = original_limits
+            del settings.API_RATE_LIMITS_BY_PERMISSION
+
+    def test_throttled_requests(self):
+        add_perms_to_user('user', 'can_view_pcm_statistics')
+        def read():
+            return self.client.get(reverse('api-pcm', kwargs={'emitter_format': 'json'}),
+                {'since_id': 0},
+                HTTP_AUTHORIZATION=basic_auth_string('user','password'))
+        for i in range(10):
+            self.assertEquals(read().status_code, 200)
+        response = read()
+        self.assertEquals(response.status_code, 503)
+        self.assertEquals(response['Retry-After'], '6')
@@ -0,0 +1,177 @@
+"""
+Rate limiting for the API, replaces Piston's `@throttle` which reads and
+writes a counter in the Django cache on every request.
+
+Every API user gets a token bucket per limit, the bucket holds `requests`
+tokens and refills at `requests` per `seconds`. A request takes a token or
+is refused with a 503 when the bucket is empty. The limits are configured
+with the API_RATE_LIMITS setting, keyed by the name passed to `rate_limit`
+with 'default' applying to all others:
+
+    API_RATE_LIMITS = {
+        'default': (10, 60),
+        'SMSHandler.create': (10, 60),
+    }
+
+Users holding a permission listed in API_RATE_LIMITS_BY_PERMISSION get that
+limit instead, the first permission that matches wins:
+
+    API_RATE_LIMITS_BY_PERMISSION = (
+        ('gateway.can_send_sms', {'SMSHandler.create': (100, 60)}),
+    )
+
+Where the buckets are kept is up to the backend in API_RATE_LIMIT_BACKEND,
+each request costs the backend one atomic operation:
+
+- `LocalBackend` keeps them in memory, for a single process.
+- `FileBackend` keeps them in files locked with flock, for several worker
+  processes on a single host. This is the default.
+- `CacheBackend` keeps them in the Django cache, for several hosts. It only
+  approximates the buckets with a counter per window, a user can get up to
+  twice the limit through around the start of a window. It needs a cache
+  shared by all the processes, e.g. memcached; Django's default local memory
+  cache is per process.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from piston.decorator import decorator
+from piston.utils import rc
+import threading
+import hashlib
+import fcntl
+import time
+import os
+
+
+class LocalBackend(object):
+    """Token buckets kept in this process' memory"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def consume(self, key, requests, seconds, now=None):
+        now = now or time.time()
+        self.lock.acquire()
+        try:
+            tokens, updated = self.buckets.get(key, (requests, now))
+            allowed, tokens = refill_and_take(tokens, updated, requests,
+                                                seconds, now)
+            self.buckets[key] = (tokens, now)
+            return allowed
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class FileBackend(object):
+    """Token buckets kept in a file per bucket in API_RATE_LIMIT_DIR, shared
+    by the processes on this host. The file is locked while the bucket is
+    updated."""
+
+    def __init__(self, directory=None):
+        self.directory = directory or getattr(settings, 'API_RATE_LIMIT_DIR',
+                                                '/tmp/txtalert-rate-limits')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def consume(self, key, requests, seconds, now=None):
+        now = now or time.time()
+        fd = os.open(self.path(key), os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                tokens, updated = map(float, os.read(fd, 64).split())
+            except ValueError:
+                tokens, updated = requests, now
+            allowed, tokens = refill_and_take(tokens, updated, requests,
+                                                seconds, now)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '%r %r' % (tokens, now))
+            return allowed
+        finally:
+            os.close(fd)
+
+
+class CacheBackend(object):
+    """Buckets kept in the Django cache. The cache has no atomic read and
+    write, only an atomic increment, so the bucket is approximated with a
+    counter per `seconds` long window that is refilled at the start of the
+    next window. Requests at the end of one window and the start of the next
+    can use up both, so bursts of up to twice the limit get through."""
+
+    def consume(self, key, requests, seconds, now=None):
+        now = now or time.time()
+        window_key = 'rate-limit:%s:%s' % (key, int(now // seconds))
+        try:
+            count = cache.incr(window_key)
+        except ValueError:
+            # first request in this window, another process may have beaten
+            # us to it
+            if cache.add(window_key, 1, int(seconds) + 1):
+                count = 1
+            else:
+                count = cache.incr(window_key)
+        return count <= requests
+
+
+def refill_and_take(tokens, updated, requests, seconds, now):
+    """Refill the bucket for the time passed since it was last updated and
+    take a token from it if there is one. Returns a tuple of whether a
+    token was taken and the number of tokens left."""
+    tokens = min(float(requests),
+                    tokens + (now - updated) * requests / float(seconds))
+    if tokens >= 1:
+        return True, tokens - 1
+    return False, tokens
+
+
+def load_backend(path):
+    module_name, class_name = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module_name), class_name)()
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured, \
+                'Rate limit backend %s does not exist: %s' % (path, e)
+
+backend = load_backend(getattr(settings, 'API_RATE_LIMIT_BACKEND',
+                        'txtalert.apps.api.throttling.FileBackend'))
+
+
+def limit_for(user, name):
+    """The (requests, seconds) limit for the user for the named limit"""
+    limits = getattr(settings, 'API_RATE_LIMITS', {})
+    for permission, permission_limits in getattr(settings,
+                                    'API_RATE_LIMITS_BY_PERMISSION', ()):
+        if name in permission_limits and user.has_perm(permission):
+            return permission_limits[name]
+    return limits.get(name, limits.get('default', (10, 60)))
+
+def rate_limit(name):
+    """Decorator for handler methods, refuses the request with a 503 when the
+    user has used up the named limit. Requests are identified by username
+    or otherwise by IP address."""
+    @decorator
+    def wrap(f, self, request, *args, **kwargs):
+        if request.user.is_authenticated():
+            ident = request.user.username
+        else:
+            ident = request.META.get('REMOTE_ADDR', None)
+
+        if ident:
+            requests, seconds = limit_for(request.user, name)
+            if not backend.consume('%s:%s' % (ident, name), requests,
+                                    seconds):
+                resp = rc.THROTTLED
+                resp['Retry-After'] = int(seconds / requests) or 1
+                return resp
+        return f(self, request, *args, **kwargs)
+    return wrap
@@ -3,8 +3,9 @@ from django.http import HttpResponse
 from piston.resource import Resource
 from piston.authentication import HttpBasicAuthentication
 from piston.utils import Mimer
+from txtalert.apps.api import emitters # registers the json-stream emitter
 from txtalert.apps.api.handlers import (SMSHandler, PCMHandler,
-                                        SMSReceiptHandler, PatientHandler,
+                                        SMSJobHandler, SMSReceiptHandler, PatientHandler,
                                         ChangeRequestHandler, CallRequestHandler)
 
 # make sure Piston also accepts text/xml with charset=utf-8
@@ -14,6 +15,7 @@ http_basic_authentication = HttpBasicAuthentication()
 
 sms_receipt_handler = Resource(SMSReceiptHandler, http_basic_authentication)
 sms_handler = Resource(SMSHandler, http_basic_authentication)
+sms_job_handler = Resource(SMSJobHandler, http_basic_authentication)
 pcm_handler = Resource(PCMHandler, http_basic_authentication)
 patient_handler = Resource(PatientHandler)
 change_request_handler = Resource(ChangeRequestHandler, http_basic_authentication)
@@ -22,6 +24,8 @@ call_request_handler = Resource(CallRequestHandler, http_basic_authentication)
 # SMS api
 urlpatterns = patterns('',
     url(r'^sms/receipt\.(?P<emitter_format>.+)$', sms_receipt_handler, {}, 'api-sms-receipt'),
+    url(r'^sms/job\.(?P<emitter_format>.+)$', sms_job_handler, {}, 'api-sms-job'),
+    url(r'^sms/job/(?P<job_id>[0-9]+)\.(?P<emitter_format>.+)$', sms_job_handler, {}, 'api-sms-job'),
     url(r'^sms/(?P<identifier>.+)/(?P<msisdn>[0-9]+)\.(?P<emitter_format>.+)$', sms_handler, {}, 'api-sms'),
     url(r'^sms\.(?P<emitter_format>.+)$', sms_handler, {}, 'api-sms'),
     url(r'^patient\.(?P<emitter_format>.+)$', patient_handler, {}, 'api-patient'),
@@ -8,7 +8,8 @@ from django.core.paginator import Paginator
 from django.db.models import Q
 from txtalert.apps.bookings.bookings_admin import forms
 from txtalert.apps.bookings.views import effective_page_range_for
-from txtalert.core.models import Patient, Visit, ChangeRequest, PleaseCallMe
+from txtalert.core.models import Patient, Visit, ChangeRequest, PleaseCallMe, \
+                                    VisitStatistics
 from txtalert.core.utils import normalize_msisdn
 import logging
 from datetime import datetime, date, timedelta
@@ -212,15 +213,7 @@ def view_patient(request):
 @permission_required(LOGIN_PERMISSION, login_url=LOGIN_URL)
 def edit_patient(request, patient_id):
     patient = get_object_or_404(Patient, pk=patient_id)
-    visits = patient.visit_set.all()
-    attended = visits.filter(status='a').count()
-    missed = visits.filter(status='m').count()
-    rescheduled = visits.filter(status='r').count()
-    total = visits.filter(date__lt=date.today()).count()
-    if attended > 0:
-        attendance = int(float(attended) / float(total) * 100)
-    else: 
-        attendance = 0
+    statistics = VisitStatistics.objects.for_patient(patient)
     
     if request.POST:
         form = forms.PatientForm(request.POST, instance=patient)
@@ -237,11 +230,11 @@ def edit_patient(request, patient_id):
     return render_to_response('bookings_admin/patient/view.html', {
         'patient': patient,
         'form': form,
-        'attendance': attendance,
-        'attended': attended,
-        'rescheduled': rescheduled,
-        'missed': missed,
-        'total': total,
+        'attendance': statistics.attendance,
+        'attended': statistics.attended,
+        'rescheduled': statistics.rescheduled,
+        'missed': statistics.missed,
+        'total': statistics.past_visits,
     }, context_instance=RequestContext(request))
 
 @permission_required(LOGIN_PERMISSION, login_url=LOGIN_URL)
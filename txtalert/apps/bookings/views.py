@@ -6,10 +6,11 @@ from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator
 import logging
-from txtalert.core.models import Visit, PleaseCallMe, MSISDN, AuthProfile, Patient
+from txtalert.core.models import Visit, PleaseCallMe, MSISDN, AuthProfile, Patient, \
+                                    VisitStatistics
 from txtalert.core.forms import RequestCallForm
 from txtalert.core.utils import normalize_msisdn
-from datetime import date, datetime
+from datetime import datetime
 from functools import wraps
 
 def effective_page_range_for(page,paginator,delta=3):
@@ -90,21 +91,14 @@ def appointment_history(request):
 def attendance_barometer(request):
     profile = request.user.get_profile()
     patient = profile.patient
-    visits = patient.visit_set.all()
-    attended = visits.filter(status='a').count()
-    missed = visits.filter(status='m').count()
-    total = visits.filter(date__lt=date.today()).count()
-    if total:
-        attendance = int(float(attended) / float(total) * 100)
-    else:
-        attendance = 0.0
+    statistics = VisitStatistics.objects.for_patient(patient)
     return render_to_response("attendance_barometer.html", {
         'profile': profile,
         'patient': patient,
-        'attendance': attendance,
-        'attended': attended,
-        'missed': missed,
-        'total': total
+        'attendance': statistics.attendance,
+        'attended': statistics.attended,
+        'missed': statistics.missed,
+        'total': statistics.past_visits,
     }, context_instance=RequestContext(request))
 
 def request_call(request):
@@ -150,12 +144,7 @@ def widget_landing(request):
             patient_id = request.GET.get('patient_id')
             patient = Patient.objects.get(active_msisdn__msisdn=msisdn,
                                             te_id=patient_id)
-            try:
-                visit = patient.next_visit()
-            except Visit.DoesNotExist:
-                visit = None
-            
-            visits = patient.visit_set.all()
+            statistics = VisitStatistics.objects.for_patient(patient)
             
             context = {
                 'msisdn': msisdn,
@@ -163,14 +152,15 @@ def widget_landing(request):
                 'patient': patient,
                 'name': patient.name,
                 'surname': patient.surname,
-                'next_appointment': visit.date if visit else '',
-                'visit_id': visit.pk if visit else '',
-                'clinic': visit.clinic.name if visit else '',
+                'next_appointment': statistics.next_visit_date or '',
+                'visit_id': statistics.next_visit_id or '',
+                'clinic': statistics.next_visit_clinic.name 
+                            if statistics.next_visit_clinic else '',
                 'attendance': int((1.0 - patient.risk_profile) * 100),
-                'total': visits.count(),
-                'attended': visits.filter(status='a').count(),
-                'rescheduled': visits.filter(status='r').count(),
-                'missed': visits.filter(status='m').count(),
+                'total': statistics.visits,
+                'attended': statistics.attended,
+                'rescheduled': statistics.rescheduled,
+                'missed': statistics.missed,
             }
         except Patient.DoesNotExist:
             context = {
@@ -14,6 +14,10 @@ class Gateway(object):
     def send_sms(self, *args, **kwargs):
         return self.send_bulk_sms(*args, **kwargs)
     
+    def submit(self, msisdn, smstext):
+        """Pretend to submit an SMS, returns a random identifier"""
+        return random_string()[:8]
+    
     def send_one_sms(self, user, msisdn, smstext, delivery=None, expiry=None,
                         priority='standard', receipt='Y'):
         delivery = delivery or datetime.now()
@@ -26,7 +30,7 @@ class Gateway(object):
                                         expiry=expiry, 
                                         priority=priority, 
                                         receipt=receipt, 
-                                        identifier=random_string()[:8])
+                                        identifier=self.submit(msisdn, smstext))
         print sms
         return sms
     
@@ -23,9 +23,14 @@ class Gateway(object):
         return SendSMS.objects.filter(pk__in=send_sms_ids)
         
     
-    def send_one_sms(self, user, msisdn, smstext, delivery=None, expiry=None, \
+    def submit(self, msisdn, smstext, delivery=None, expiry=None, \
+                        priority='standard', receipt='Y'):
+        """Submit one sms to Opera, returns the identifier assigned by Opera"""
+        return self.send_struct(msisdn, smstext, delivery, expiry, priority, 
+                                    receipt)[1]['Identifier']
+    
+    def send_struct(self, msisdn, smstext, delivery=None, expiry=None, \
                         priority='standard', receipt='Y'):
-        """Send one sms"""
         struct = self.default_values.copy()
         delivery = delivery or datetime.utcnow()
         expiry = expiry or (delivery + timedelta(days=1))
@@ -37,7 +42,13 @@ class Gateway(object):
         struct['Priority'] = priority
         struct['Receipt'] = receipt
         
-        proxy_response = self.proxy.EAPIGateway.SendSMS(struct)
+        return struct, self.proxy.EAPIGateway.SendSMS(struct)
+    
+    def send_one_sms(self, user, msisdn, smstext, delivery=None, expiry=None, \
+                        priority='standard', receipt='Y'):
+        """Send one sms"""
+        struct, proxy_response = self.send_struct(msisdn, smstext, delivery, 
+                                                expiry, priority, receipt)
         
         return SendSMS.objects.create(user=user,
                                         msisdn=msisdn,
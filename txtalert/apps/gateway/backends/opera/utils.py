@@ -4,39 +4,76 @@ from collections import namedtuple
 from datetime import datetime
 import xml.etree.ElementTree as ET
 
+from django.db import transaction
 from txtalert.apps.gateway.models import SendSMS
 import iso8601
 import logging
 
 OPERA_TIMESTAMP_FORMAT = "%Y%m%dT%H:%M:%S"
 
+# the number of identifiers looked up per query
+LOOKUP_CHUNK_SIZE = 500
+
+Receipt = namedtuple('receipt', 
+                ['msgid', 'reference', 'msisdn', 'status', 'timestamp', 'billed'])
+
+def element_to_receipt(element):
+    """Turn a <receipt> element into a Receipt"""
+    return Receipt._make([element.findtext(field) for field in Receipt._fields])
+
 def process_receipts_xml(receipt_xml_data):
     tree = ET.fromstring(receipt_xml_data)
-    receipts = map(element_to_namedtuple, tree.findall('receipt'))
+    receipts = map(element_to_receipt, tree.findall('receipt'))
     return process_receipts(receipts)
     
 
+def find_send_smses(receipts):
+    """Find the SendSMSs for the receipts with one query per 
+    LOOKUP_CHUNK_SIZE receipts. Returns a dict of SendSMS pks keyed by 
+    (identifier, msisdn)"""
+    identifiers = list(set([receipt.reference for receipt in receipts]))
+    send_smses = {}
+    for offset in range(0, len(identifiers), LOOKUP_CHUNK_SIZE):
+        for pk, identifier, msisdn in SendSMS.objects.filter(
+                identifier__in=identifiers[offset:offset + LOOKUP_CHUNK_SIZE]
+                ).values_list('pk', 'identifier', 'msisdn'):
+            send_smses.setdefault((identifier, msisdn), []).append(pk)
+    return send_smses
+
+@transaction.commit_on_success
 def process_receipts(receipts):
     """Deal with the list of receipt objects, find & updated associated SendSMSs 
     or mark them as failed.
     
     Returns a tuple of two lists, successful receipts & failed receipts.
     """
+    send_smses = find_send_smses(receipts)
     success, fail = [], []
+    # the latest receipt for a SendSMS wins
+    updates = {}
     for receipt in receipts:
-        try:
-            # internally we store MSISDNs without a leading plus, strip that
-            # from the msisdn
-            sms_sent = SendSMS.objects.get(identifier=receipt.reference, \
-                                        msisdn=receipt.msisdn.replace("+",""))
-            sms_sent.status = receipt.status
-            sms_sent.delivery_timestamp = datetime.strptime(receipt.timestamp, \
-                                                        OPERA_TIMESTAMP_FORMAT)
-            sms_sent.save()
-            success.append(receipt)
-        except SendSMS.DoesNotExist, error:
-            logging.info(error)
+        # internally we store MSISDNs without a leading plus, strip that
+        # from the msisdn
+        pks = send_smses.get((receipt.reference, 
+                                receipt.msisdn.replace("+","")))
+        if not pks:
+            logging.info('SendSMS matching query does not exist for %s' % (
+                            receipt,))
             fail.append(receipt)
+            continue
+        delivery_timestamp = datetime.strptime(receipt.timestamp, \
+                                                    OPERA_TIMESTAMP_FORMAT)
+        for pk in pks:
+            updates[pk] = (receipt.status, delivery_timestamp)
+        success.append(receipt)
+    
+    # one UPDATE per distinct status & timestamp
+    groups = {}
+    for pk, values in updates.items():
+        groups.setdefault(values, []).append(pk)
+    for (status, delivery_timestamp), pks in groups.items():
+        SendSMS.objects.filter(pk__in=pks).update(status=status, 
+                                        delivery_timestamp=delivery_timestamp)
     return success, fail
 
 
@@ -52,6 +89,9 @@ def element_to_dict(element):
     """
     return dict([(child.tag, child.text) for child in element.getchildren()])
 
+# cache for the generated classes
+NAMEDTUPLE_CACHE = {}
+
 def element_to_namedtuple(element):
     """
     Turn an ElementTree element into an object with named params. Not recursive!
@@ -62,7 +102,9 @@ def element_to_namedtuple(element):
     
     """
     d = element_to_dict(element)
-    klass = namedtuple(element.tag, d.keys())
-    return klass._make(d.values())
+    key = (element.tag, tuple(d.keys()))
+    if key not in NAMEDTUPLE_CACHE:
+        NAMEDTUPLE_CACHE[key] = namedtuple(element.tag, d.keys())
+    return NAMEDTUPLE_CACHE[key]._make(d.values())
 
 
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.http import Http404
+from django.utils.importlib import import_module
+from txtalert.apps.gateway import outbox
+
+class Gateway(object):
+    """Gateway that stores messages in the outbound queue instead of 
+    submitting them, the `send_queued_sms` command hands them to the gateway
+    specified in settings.SMS_QUEUE_BACKEND"""
+    
+    def send_sms(self, user, msisdns, smstexts, *args, **kwargs):
+        return outbox.enqueue(user, msisdns, smstexts, *args, **kwargs)
+    
+    def send_bulk_sms(self, *args, **kwargs):
+        return self.send_sms(*args, **kwargs)
+    
+    def send_one_sms(self, user, msisdn, smstext, *args, **kwargs):
+        return self.send_sms(user, [msisdn], [smstext], *args, **kwargs)[0]
+    
+
+gateway = Gateway()
+
+def sms_receipt_handler(request, *args, **kwargs):
+    """Receipts are for messages submitted by the upstream gateway"""
+    backend = import_module('.backend', settings.SMS_QUEUE_BACKEND)
+    handler = getattr(backend, 'sms_receipt_handler', None)
+    if handler is None:
+        raise Http404
+    return handler(request, *args, **kwargs)
@@ -1,18 +1,56 @@
 from vumiclient.client import Client
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
 from txtalert.apps.gateway.models import SendSMS
+from txtalert.apps.gateway.receipts import log_receipt
+import threading
+import logging
+
+logger = logging.getLogger("gateway")
 
 class Gateway(object):
     
-    def __init__(self, username, password):
-        self.client = Client(username, password)
+    def __init__(self, username, password, concurrency=8):
+        self.username = username
+        self.password = password
+        # the maximum number of submissions in flight at any time
+        self.concurrency = concurrency
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.threads = None
     
-    def send_one_sms(self, user, msisdn, smstext):
+    @property
+    def pool(self):
+        """The threads submitting the messages. The pool is kept for as long
+        as the gateway is so the threads, and with them their clients'
+        connections, are reused by every call to `send_sms`."""
+        self.lock.acquire()
+        try:
+            if self.threads is None:
+                self.threads = ThreadPool(self.concurrency)
+            return self.threads
+        finally:
+            self.lock.release()
+    
+    @property
+    def client(self):
+        """Every thread gets its own client which it keeps using for all of
+        the messages it submits"""
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client(self.username, self.password)
+        return self.local.client
+    
+    def submit(self, msisdn, smstext):
+        """Submit an SMS to Vumi, returns the identifier assigned by Vumi"""
         resp = self.client.send_sms(to_msisdn=msisdn, from_msisdn='0',
                     message=smstext).pop()
+        return str(resp.id)
+    
+    def create_send_sms(self, user, msisdn, smstext, identifier):
         send_sms = SendSMS()
         send_sms.user = user
         send_sms.msisdn = msisdn
@@ -21,27 +59,63 @@ class Gateway(object):
         send_sms.expiry = datetime.now() + timedelta(days=1)
         send_sms.priority = 'standard'
         send_sms.receipt = 'Y'
-        send_sms.identifier = str(resp.id)
+        send_sms.identifier = identifier
+        return send_sms
+    
+    def send_one_sms(self, user, msisdn, smstext):
+        send_sms = self.create_send_sms(user, msisdn, smstext, 
+                                        self.submit(msisdn, smstext))
         send_sms.save()
         return send_sms
-
+    
+    def try_submit(self, message):
+        msisdn, smstext = message
+        try:
+            return self.submit(msisdn, smstext), None
+        except Exception, e:
+            logger.exception('Failed to submit SMS to %s' % msisdn)
+            return None, e
+    
+    @transaction.commit_on_success
+    def save_all(self, send_smses):
+        for send_sms in send_smses:
+            send_sms.save()
+        return send_smses
+    
     def send_sms(self, user, msisdns, smstexts):
-        responses = []
-        for msisdn, smstext in zip(msisdns, smstexts):
-            send_sms = self.send_one_sms(user, msisdn, smstext)
-            responses.append(send_sms.pk)
-        return SendSMS.objects.filter(pk__in=responses)
+        """Submit the messages to Vumi with at most `concurrency` requests in
+        flight. The SendSMS records of the messages that were accepted are
+        written in one transaction and returned.
+        
+        A failed submission doesn't stop the other messages from being
+        submitted, they're all tried. Once the accepted ones have been
+        recorded the first error is raised."""
+        messages = zip(msisdns, smstexts)
+        if not messages:
+            return []
+        results = self.pool.map(self.try_submit, messages)
+        
+        send_smses = self.save_all([
+            self.create_send_sms(user, msisdn, smstext, identifier)
+            for (msisdn, smstext), (identifier, exception) 
+                in zip(messages, results) if exception is None])
+        
+        exceptions = [exception for identifier, exception in results 
+                        if exception is not None]
+        if exceptions:
+            raise exceptions[0]
+        return send_smses
 
-gateway = Gateway(settings.VUMI_USERNAME, settings.VUMI_PASSWORD)
+gateway = Gateway(settings.VUMI_USERNAME, settings.VUMI_PASSWORD, 
+                    getattr(settings, 'VUMI_CONCURRENCY', 8))
 
 def sms_receipt_handler(request, *args, **kwargs):
-    try:
-        send_sms = SendSMS.objects.get(identifier=request.POST.get('id'))
-        send_sms.status = request.POST.get('transport_status')
-        send_sms.delivery_timestamp = request.POST.get('delivered_at')
-        send_sms.save()
-        return HttpResponse("ok", status=201)
-    except SendSMS.DoesNotExist, e:
-        print 'Cannot find SendSMS for id', request.POST.get('id')
-        print request.POST
+    """Receipts are logged and acknowledged immediately, they're applied to
+    their SendSMS by the `apply_sms_receipts` management command."""
+    identifier = request.POST.get('id')
+    if not identifier:
+        logger.warning('Receipt without an id: %s' % request.POST)
         return HttpResponse("accepted", status=202)
+    log_receipt(identifier, request.POST.get('transport_status'),
+                request.POST.get('delivered_at'))
+    return HttpResponse("accepted", status=202)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from txtalert.apps.gateway import receipts
+import time
+
+class Command(BaseCommand):
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', dest='batch', type='int', 
+            default=receipts.RECEIPT_BATCH_SIZE,
+            help='Number of receipts applied per transaction.'),
+        make_option('--park-days', dest='park_days', type='int', default=7,
+            help='Drop receipts without a matching SendSMS after this many '
+                    'days.'),
+        make_option('--loop', dest='loop', action='store_true', 
+            default=False, help='Keep applying receipts as they come in '
+                                'instead of exiting.'),
+        make_option('--interval', dest='interval', type='int', default=5,
+            help='Seconds to sleep between runs.'),
+    )
+    help = "Applies the logged delivery receipts to their SendSMS records."
+    
+    def handle(self, *args, **options):
+        while True:
+            applied, parked, dropped = receipts.apply_receipts(
+                batch_size=options['batch'], park_days=options['park_days'])
+            if applied or dropped or not options['loop']:
+                print 'Applied %s, parked %s, dropped %s' % (applied, parked,
+                                                                dropped)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from optparse import make_option
+from txtalert.apps.gateway import outbox
+import time
+
+class Command(BaseCommand):
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--gateway', dest='gateway', 
+            default=getattr(settings, 'SMS_QUEUE_BACKEND', None),
+            help='Specifies the gateway to submit the messages to, defaults '
+                    'to settings.SMS_QUEUE_BACKEND.'),
+        make_option('--concurrency', dest='concurrency', type='int', 
+            default=4, help='Number of messages submitted concurrently.'),
+        make_option('--rate', dest='rate', type='float', default=0,
+            help='Maximum number of messages submitted per second, '
+                    '0 means no limit.'),
+        make_option('--batch', dest='batch', type='int', default=100,
+            help='Number of messages claimed from the queue at a time.'),
+        make_option('--max-attempts', dest='max_attempts', type='int', 
+            default=5, help='Give up on a message after this many attempts.'),
+        make_option('--backoff', dest='backoff', type='int', default=60,
+            help='Seconds to wait before retrying a message, doubled after '
+                    'every failed attempt.'),
+        make_option('--loop', dest='loop', action='store_true', 
+            default=False, help='Keep polling the queue instead of exiting '
+                                'once it is empty.'),
+        make_option('--interval', dest='interval', type='int', default=5,
+            help='Seconds to sleep between polls of an empty queue.'),
+    )
+    help = "Submits the messages in the outbound SMS queue, run as many as " \
+            "needed to drain the queue."
+    
+    def handle(self, *args, **options):
+        worker = outbox.Worker(
+            outbox.load_upstream_gateway(options['gateway']),
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            max_attempts=options['max_attempts'],
+            backoff=options['backoff'])
+        while True:
+            sent, failed = worker.run_once(options['batch'])
+            if sent or failed:
+                print 'Sent %s, failed %s' % (sent, failed)
+            elif options['loop']:
+                time.sleep(options['interval'])
+            else:
+                break
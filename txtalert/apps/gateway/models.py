@@ -1,5 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils.encoding import smart_unicode
+from datetime import timedelta
+import hashlib
+import time
 
 # Copied from https://dragon.sa.operatelecom.com:1089/Gateway#Receipt, seems sensible to keep for now
 RECEIPT_STATUS_CHOICES = (
@@ -30,6 +34,17 @@ RECEIPT_STATUS_CHOICES = (
     ('A', 'Billing unknown'), # network operator or aggregator failed to acknowledge a billing attempt, so the billing operation may have taken place but probably has not. The customer should not be re-billed without checking with them to see if the network operator has billed them.
 )
 
+# the states of messages in the outbound queue, see outbox. These are kept
+# apart from the receipt statuses so a receipt can never put a message back
+# in the queue.
+QUEUE_STATUS_CHOICES = (
+    ('q', 'Queued for submission'),
+    ('p', 'Being submitted'),
+    ('s', 'Submission retrying'),
+    ('f', 'Submission failed'),
+    ('x', 'Submission expired'),
+)
+
 class SendSMS(models.Model):
     """A local storage of SMS's sent via the SendSMS API, need to keep 
     track of these to be able to process the receipts we receive asynchronously
@@ -52,13 +67,26 @@ class SendSMS(models.Model):
     user = models.ForeignKey(User)
     msisdn = models.CharField(max_length=12)
     smstext = models.TextField()
-    delivery = models.DateTimeField()
+    delivery = models.DateTimeField(db_index=True)
     expiry = models.DateTimeField()
     priority = models.CharField(max_length=80, choices=PRIORITY_CHOICES)
     receipt = models.CharField(max_length=1, choices=RECEIPT_CHOICES)
     identifier = models.CharField(blank=False, max_length=8)
-    status = models.CharField(max_length=1, default='v', choices=RECEIPT_STATUS_CHOICES)
+    status = models.CharField(max_length=1, default='v', 
+                    choices=RECEIPT_STATUS_CHOICES + QUEUE_STATUS_CHOICES)
     delivery_timestamp = models.DateTimeField(null=True)
+    # the kind of reminder this is, if it is one
+    message_type = models.ForeignKey('core.MessageType', null=True, 
+                                        blank=True)
+    
+    # the bulk submission this message is part of, if any
+    job = models.ForeignKey('SMSJob', null=True, blank=True, 
+                                related_name='messages')
+    
+    # bookkeeping for the outbound queue, see txtalert.apps.gateway.outbox
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
     
     class Meta:
         permissions = (
@@ -73,6 +101,39 @@ class SendSMS(models.Model):
             self.smstext)
 
 
+class SMSJob(models.Model):
+    """A bulk submission of messages through the API, the messages are 
+    queued in the outbound queue and sent by the `send_queued_sms` 
+    command."""
+    user = models.ForeignKey(User)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __unicode__(self):
+        return u"SMSJob: %s" % self.pk
+    
+    def status_counts(self):
+        """Returns a dict of status -> the number of messages with it"""
+        return dict(self.messages.order_by().values_list('status')
+                                    .annotate(models.Count('id')))
+
+
+class SMSReceipt(models.Model):
+    """A delivery receipt as received from the gateway. Receipts are logged
+    here when they come in and are applied to their SendSMS in batches by
+    the `apply_sms_receipts` command. Receipts for which no SendSMS can be
+    found (yet) are kept around and retried."""
+    identifier = models.CharField(max_length=80, db_index=True)
+    status = models.CharField(max_length=1, choices=RECEIPT_STATUS_CHOICES)
+    delivery_timestamp = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['id']
+    
+    def __unicode__(self):
+        return u"SMSReceipt: %s - %s" % (self.identifier, self.status)
+
+
 class PleaseCallMe(models.Model):
     """A please call me we receive from a patient"""
     user = models.ForeignKey(User, related_name='gateway_pleasecallme_set')
@@ -80,7 +141,14 @@ class PleaseCallMe(models.Model):
     sender_msisdn = models.CharField(max_length=255)
     recipient_msisdn = models.CharField(max_length=255)
     message = models.TextField(blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # hash of the sender, the message & the period it was received in, set
+    # by the API to keep out duplicate submissions
+    dedupe_key = models.CharField(max_length=40, unique=True, null=True,
+                                    blank=True)
+    
+    # PCMs with the same sender & message within this window are duplicates
+    DEDUPE_WINDOW = timedelta(hours=2)
     
     class Meta:
         ordering = ['created_at']
@@ -92,4 +160,18 @@ class PleaseCallMe(models.Model):
 
     def __unicode__(self):
         return u"PleaseCallMe: %s" % self.sender_msisdn
+    
+    @classmethod
+    def dedupe_keys_for(cls, sender_msisdn, message, when):
+        """The dedupe key of a PCM received at `when`, followed by the key
+        it would have had in the previous period. The periods are
+        DEDUPE_WINDOW long, a PCM is a duplicate if one with either key was
+        received within DEDUPE_WINDOW before it."""
+        window = cls.DEDUPE_WINDOW.days * 24 * 60 * 60 + \
+                    cls.DEDUPE_WINDOW.seconds
+        period = int(time.mktime(when.timetuple())) // window
+        content = u'%s:%s' % (smart_unicode(sender_msisdn, errors='replace'),
+                                smart_unicode(message, errors='replace'))
+        return [hashlib.sha1((u'%s:%s' % (content, p)).encode('utf-8'))
+                    .hexdigest() for p in (period, period - 1)]
 
@@ -0,0 +1,184 @@
+"""
+A database backed queue for outbound SMSs. Messages are stored as SendSMS
+records with a status of Queued and without an identifier and are handed to
+the upstream gateway by the `send_queued_sms` management command.
+
+    q (Queued)   waiting to be picked up by a worker
+    p (Progress) claimed by a worker, `next_attempt` is when the claim expires
+    s (Retrying) submission failed, will be retried at `next_attempt`
+    f (Failed)   gave up after `max_attempts`
+    x (Expired)  the message expired before it could be submitted
+
+These are not receipt statuses, see QUEUE_STATUS_CHOICES. Once submitted
+the record gets the identifier from the upstream gateway and the status the
+upstream gateway would have given it, from there on receipts are handled as
+usual. Only records without an identifier are ever taken from the queue.
+"""
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.importlib import import_module
+from txtalert.apps.gateway.models import SendSMS
+import threading
+import math
+import time
+import logging
+
+logger = logging.getLogger("gateway")
+
+QUEUED, IN_PROGRESS, UNSENT, FAILED, EXPIRED = 'q', 'p', 's', 'f', 'x'
+
+# the status given to SendSMS records after being submitted upstream
+SUBMITTED = SendSMS._meta.get_field('status').default
+
+
+def load_upstream_gateway(backend=None):
+    """The gateway that actually submits the queued messages"""
+    backend = backend or settings.SMS_QUEUE_BACKEND
+    return import_module('.backend', backend).gateway
+
+def message_parts(smstext):
+    """The number of SMSs the message is sent as. Messages that don't fit in
+    a single SMS are sent as a concatenated SMS, each part of which loses
+    some room to the concatenation header. Anything outside of ASCII is
+    counted as being sent as UCS-2."""
+    try:
+        smstext.encode('ascii')
+        single, part = 160, 153
+    except UnicodeError:
+        single, part = 70, 67
+    if len(smstext) <= single:
+        return 1
+    return int(math.ceil(len(smstext) / float(part)))
+
+@transaction.commit_on_success
+def enqueue(user, msisdns, smstexts, delivery=None, expiry=None,
+                priority='standard', receipt='Y', job=None):
+    """Queue messages for sending, returns the list of SendSMS records"""
+    delivery = delivery or datetime.now()
+    expiry = expiry or (delivery + timedelta(days=1))
+    return [SendSMS.objects.create(user=user, msisdn=msisdn, smstext=smstext,
+                delivery=delivery, expiry=expiry, priority=priority,
+                receipt=receipt, identifier='', status=QUEUED, job=job)
+            for msisdn, smstext in zip(msisdns, smstexts)]
+
+def requeue_stale():
+    """Put messages claimed by workers that went away back in the queue"""
+    return SendSMS.objects.filter(status=IN_PROGRESS, identifier='',
+        next_attempt__lt=datetime.now()).update(status=QUEUED)
+
+def expire():
+    return SendSMS.objects.filter(status__in=(QUEUED, UNSENT), identifier='',
+        expiry__lt=datetime.now()).update(status=EXPIRED)
+
+def claim(limit, lease=300):
+    """Claim up to `limit` messages that are due for sending. A message is
+    claimed for `lease` seconds, if it hasn't been submitted by then it is
+    put back in the queue by `requeue_stale`. Claiming is done with an
+    UPDATE on the message's status so multiple workers can safely drain
+    the same queue."""
+    now = datetime.now()
+    candidates = SendSMS.objects.filter(
+        Q(next_attempt__isnull=True) | Q(next_attempt__lte=now),
+        status__in=(QUEUED, UNSENT),
+        identifier='',
+        delivery__lte=now,
+    ).order_by('id').values_list('pk', 'status')[:limit]
+    claimed = [pk for pk, status in candidates
+                if SendSMS.objects.filter(pk=pk, status=status,
+                                            identifier='').update(
+                    status=IN_PROGRESS,
+                    next_attempt=now + timedelta(seconds=lease)) == 1]
+    return list(SendSMS.objects.filter(pk__in=claimed).order_by('id'))
+
+
+class RateLimiter(object):
+    """Spaces out calls to `wait` to at most `rate` per second across all
+    threads, a rate of 0 means no limit."""
+
+    def __init__(self, rate=0):
+        self.interval = rate and 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+
+    def wait(self):
+        if not self.interval:
+            return
+        self.lock.acquire()
+        try:
+            now = time.time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Worker(object):
+    """Submits claimed messages to the upstream gateway from a pool of
+    threads. The threads only talk to the upstream gateway, the results
+    are written to the database from the calling thread."""
+
+    def __init__(self, gateway, concurrency=4, rate=0, max_attempts=5,
+                    backoff=60, lease=300):
+        self.gateway = gateway
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+
+    def submit(self, send_sms):
+        self.limiter.wait()
+        try:
+            return send_sms, self.gateway.submit(send_sms.msisdn,
+                                                    send_sms.smstext), None
+        except Exception, e:
+            logger.exception('Failed to submit SendSMS %s' % send_sms.pk)
+            return send_sms, None, e
+
+    def retry_delay(self, attempts):
+        """exponential backoff, `backoff` seconds after the first failure,
+        doubling after every subsequent one"""
+        return timedelta(seconds=self.backoff * (2 ** (attempts - 1)))
+
+    @transaction.commit_on_success
+    def record(self, results):
+        now = datetime.now()
+        sent = failed = 0
+        for send_sms, identifier, exception in results:
+            attempts = send_sms.attempts + 1
+            if exception is None:
+                SendSMS.objects.filter(pk=send_sms.pk).update(
+                    identifier=identifier, status=SUBMITTED,
+                    attempts=attempts, next_attempt=None, last_error='')
+                sent += 1
+            else:
+                if attempts >= self.max_attempts:
+                    status, next_attempt = FAILED, None
+                else:
+                    status = UNSENT
+                    next_attempt = now + self.retry_delay(attempts)
+                SendSMS.objects.filter(pk=send_sms.pk).update(status=status,
+                    attempts=attempts, next_attempt=next_attempt,
+                    last_error=repr(exception))
+                failed += 1
+        return sent, failed
+
+    def run_once(self, limit=100):
+        """Drain one batch of the queue, returns a tuple with the number of
+        messages sent and failed."""
+        requeue_stale()
+        expire()
+        send_smses = claim(limit, self.lease)
+        if not send_smses:
+            return 0, 0
+        pool = ThreadPool(min(self.concurrency, len(send_smses)))
+        try:
+            results = pool.map(self.submit, send_smses)
+        finally:
+            pool.terminate()
+        return self.record(results)
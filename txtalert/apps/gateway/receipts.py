@@ -0,0 +1,80 @@
+"""
+Delivery receipts are logged as SMSReceipt records when they arrive so the
+receipt handler can acknowledge them straight away. The `apply_sms_receipts`
+management command applies them to their SendSMS records in batches.
+
+Receipts can arrive before the SendSMS they refer to has been saved with
+its identifier, those are kept and retried on later runs until they are
+older than `park_days`.
+"""
+from datetime import datetime, timedelta
+from django.db import transaction
+from txtalert.apps.gateway.models import SendSMS, SMSReceipt
+import logging
+
+logger = logging.getLogger("gateway")
+
+RECEIPT_BATCH_SIZE = 500
+
+
+def log_receipt(identifier, status, delivery_timestamp=None):
+    return SMSReceipt.objects.create(identifier=identifier, status=status,
+                                        delivery_timestamp=delivery_timestamp)
+
+@transaction.commit_on_success
+def apply_batch(receipts):
+    """Apply a batch of receipts, returns a tuple with the pks of the
+    receipts that were applied and of those that were not matched."""
+    # queued messages have no identifier yet, receipts without one can't
+    # be for any of them
+    identifiers = set([receipt.identifier for receipt in receipts
+                        if receipt.identifier])
+    send_sms_pks = {}
+    for pk, identifier in SendSMS.objects.filter(
+            identifier__in=identifiers).values_list('pk', 'identifier'):
+        send_sms_pks.setdefault(identifier, []).append(pk)
+
+    # receipts are in order of arrival, the last one for an identifier wins
+    latest = {}
+    applied, unmatched = [], []
+    for receipt in receipts:
+        if receipt.identifier in send_sms_pks:
+            latest[receipt.identifier] = receipt
+            applied.append(receipt.pk)
+        else:
+            unmatched.append(receipt.pk)
+
+    grouped = {}
+    for identifier, receipt in latest.items():
+        key = (receipt.status, receipt.delivery_timestamp)
+        grouped.setdefault(key, []).extend(send_sms_pks[identifier])
+    for (status, delivery_timestamp), pks in grouped.items():
+        SendSMS.objects.filter(pk__in=pks).update(status=status,
+                                        delivery_timestamp=delivery_timestamp)
+
+    SMSReceipt.objects.filter(pk__in=applied).delete()
+    return applied, unmatched
+
+def apply_receipts(batch_size=RECEIPT_BATCH_SIZE, park_days=7):
+    """Apply all logged receipts, returns a tuple with the number of
+    receipts applied, left for a later run and dropped."""
+    applied = parked = 0
+    last_pk = 0
+    while True:
+        receipts = list(SMSReceipt.objects.filter(pk__gt=last_pk)
+                                            .order_by('id')[:batch_size])
+        if not receipts:
+            break
+        last_pk = receipts[-1].pk
+        batch_applied, batch_unmatched = apply_batch(receipts)
+        applied += len(batch_applied)
+        parked += len(batch_unmatched)
+
+    stale = SMSReceipt.objects.filter(
+        created_at__lt=datetime.now() - timedelta(days=park_days))
+    dropped = stale.count()
+    if dropped:
+        logger.warning('Dropping %s receipts without a matching SendSMS' %
+                        dropped)
+        stale.delete()
+    return applied, parked - dropped, dropped
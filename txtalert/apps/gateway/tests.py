@@ -1,8 +1,14 @@
 from django.test import TestCase
 from txtalert.apps.gateway.backends.dummy import backend
 from txtalert.apps import gateway
+from txtalert.apps.gateway import outbox, receipts
 from txtalert.apps.gateway.models import *
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import namedtuple
+import threading
+import time
+
+Response = namedtuple('Response', 'id')
 
 class GatewayLoadingTestCase(TestCase):
     
@@ -47,4 +53,198 @@ class GatewayModelTestCase(TestCase):
             u'PleaseCallMe: 27123456789',
             unicode(pcm)
         )
-    
\ No newline at end of file
+    
+
+class FailingGateway(object):
+    def submit(self, msisdn, smstext):
+        raise IOError('upstream unavailable')
+
+
+class FakeVumiClient(object):
+    """Stands in for vumiclient's Client, records the number of clients and
+    the most submissions it has seen in flight at once"""
+    lock = threading.Lock()
+    clients = 0
+    in_flight = 0
+    most_in_flight = 0
+    
+    def __init__(self, username, password):
+        FakeVumiClient.lock.acquire()
+        FakeVumiClient.clients += 1
+        FakeVumiClient.lock.release()
+    
+    def send_sms(self, to_msisdn, from_msisdn, message):
+        FakeVumiClient.lock.acquire()
+        FakeVumiClient.in_flight += 1
+        FakeVumiClient.most_in_flight = max(FakeVumiClient.most_in_flight,
+                                            FakeVumiClient.in_flight)
+        FakeVumiClient.lock.release()
+        try:
+            time.sleep(0.05)
+            if message == 'fail':
+                raise IOError('upstream unavailable')
+            return [Response(id='vumi-%s' % to_msisdn)]
+        finally:
+            FakeVumiClient.lock.acquire()
+            FakeVumiClient.in_flight -= 1
+            FakeVumiClient.lock.release()
+
+
+class VumiGatewayTestCase(TestCase):
+    
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from txtalert.apps.gateway.backends.vumi import backend as vumi
+        self.vumi = vumi
+        self.client_class = vumi.Client
+        vumi.Client = FakeVumiClient
+        FakeVumiClient.clients = FakeVumiClient.most_in_flight = 0
+        self.user = User.objects.create(username='vumi')
+        self.gateway = vumi.Gateway('username', 'password', concurrency=3)
+        self.msisdns = ['2712345678%s' % i for i in range(6)]
+    
+    def tearDown(self):
+        self.vumi.Client = self.client_class
+    
+    def test_concurrent_submission(self):
+        send_smses = self.gateway.send_sms(self.user, self.msisdns, 
+                                            ['hello'] * 6)
+        self.assertEquals([send_sms.identifier for send_sms in send_smses],
+                            ['vumi-%s' % msisdn for msisdn in self.msisdns])
+        self.assertTrue(all([send_sms.pk for send_sms in send_smses]))
+        self.assertEquals(SendSMS.objects.filter(user=self.user).count(), 6)
+        self.assertTrue(1 < FakeVumiClient.most_in_flight <= 3)
+        # the threads and their clients are reused by the next call
+        self.gateway.send_sms(self.user, self.msisdns, ['again'] * 6)
+        self.assertTrue(FakeVumiClient.clients <= 3)
+        self.assertEquals(SendSMS.objects.filter(user=self.user).count(), 12)
+    
+    def test_partial_failure(self):
+        smstexts = ['hello', 'fail', 'hello', 'hello', 'fail', 'hello']
+        self.assertRaises(IOError, self.gateway.send_sms, self.user, 
+                            self.msisdns, smstexts)
+        # the messages that were accepted are still recorded
+        self.assertEquals(sorted(SendSMS.objects.filter(user=self.user) \
+                            .values_list('msisdn', flat=True)),
+                            [msisdn for msisdn, smstext 
+                                in zip(self.msisdns, smstexts) 
+                                if smstext == 'hello'])
+    
+
+class OutboxTestCase(TestCase):
+    
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from txtalert.apps.gateway.backends.queued.backend import Gateway
+        self.user = User.objects.create(username='outbox')
+        self.gateway = Gateway()
+        self.msisdns = ['2712345678%s' % i for i in range(5)]
+    
+    def test_enqueue(self):
+        send_smses = self.gateway.send_sms(self.user, self.msisdns, 
+                                            ['hello'] * len(self.msisdns))
+        self.assertEquals(len(send_smses), len(self.msisdns))
+        self.assertEquals(SendSMS.objects.filter(
+                            status=outbox.QUEUED).count(), len(self.msisdns))
+        send_sms = self.gateway.send_one_sms(self.user, '27123456789', 'hi')
+        self.assertEquals(send_sms.status, outbox.QUEUED)
+    
+    def test_worker(self):
+        self.gateway.send_sms(self.user, self.msisdns, 
+                                ['hello'] * len(self.msisdns))
+        worker = outbox.Worker(backend.gateway, concurrency=2)
+        self.assertEquals(worker.run_once(limit=3), (3, 0))
+        self.assertEquals(worker.run_once(limit=3), (2, 0))
+        self.assertEquals(worker.run_once(limit=3), (0, 0))
+        for send_sms in SendSMS.objects.all():
+            self.assertEquals(send_sms.status, 'v')
+            self.assertEquals(send_sms.attempts, 1)
+            self.assertTrue(send_sms.identifier)
+    
+    def test_retry_with_backoff(self):
+        send_sms = self.gateway.send_one_sms(self.user, '27123456789', 'hi')
+        worker = outbox.Worker(FailingGateway(), max_attempts=2, backoff=60)
+        self.assertEquals(worker.run_once(), (0, 1))
+        send_sms = SendSMS.objects.get(pk=send_sms.pk)
+        self.assertEquals(send_sms.status, outbox.UNSENT)
+        self.assertEquals(send_sms.attempts, 1)
+        self.assertTrue('upstream unavailable' in send_sms.last_error)
+        self.assertTrue(send_sms.next_attempt > datetime.now())
+        # not due yet
+        self.assertEquals(worker.run_once(), (0, 0))
+        
+        SendSMS.objects.update(next_attempt=datetime.now())
+        self.assertEquals(worker.run_once(), (0, 1))
+        send_sms = SendSMS.objects.get(pk=send_sms.pk)
+        self.assertEquals(send_sms.status, outbox.FAILED)
+        self.assertEquals(send_sms.attempts, 2)
+    
+    def test_stale_claims_and_expiry(self):
+        from datetime import timedelta
+        self.gateway.send_sms(self.user, self.msisdns[:2], ['hello'] * 2)
+        claimed = outbox.claim(1, lease=-1)
+        self.assertEquals(len(claimed), 1)
+        self.assertEquals(SendSMS.objects.get(pk=claimed[0].pk).status, 
+                            outbox.IN_PROGRESS)
+        self.assertEquals(outbox.requeue_stale(), 1)
+        
+        SendSMS.objects.update(expiry=datetime.now() - timedelta(minutes=1))
+        self.assertEquals(outbox.expire(), 2)
+        self.assertEquals(outbox.claim(10), [])
+    
+    def test_receipts_dont_requeue(self):
+        # a message sent straight through a gateway, with an upstream 
+        # receipt that uses the same code as the queue once did
+        send_sms = backend.gateway.send_one_sms(self.user, '27123456789', 
+                                                'hi')
+        receipts.log_receipt(send_sms.identifier, 'Q')
+        receipts.log_receipt(send_sms.identifier, 'u')
+        receipts.log_receipt('', 'D')
+        self.assertEquals(receipts.apply_receipts(), (2, 1, 0))
+        self.assertEquals(SendSMS.objects.get(pk=send_sms.pk).status, 'u')
+        # the message isn't put back in the queue
+        self.assertEquals(outbox.claim(10), [])
+        SendSMS.objects.update(expiry=datetime.now() - timedelta(minutes=1))
+        self.assertEquals(outbox.expire(), 0)
+        self.assertEquals(SendSMS.objects.get(pk=send_sms.pk).status, 'u')
+
+
+class ReceiptLogTestCase(TestCase):
+    
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.user = User.objects.create(username='receipts')
+        self.send_smses = backend.gateway.send_sms(self.user,
+                                ['27123456780', '27123456781'], ['hi', 'hi'])
+    
+    def test_apply_receipts(self):
+        first, second = self.send_smses
+        receipts.log_receipt(first.identifier, 'a')
+        receipts.log_receipt(first.identifier, 'D', datetime(2011, 1, 1))
+        receipts.log_receipt(second.identifier, 'D', datetime(2011, 1, 2))
+        receipts.log_receipt('unknown', 'D')
+        self.assertEquals(receipts.apply_receipts(batch_size=2), (3, 1, 0))
+        
+        first = SendSMS.objects.get(pk=first.pk)
+        self.assertEquals(first.status, 'D')
+        self.assertEquals(first.delivery_timestamp, datetime(2011, 1, 1))
+        second = SendSMS.objects.get(pk=second.pk)
+        self.assertEquals(second.delivery_timestamp, datetime(2011, 1, 2))
+        # the unmatched receipt is kept for a later run
+        self.assertEquals(SMSReceipt.objects.get().identifier, 'unknown')
+    
+    def test_late_matching(self):
+        receipts.log_receipt('late', 'D')
+        self.assertEquals(receipts.apply_receipts(), (0, 1, 0))
+        send_sms = self.send_smses[0]
+        send_sms.identifier = 'late'
+        send_sms.save()
+        self.assertEquals(receipts.apply_receipts(), (1, 0, 0))
+        self.assertEquals(SendSMS.objects.get(pk=send_sms.pk).status, 'D')
+    
+    def test_drop_stale_receipts(self):
+        receipts.log_receipt('unknown', 'D')
+        SMSReceipt.objects.update(
+            created_at=datetime.now() - timedelta(days=8))
+        self.assertEquals(receipts.apply_receipts(park_days=7), (0, 0, 1))
+        self.assertFalse(SMSReceipt.objects.exists())
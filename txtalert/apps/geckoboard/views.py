@@ -1,81 +1,99 @@
 from django_geckoboard.decorators import number_widget, line_chart, pie_chart, funnel
+from django.conf import settings
+from django.core.cache import cache
 from datetime import datetime, timedelta, date
-from txtalert.core.models import Patient, PleaseCallMe, Visit
-from txtalert.apps.gateway.models import SendSMS
+from functools import wraps
+from txtalert.core import stats
+
+# Geckoboard polls every few minutes, past days are read from the statistics
+# rolled up by `rollup_stats` and today is counted live, see
+# `stats.live_totals`
+CACHE_TIMEOUT = getattr(settings, 'GECKOBOARD_CACHE_TIMEOUT', 60)
+
+def cached(func):
+    """Cache the data returned by the widget for CACHE_TIMEOUT seconds"""
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        key = ':'.join(['geckoboard', func.__name__] + map(str, args) +
+                        ['%s=%s' % item for item in sorted(kwargs.items())])
+        data = cache.get(key)
+        if data is None:
+            data = func(request, *args, **kwargs)
+            cache.set(key, data, CACHE_TIMEOUT)
+        return data
+    return wrapper
+
+def total(totals, metric, key=None):
+    """The total of the metric in the totals returned by
+    `stats.live_totals`, for a single key or all of them"""
+    return sum([value for (total_metric, total_key), value in totals.items()
+                if total_metric == metric and key in (None, total_key)])
+
+def compare_periods(source, metric, days, until, key=None):
+    """The totals of the source's metric for the `days` up to but not
+    including `until` and for the `days` before that"""
+    this_period = until - timedelta(days=days)
+    last_period = this_period - timedelta(days=days)
+    return (
+        total(stats.live_totals(this_period, until, source), metric, key),
+        total(stats.live_totals(last_period, this_period, source), metric,
+                key),
+    )
 
 @number_widget
+@cached
 def patient_count(request):
-    last_week_start = datetime.now() - timedelta(weeks=2)
-    last_week_end = datetime.now() - timedelta(weeks=1)
-    patients = Patient.objects
-    last_week_patients = patients.filter(
-                            created_at__gte=last_week_start,
-                            created_at__lt=last_week_end)
-    this_week_patients = patients.filter(
-                            created_at__gte=last_week_end,
-                        )
-    return (this_week_patients.count(), last_week_patients.count())
+    tomorrow = date.today() + timedelta(days=1)
+    return compare_periods('patients', stats.PATIENTS_CREATED, 7, tomorrow)
 
 
 @number_widget
+@cached
 def smss_sent(request):
-    last_week_start = datetime.now() - timedelta(weeks=2)
-    last_week_end = datetime.now() - timedelta(weeks=1)
-    smss = SendSMS.objects
-    last_week_sms = smss.filter(
-                            delivery__gte=last_week_start,
-                            delivery__lt=last_week_end)
-    this_week_sms = smss.filter(
-                            delivery__gte=last_week_end,
-                        )
-    return (this_week_sms.count(), last_week_sms.count())
+    tomorrow = date.today() + timedelta(days=1)
+    return compare_periods('messages', stats.SMS_SENT, 7, tomorrow)
 
 @number_widget
+@cached
 def pcms_received(request):
-    last_week_start = datetime.now() - timedelta(weeks=2)
-    last_week_end = datetime.now() - timedelta(weeks=1)
-    pcms = PleaseCallMe.objects
-    last_week_pcms = pcms.filter(
-                            timestamp__gte=last_week_start,
-                            timestamp__lt=last_week_end)
-    this_week_pcms = pcms.filter(
-                            timestamp__gte=last_week_end,
-                        )
-    return (this_week_pcms.count(), last_week_pcms.count())
+    tomorrow = date.today() + timedelta(days=1)
+    return compare_periods('pcms', stats.PCMS_RECEIVED, 7, tomorrow)
 
 @pie_chart
+@cached
 def visit_status(request):
-    week_ago = datetime.now() - timedelta(weeks=1)
-    visits = Visit.objects.filter(date__gte=week_ago, date__lt=date.today())
+    today = date.today()
+    totals = stats.live_totals(today - timedelta(weeks=1), today, 'visits')
     return [
-        [visits.filter(status='a').count(), 'Attended', '1D6099'],
-        [visits.filter(status='m').count(), 'Missed', 'FF4359'],
-        [visits.filter(status='s').count(), 'Scheduled', '239953'],
-        [visits.filter(status='r').count(), 'Rescheduled', '992B8B'],
+        [totals.get((stats.VISIT_STATUS, 'a'), 0), 'Attended', '1D6099'],
+        [totals.get((stats.VISIT_STATUS, 'm'), 0), 'Missed', 'FF4359'],
+        [totals.get((stats.VISIT_STATUS, 's'), 0), 'Scheduled', '239953'],
+        [totals.get((stats.VISIT_STATUS, 'r'), 0), 'Rescheduled', '992B8B'],
     ]
 
 @number_widget
+@cached
 def visit_attendance(request, status):
-    last_month = datetime.now() - timedelta(days=60)
-    this_month = datetime.now() - timedelta(days=30)
-    visits = Visit.objects.filter(status=status)
-    last_months_visits = visits.filter(date__gte=last_month, date__lt=this_month).count()
-    this_months_visits = visits.filter(date__gte=this_month, date__lt=datetime.now()).count()
-    return (this_months_visits, last_months_visits)
+    return compare_periods('visits', stats.VISIT_STATUS, 30, date.today(),
+                            status)
 
 @funnel
+@cached
 def smss_sent_breakdown(request):
-    last_month = datetime.now() - timedelta(days=30)
-    messages = SendSMS.objects.filter(delivery__gte=last_month)
+    today = date.today()
+    totals = stats.live_totals(today - timedelta(days=30),
+                                today + timedelta(days=1), 'messages')
+    def message_type(name):
+        return totals.get((stats.SMS_MESSAGE_TYPE, name), 0)
     return {
         "type": "standard",
         "percentage": "show",
         "items": [
-            (messages.count(), "Messages sent"),
-            (messages.filter(smstext__startswith='You missed your visit').count(), "Missed message"),
-            (messages.filter(smstext__startswith="Thank you for attending").count(), "Attended message"),
-            (messages.filter(smstext__startswith="See you at the clinic tomorrow").count(), "Tomorrow reminder"),
-            (messages.filter(smstext__startswith="You have an visit at the clinic on").count(), "Two week reminder")
+            (totals.get((stats.SMS_SENT, ''), 0), "Messages sent"),
+            (message_type('missed_message'), "Missed message"),
+            (message_type('attended_message'), "Attended message"),
+            (message_type('tomorrow_message'), "Tomorrow reminder"),
+            (message_type('twoweeks_message'), "Two week reminder")
         ],
         "sort": True
-    }
\ No newline at end of file
+    }
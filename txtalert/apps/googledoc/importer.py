@@ -1,9 +1,13 @@
 from txtalert.apps.googledoc.reader.spreadsheetReader import SimpleCRUD
-from txtalert.core.models import Patient, MSISDN, Visit, Clinic
+from txtalert.core.models import (Patient, MSISDN, Visit, Clinic,
+                                    ImportWatermark)
+from txtalert.core.signals import deferred_risk_profiles
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db import IntegrityError
+from django.conf import settings
+from django.db import IntegrityError, transaction
 import re
+import hashlib
 import logging
 
 MSISDNS_RE = re.compile(r'^([+]?(0|27)[0-9]{9}/?)+$')
@@ -12,8 +16,10 @@ MSISDN_RE = re.compile(r'^([+?0][0-9]{9}/?)+$')
 FILE_NO = re.compile(r'^[a-zA-Z0-9]+$')
 STATUS_RE = re.compile(r'^[a-zA-Z]+$')
 
-#the amount of time to cache a enrollment status
-CACHE_TIMEOUT = 30
+#the amount of time to keep a snapshot of the enrolled file numbers
+#of a spreadsheet for, 0 downloads them on every import run
+ENROLLMENT_SNAPSHOT_TIMEOUT = getattr(settings,
+                            'GOOGLEDOC_ENROLLMENT_SNAPSHOT_TIMEOUT', 0)
 
 
 class Importer(object):
@@ -32,13 +38,16 @@ class Importer(object):
         self.email = email
         self.password = password
         self.reader = SimpleCRUD(self.email, self.password)
+        #enrolled file numbers by spreadsheet name for this import run
+        self.enrollment = {}
 
-    def import_spread_sheet(self, doc_name, start, until):
+    def import_spread_sheet(self, doc_name, start, until, force=False):
         """
         @arguments:
         doc_name: the name of spreadsheet to import data from.
         start: indicates the date to start import data from.
         until: indicates the date import data function must stop at.
+        force: update the patients even if the worksheet is unchanged.
 
         This reads data from a google spreadsheet.
         If the data to be read from a spreadsheet is from
@@ -47,10 +56,23 @@ class Importer(object):
         two dictionaries. Patient updates are done for each worksheet.
 
         self.month: stores the complete spreadsheet(has worksheets(s))
+
+        A watermark is kept per worksheet, if neither the worksheet's
+        content nor the enrolled file numbers have changed since the
+        previous import it is skipped. If imports were missed the
+        import starts from the day of the last successful import
+        instead of start. A worksheet with rows that failed to update
+        is imported again on the next run.
         """
+        self.doc_name = str(doc_name)
+        #download the enrolled file numbers afresh for every run
+        self.enrollment = {}
+        #catch up from the last import if imports were missed
+        for clinic in Clinic.objects.filter(name=self.doc_name,
+                                            user=self.owner)[:1]:
+            start = ImportWatermark.objects.since(clinic, start)
         self.start = start
         self.until = until
-        self.doc_name = str(doc_name)
         self.month = self.reader.run_appointment(self.doc_name, start, until)
         #counts how many enrolled patients where updated correctly
         correct_updates = 0
@@ -70,10 +92,34 @@ class Importer(object):
                 for worksheet in self.month:
                     #check that the spreadsheet has data to update
                     if len(self.month[worksheet]) != 0:
+                        #check if the worksheet changed since the last import
+                        clinic = self.get_or_create_clinic(self.doc_name)
+                        watermark, created = \
+                            ImportWatermark.objects.get_or_create(
+                                clinic=clinic, feed=worksheet)
+                        #newly enrolled patients change the outcome too
+                        content_hash = ImportWatermark.hash_payload((
+                            self.month[worksheet],
+                            list(self.enrolled_file_numbers(self.doc_name))
+                        ))
+                        if watermark.is_unchanged(content_hash) and not force:
+                            logging.debug("Worksheet %s has not changed" %
+                                          worksheet)
+                            watermark.advance(until, content_hash)
+                            return enrolled_counter, correct_updates
                         #if true do update each enrolled patient
-                        enrolled_counter, correct_updates = self.update_patients(
-                            self.month[worksheet], self.doc_name, start, until
-                        )
+                        enrolled_counter, correct_updates = \
+                            self.update_patients_in_bulk(
+                                self.month[worksheet], self.doc_name,
+                                start, until
+                            )
+                        if correct_updates < enrolled_counter:
+                            logging.error("%s patients of %s failed to "
+                                "update, retrying next run" % (
+                                enrolled_counter - correct_updates, worksheet))
+                            watermark.forget()
+                        else:
+                            watermark.advance(until, content_hash)
                         #return enrolled and updated counters
                         return enrolled_counter, correct_updates
                     #if the worksheet does not have data dont do updates
@@ -163,34 +209,179 @@ class Importer(object):
 
         return (enrolled_counter, correct_updates)
 
+    def update_patients_in_bulk(self, month_worksheet, doc_name, start, until,
+                                chunk_size=500):
+        """
+        @arguments:
+        month_worksheet: store the current month's worksheet from spreadsheet.
+        doc_name: the name of spreadsheet to import data from.
+        start: indicates the date to start import data from.
+        until: indicates the date import data function must stop at.
+
+        Does what update_patients does for all the rows in the
+        worksheet at once. The patients, visits and phone numbers of
+        the rows are loaded with a query per chunk_size rows, the clinic
+        is looked up once and the changes are written in a single
+        transaction with the risk profiles updated at the end of it.
+
+        @returns:
+        enrolled_counter: the number of enrolled patients in the worksheet.
+        correct_updates: the number of them updated successfully.
+        """
+        enrolled = self.enrolled_file_numbers(doc_name)
+        #counts how many enrolled patients where updated correctly
+        correct_updates = 0
+        #counter for number of patients found on the enrollement worksheet
+        enrolled_counter = 0
+        rows = []
+        for row_no in sorted(month_worksheet):
+            patient_row = month_worksheet[row_no]
+            if str(patient_row['fileno']) not in enrolled:
+                logging.exception(
+                    'Patient: %s cannot update with False enrollment status' %
+                    patient_row['fileno']
+                )
+                continue
+            enrolled_counter = enrolled_counter + 1
+            file_no, file_format = self.check_file_no_format(
+                                                        patient_row['fileno'])
+            phone, phone_format = self.check_msisdn_format(
+                                                    patient_row['phonenumber'])
+            app_status, status_format = self.check_appointment_status(
+                                            patient_row['appointmentstatus1'])
+            if not (file_format and phone_format and status_format):
+                logging.exception("Invalid data format for patient: %s" %
+                                  file_no)
+                continue
+            visit_id = '%02d-%s' % (row_no, file_no)
+            rows.append((file_no, phone, patient_row['appointmentdate1'],
+                         app_status, visit_id))
+
+        patients, visits, msisdns = {}, {}, {}
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            for patient in Patient.objects.filter(
+                    te_id__in=[row[0] for row in chunk]):
+                patients[patient.te_id] = patient
+            for visit in Visit.objects.filter(
+                    te_visit_id__in=[row[4] for row in chunk]):
+                visits[visit.te_visit_id] = visit
+            for msisdn in MSISDN.objects.filter(
+                    msisdn__in=[row[1] for row in chunk]):
+                msisdns[msisdn.msisdn] = msisdn
+        clinic = self.get_or_create_clinic(doc_name)
+
+        with transaction.commit_on_success():
+            with deferred_risk_profiles():
+                for file_no, phone, app_date, app_status, visit_id in rows:
+                    if self.reconcile_patient(file_no, phone, app_date,
+                                              app_status, visit_id, clinic,
+                                              patients, visits, msisdns):
+                        correct_updates = correct_updates + 1
+        return (enrolled_counter, correct_updates)
+
+    def reconcile_patient(self, file_no, phone, app_date, app_status,
+                          visit_id, clinic, patients, visits, msisdns):
+        """
+        Creates or updates the patient of a worksheet row as
+        update_patient does, using the patients, visits and msisdns
+        preloaded by update_patients_in_bulk. Records created are
+        added to those.
+
+        @returns:
+        patient_update: successful updates flag.
+        """
+        msisdn = msisdns.get(phone)
+        msisdn_created = msisdn is None
+        if msisdn_created:
+            #another import may have created the number since it was loaded
+            sid = transaction.savepoint()
+            try:
+                msisdn = MSISDN.objects.create(msisdn=phone)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                msisdn = MSISDN.objects.get(msisdn=phone)
+            msisdns[phone] = msisdn
+
+        patient = patients.get(file_no)
+        patient_created = patient is None
+        if patient_created:
+            logging.debug("Patient: %s not found in database" % file_no)
+            sid = transaction.savepoint()
+            try:
+                patient = Patient(te_id=file_no, active_msisdn=msisdn,
+                                  owner=self.owner)
+                patient.save()
+                patient.msisdns.add(msisdn)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                logging.exception("Failed to create patient invalid field")
+                return False
+            patients[file_no] = patient
+        elif msisdn_created:
+            #add new phone numbers to the patient's list of numbers
+            patient.msisdns.add(msisdn)
+            logging.debug('Phone number update for patient: %s' % patient)
+
+        visit = visits.get(visit_id)
+        if visit is None:
+            logging.debug("Creating a new visit for patient")
+            sid = transaction.savepoint()
+            visit, visit_created = self.create_visit(visit_id, patient,
+                            app_date, self.update_needed(app_status), clinic)
+            if not visit_created:
+                transaction.savepoint_rollback(sid)
+                #a new patient only counts as updated with its visit
+                return not patient_created
+            transaction.savepoint_commit(sid)
+            visits[visit_id] = visit
+        self.apply_appointment_status(visit, app_status, app_date, visit_id)
+        return True
+
+    def enrolled_file_numbers(self, doc_name):
+        """
+        @arguments:
+        doc_name: the name of spreadsheet to import data from.
+
+        The set of enrolled file numbers for the spreadsheet, the
+        enrollment worksheet is downloaded once per import run. If
+        ENROLLMENT_SNAPSHOT_TIMEOUT is set the set is also kept in
+        the cache for that many seconds and reused by later runs.
+        """
+        doc_name = str(doc_name)
+        if doc_name not in self.enrollment:
+            key = 'googledoc:enrollment:%s' % hashlib.md5(
+                                    '%s:%s' % (self.email, doc_name)).hexdigest()
+            file_numbers = None
+            if ENROLLMENT_SNAPSHOT_TIMEOUT:
+                file_numbers = cache.get(key)
+            if file_numbers is None:
+                file_numbers = self.reader.enrolled_file_numbers(doc_name)
+                if file_numbers is None:
+                    logging.error("No enrollment worksheet for %s" % doc_name)
+                    file_numbers = set()
+                elif ENROLLMENT_SNAPSHOT_TIMEOUT:
+                    cache.set(key, file_numbers, ENROLLMENT_SNAPSHOT_TIMEOUT)
+            self.enrollment[doc_name] = file_numbers
+        return self.enrollment[doc_name]
+
     def set_cache_enrollement_status(self, doc_name, file_no, start, until):
-         #check if the patient has enrolled
-        if self.reader.run_enrollment_check(doc_name, file_no,
-                                            start, until) is True:
-            #cache the enrollment check
-            cache.set(file_no, True, CACHE_TIMEOUT)
-            logging.debug("Caching True status for patient: %s" %
-                           file_no
-            )
-            #the patient is enrolled, cache true for enrollement status
-            enrolled_cache = True
-            return enrolled_cache
-        elif self.reader.run_enrollment_check(doc_name, file_no,
-                                              start, until) is False:
-            #cache the enrollment check
-            cache.set(file_no, False, CACHE_TIMEOUT)
-            logging.exception(
-                               "Caching False status for patient: %s" %
-                               file_no
-            )
-            #the patient is not enrolled, cache False for enrollement status
-            enrolled_cache = False
-            return enrolled_cache
+        #check if the patient has enrolled
+        self.doc_name = str(doc_name)
+        if str(file_no) in self.enrolled_file_numbers(doc_name):
+            logging.debug("Patient: %s is enrolled" % file_no)
+            return True
+        else:
+            logging.debug("Patient: %s is not enrolled" % file_no)
+            return False
 
     def get_cache_enrollement_status(self, file_no):
-        #check if the enrollment check was cached
-        enrolled = cache.get(file_no)
-        return enrolled
+        #check if the enrollment status is known for the current spreadsheet
+        file_numbers = self.enrollment.get(getattr(self, 'doc_name', None))
+        if file_numbers is not None:
+            return str(file_no) in file_numbers
 
     def update_patient(self, patient_row, row, doc_name, start, until):
         '''
@@ -404,8 +595,6 @@ class Importer(object):
                     enrolled = self.set_cache_enrollement_status(
                                     doc_name, file_no, start, until
                     )
-                    #check if the enrollment check was cached
-                    enrolled = cache.get(file_no)
                     #convert string enroment to a choice key used in database
                     status = self.update_needed(app_status)
                     #if patient is enrolled create a visit instanceprint
@@ -574,7 +763,25 @@ class Importer(object):
             #check if the visit was created
             if not visit_created:
                 return status
+        return self.apply_appointment_status(curr_visit, app_status,
+                                             app_date, visit_id)
+
+    def apply_appointment_status(self, curr_visit, app_status, app_date,
+                                 visit_id):
+        """
+        @rgument:
+        curr_visit: the patient's visit for the appointment.
+        app_status: appointment status.
+        app_date: appointment date.
+        visit_id: database unique identifier for the patient
 
+        Applies the appointment status from the worksheet to the
+        visit, see update_appointment_status.
+
+        @returns:
+        updated: indicates whether the appointment status was updated.
+        """
+        status = self.update_needed(app_status)
         #stores variable used to check if appointment updates are needed
         progress = self.update_needed(app_status)
         #dont update if the status has not changed
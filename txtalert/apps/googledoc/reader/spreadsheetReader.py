@@ -23,6 +23,111 @@ import gdata.service
 import gdata.spreadsheet
 import datetime
 import logging
+import time
+
+#seconds resolved spreadsheet keys and worksheet ids are reused for
+KEY_CACHE_TIMEOUT = 60 * 60
+#seconds a logged in session is reused for, the auth tokens are valid for
+#a day
+SESSION_TIMEOUT = 12 * 60 * 60
+
+
+class ExpiringCache(object):
+    """A dict whose entries expire `timeout` seconds after being set."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.entries = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.time():
+                return value
+            #another thread may have removed it already
+            self.entries.pop(key, None)
+
+    def set(self, key, value):
+        self.entries[key] = (value, time.time() + self.timeout)
+
+    def clear(self):
+        self.entries.clear()
+
+#spreadsheet keys and worksheet ids by title, these don't change unless
+#a spreadsheet or worksheet is renamed so they're shared by all readers
+resolved_keys = ExpiringCache(KEY_CACHE_TIMEOUT)
+#authenticated sessions by account, so each account only logs in once
+sessions = ExpiringCache(SESSION_TIMEOUT)
+
+
+def login(email, password):
+    """
+    @arguments:
+    email: google email account username.
+    password: google email account password.
+
+    Returns an authenticated SpreadsheetsService for the account,
+    reusing the session of an earlier login if it hasn't expired.
+    """
+    gd_client = sessions.get((email, password))
+    if gd_client is None:
+        gd_client = gdata.spreadsheet.service.SpreadsheetsService()
+        gd_client.email = email
+        gd_client.password = password
+        gd_client.source = 'Import Google SpreadSheet to Database'
+        try:
+            gd_client.ProgrammaticLogin()
+        except (BadAuthentication, CaptchaRequired):
+            logging.exception("Invalid loggin values or captcha error.")
+            raise
+        sessions.set((email, password), gd_client)
+    return gd_client
+
+
+class DateIndexedWorksheet(object):
+    """
+    The rows of an appointment worksheet bucketed by their appointment
+    date. The rows are bucketed in a single pass, after that the rows
+    for any date range can be looked up without rescanning the
+    worksheet.
+    """
+    def __init__(self, worksheet):
+        """
+        @arguments:
+        worksheet: the worksheet contents, row number -> row.
+        """
+        self.by_date = {}
+        for row in worksheet:
+            #skip empty rows
+            if not worksheet[row]:
+                logging.error('Empty row %s at %s' % (worksheet[row], row))
+                continue
+            try:
+                app_date = worksheet[row]['appointmentdate1']
+            except KeyError:
+                logging.error('Error reading row %s at %s' % (
+                                                    worksheet[row], row))
+                continue
+            #only rows with a proper date can fall within a period
+            if type(app_date) == datetime.date:
+                self.by_date.setdefault(app_date, {})[row] = worksheet[row]
+
+    def rows(self, start, until):
+        """
+        @arguments:
+        start: the first day of the period.
+        until: the last day of the period.
+
+        @returns:
+        patients_worksheet: the rows with an appointment date from
+                            start up to and including until.
+        """
+        patients_worksheet = {}
+        for day in range((until - start).days + 1):
+            curr_date = start + datetime.timedelta(days=day)
+            patients_worksheet.update(self.by_date.get(curr_date, {}))
+        return patients_worksheet
 
 
 class SimpleCRUD:
@@ -33,20 +138,14 @@ class SimpleCRUD:
         password: google email account password.
 
         Authenticates the user and sets the
-        Gdata Auth token.
+        Gdata Auth token, see login.
         """
-        self.gd_client = gdata.spreadsheet.service.SpreadsheetsService()
-        self.gd_client.email = email
-        self.gd_client.password = password
-        self.gd_client.source = 'Import Google SpreadSheet to Database'
-        try:
-            self.gd_client.ProgrammaticLogin()
-        except (BadAuthentication, CaptchaRequired):
-            logging.exception("Invalid loggin values or captcha error.")
-            raise
+        self.gd_client = login(email, password)
         self.curr_key = ''
         self.wksht_id = ''
         self.list_feed = None
+        #date indexes of the appointment worksheets last downloaded
+        self.worksheet_indexes = {}
 
     def get_spreadsheet(self, doc_name):
         """
@@ -56,19 +155,25 @@ class SimpleCRUD:
         Use Auth token to get the spreadsheet
         specified by doc_name. Gets a key which
         is used as a unique idenfier for the spreadsheet.
+        The key is reused for KEY_CACHE_TIMEOUT seconds.
         """
-        q = gdata.spreadsheet.service.DocumentQuery()
-        q['title'] = doc_name
-        q['title-exact'] = 'true'
-        feed = self.gd_client.GetSpreadsheetsFeed(query=q)
-        try:
-            self.curr_key = feed.entry[0].id.text.rsplit('/', 1)[1]
-            found = True
-            return found
-        except IndexError:
-            logging.exception("Spreadsheet name is invalid")
-            found = False
-            return found
+        cache_key = ('spreadsheet', self.gd_client.email, doc_name)
+        curr_key = resolved_keys.get(cache_key)
+        if curr_key is None:
+            q = gdata.spreadsheet.service.DocumentQuery()
+            q['title'] = doc_name
+            q['title-exact'] = 'true'
+            feed = self.gd_client.GetSpreadsheetsFeed(query=q)
+            try:
+                curr_key = feed.entry[0].id.text.rsplit('/', 1)[1]
+            except IndexError:
+                logging.exception("Spreadsheet name is invalid")
+                found = False
+                return found
+            resolved_keys.set(cache_key, curr_key)
+        self.curr_key = curr_key
+        found = True
+        return found
 
     def get_worksheet_data(self, worksheet_type, start, until):
         """
@@ -131,9 +236,11 @@ class SimpleCRUD:
             app_worksheet = self.get_worksheet(worksheet_name)
             #check if the worksheet was found and has contents
             if app_worksheet is  not False and len(app_worksheet) > 0:
+                #index the rows by date, kept for further range queries
+                index = DateIndexedWorksheet(app_worksheet)
+                self.worksheet_indexes[worksheet_name] = index
                 #get the rows that fall with the start and until date(s)
-                app_worksheet = self.appointment_rows(app_worksheet,
-                                                      start, until)
+                app_worksheet = index.rows(start, until)
                 #worksheet name is the key and value is worksheet
                 holder = {worksheet_name: app_worksheet}
                 #store it in the dictionary to be returned
@@ -158,21 +265,24 @@ class SimpleCRUD:
         @returns:
         app_worksheet: Stores the worksheet contents.
         """
-
-        q = gdata.spreadsheet.service.DocumentQuery()
-        q['title'] = worksheet_name
-        q['title-exact'] = 'true'
-        feed = self.gd_client.GetWorksheetsFeed(self.curr_key, query=q)
-        try:
-            self.wksht_id = feed.entry[0].id.text.rsplit('/', 1)[1]
-            #if worksheet is not enrollement sheet get data
-            if worksheet_name != 'enrollment sheet':
-                app_worksheet = self.prompt_for_list_action()
-                return app_worksheet
-
-        except IndexError:
-            worksheet_found = False
-            return worksheet_found
+        cache_key = ('worksheet', self.curr_key, worksheet_name)
+        wksht_id = resolved_keys.get(cache_key)
+        if wksht_id is None:
+            q = gdata.spreadsheet.service.DocumentQuery()
+            q['title'] = worksheet_name
+            q['title-exact'] = 'true'
+            feed = self.gd_client.GetWorksheetsFeed(self.curr_key, query=q)
+            try:
+                wksht_id = feed.entry[0].id.text.rsplit('/', 1)[1]
+            except IndexError:
+                worksheet_found = False
+                return worksheet_found
+            resolved_keys.set(cache_key, wksht_id)
+        self.wksht_id = wksht_id
+        #if worksheet is not enrollement sheet get data
+        if worksheet_name != 'enrollment sheet':
+            app_worksheet = self.prompt_for_list_action()
+            return app_worksheet
 
     def appointment_rows(self, worksheet, start, until):
         """
@@ -181,47 +291,15 @@ class SimpleCRUD:
         start: indicates the date to start import data from.
         until: indicates the date import data function must stop at.
 
-        Looks at data from the provideed worksheet that falls
-        within the start and until date. Creates a loop of dates from
-        start to until, for each day search the worksheet to see if
-        the is a patient record with the same date if true get it.
+        Looks at data from the provided worksheet that falls
+        within the start and until date. The rows are bucketed by
+        date in a single pass, see DateIndexedWorksheet.
 
         @returns:
         patients_worksheet: store the patient rows that are
                             within start and until.
         """
-        #stores the rows in the worksheet that are with the period date
-        patients_worksheet = {}
-        #Used to indicate the days to get patient data from
-        period = until - start
-        #get patient info for each day in period
-        for day in range(period.days + 1):
-            #the day to check from the worksheet
-            curr_date = start + datetime.timedelta(days=day)
-            #access the rows inside the worksheet
-            for row in worksheet:
-                try:
-                    #check if the worksheet has a patient with this date
-                    if worksheet[row]:
-                        if worksheet[row]['appointmentdate1'] == curr_date:
-                            #test if the current date is in month range
-                            date_range = worksheet[row]['appointmentdate1']
-                            if type(date_range) == datetime.date:
-                                #row for final worksheet
-                                patient_row = {row: worksheet[row]}
-                                #update the new worksheet
-                                patients_worksheet.update(patient_row)
-                                #clear temp locations
-                                patient_row = {}
-                    else:
-                        logging.error('Empty row %s at %s' % (
-                                                         worksheet[row], row)
-                        )
-                except KeyError, e:
-                     logging.error('Error reading row %s at %s in %s' % (
-                                               worksheet[row], row, period)
-                     )
-        return patients_worksheet
+        return DateIndexedWorksheet(worksheet).rows(start, until)
 
     def enrol_query(self, file_no):
         """
@@ -250,6 +328,32 @@ class SimpleCRUD:
             enrolled = False
             return enrolled
 
+    def enrolled_file_numbers(self, doc_name):
+        """
+        @arguments:
+        doc_name: the name of spreadsheet to import data from.
+
+        Downloads the enrollment worksheet in one go instead of
+        querying it for every patient. The enrollment query used to
+        match the file number against any cell in the worksheet so
+        the values of all the cells are collected.
+
+        @returns:
+        file_numbers: set of the values in the enrollment worksheet,
+                      None if the spreadsheet or worksheet was not found.
+        """
+        if not self.get_spreadsheet(doc_name):
+            return None
+        if self.get_worksheet('enrollment sheet') is False:
+            return None
+        feed = self.gd_client.GetListFeed(self.curr_key, self.wksht_id)
+        file_numbers = set()
+        for entry in feed.entry:
+            for key in entry.custom:
+                if entry.custom[key].text:
+                    file_numbers.add(entry.custom[key].text.strip())
+        return file_numbers
+
     def prompt_for_list_action(self):
         """Calls method that gets a list feed from the given worksheet."""
         sheet = self.list_get_action()
@@ -0,0 +1,125 @@
+"""
+Runs the Google spreadsheet imports of all the GoogleAccounts, used by the
+`gd_import_data` management command.
+
+Each account logs in once and imports its spreadsheets one after the other,
+the accounts are imported concurrently from a pool of threads as most of an
+import is spent waiting for Google. An account that fails to log in or a
+spreadsheet that fails to import is logged and reported without affecting
+the others.
+"""
+from multiprocessing.pool import ThreadPool
+from django.db import connection
+from txtalert.apps.googledoc.importer import Importer
+from txtalert.apps.googledoc.reader import spreadsheetReader
+from txtalert.apps.googledoc.models import GoogleAccount
+import logging
+
+
+class ImportResult(object):
+    """The outcome of importing a spreadsheet, or of the account as a
+    whole when `spreadsheet` is None, i.e. failing to log in or having no
+    spreadsheets to import"""
+
+    def __init__(self, account, spreadsheet=None, enrolled=0, updated=0,
+                    error=None):
+        self.account = account
+        self.spreadsheet = spreadsheet
+        self.enrolled = enrolled
+        self.updated = updated
+        self.error = error
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def __unicode__(self):
+        name = self.spreadsheet or u'account'
+        if self.failed:
+            return u'%s: %s failed: %s' % (self.account.username, name,
+                                            self.error)
+        return u'%s: %s enrolled %s, updated %s' % (self.account.username,
+                                            name, self.enrolled, self.updated)
+
+
+def import_account(account, start, until, force=False,
+                    importer_class=Importer, spreadsheets=None):
+    """Import all the spreadsheets of the account, or the named
+    `spreadsheets` of it, returns a list of ImportResults, one per
+    spreadsheet. An account without spreadsheets gets a failed result."""
+    if spreadsheets is None:
+        spreadsheets = [spreadsheet.spreadsheet for spreadsheet
+                            in account.spreadsheet_set.all()]
+    try:
+        importer = importer_class(owner=account.user,
+                                    email=account.username,
+                                    password=account.password)
+    except Exception, e:
+        logging.exception("Login failed for account: %s" % account)
+        return [ImportResult(account, error=e)]
+
+    if not spreadsheets:
+        logging.error("No Spreadsheet for account: %s" % account)
+        return [ImportResult(account, error='no spreadsheets')]
+
+    results = []
+    for spreadsheet in spreadsheets:
+        logging.debug("Spreadsheet for: %s" % account.username)
+        try:
+            counts = importer.import_spread_sheet(spreadsheet, start, until,
+                                                    force=force)
+        except Exception, e:
+            logging.exception("Error while updating patients from %s" %
+                                spreadsheet)
+            results.append(ImportResult(account, spreadsheet, error=e))
+            continue
+        enrolled, updated = counts
+        if updated is False:
+            # import_spread_sheet returns the name and a False flag when
+            # the spreadsheet or its worksheet can't be found or is empty
+            results.append(ImportResult(account, spreadsheet,
+                            error='spreadsheet not found or empty'))
+        else:
+            results.append(ImportResult(account, spreadsheet, enrolled,
+                                        updated))
+    return results
+
+
+def run(start, until, force=False, concurrency=4, accounts=None,
+            importer_class=Importer):
+    """Import the spreadsheets of the accounts, all GoogleAccounts by
+    default, with up to `concurrency` accounts at a time. Returns the list
+    of ImportResults."""
+    accounts = list(accounts if accounts is not None
+                    else GoogleAccount.objects.select_related('user'))
+    if not accounts:
+        return []
+    # the accounts' spreadsheets are looked up here rather than in the
+    # threads, which only use the database to write the imported patients
+    jobs = [(account, [spreadsheet.spreadsheet for spreadsheet
+                            in account.spreadsheet_set.all()])
+            for account in accounts]
+    # resolve the spreadsheet and worksheet keys afresh every run, they
+    # are shared by all the accounts' imports within the run
+    spreadsheetReader.resolved_keys.clear()
+
+    def import_in_thread(job):
+        account, spreadsheets = job
+        try:
+            return import_account(account, start, until, force,
+                                    importer_class, spreadsheets)
+        finally:
+            # every thread has its own database connection
+            connection.close()
+
+    if concurrency <= 1:
+        per_account = [import_account(account, start, until, force,
+                                        importer_class, spreadsheets)
+                        for account, spreadsheets in jobs]
+    else:
+        pool = ThreadPool(min(concurrency, len(jobs)))
+        try:
+            per_account = pool.map(import_in_thread, jobs)
+        finally:
+            pool.terminate()
+    return sum(per_account, [])
@@ -1 +1,2 @@
-from txtalert.apps.googledoc.tests.importer import *
\ No newline at end of file
+from txtalert.apps.googledoc.tests.importer import *
+from txtalert.apps.googledoc.tests.runner import *
\ No newline at end of file
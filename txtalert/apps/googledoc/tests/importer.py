@@ -1,9 +1,14 @@
 from django.test import TestCase
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from txtalert.apps.googledoc.models import SpreadSheet, GoogleAccount
+from txtalert.apps.googledoc import importer
 from txtalert.apps.googledoc.importer import Importer
-from txtalert.apps.googledoc.reader.spreadsheetReader import SimpleCRUD
-from txtalert.core.models import Patient, MSISDN, Visit, Clinic
+from txtalert.apps.googledoc.reader import spreadsheetReader
+from txtalert.apps.googledoc.reader.spreadsheetReader import (SimpleCRUD,
+                                        DateIndexedWorksheet, ExpiringCache)
+from txtalert.core.models import (Patient, MSISDN, Visit, Clinic,
+                                    ImportWatermark)
 from datetime import datetime, timedelta, date
 import random
 
@@ -450,9 +455,278 @@ class SpreadSheetReaderTestCase(TestCase):
         )
         self.assertEquals(self.not_enrol, False)
 
+    def test_enrolled_file_numbers(self):
+        """Test if the enrollment worksheet is downloaded as a set."""
+        self.file_numbers = self.reader.enrolled_file_numbers(
+                                                        self.spreadsheet)
+        self.assertTrue('63601' in self.file_numbers)
+        self.assertFalse('60001' in self.file_numbers)
+        self.assertEquals(
+                self.reader.enrolled_file_numbers('##########'), None)
+
     def test_run_appointment_check(self):
         """Test if the appointments worksheets are retrieved."""
         self.month = self.reader.run_appointment(
                                        self.spreadsheet, self.start, self.until
         )
         self.assertTrue(self.month)
+
+
+class DateIndexedWorksheetTestCase(TestCase):
+    """Testing the date index of appointment worksheets"""
+
+    def test_rows(self):
+        """Test for getting the rows in a date range from the index."""
+        self.worksheet = {
+                            2: {'appointmentdate1': date(2011, 8, 1)},
+                            3: {'appointmentdate1': date(2011, 8, 10)},
+                            4: {'appointmentdate1': date(2011, 8, 10)},
+                            5: {'appointmentdate1': date(2011, 9, 2)},
+                            6: {},
+                            7: {'fileno': '63601'},
+        }
+        self.index = DateIndexedWorksheet(self.worksheet)
+        self.rows = self.index.rows(date(2011, 8, 1), date(2011, 8, 14))
+        self.assertEquals(sorted(self.rows.keys()), [2, 3, 4])
+        self.assertEquals(self.rows[3], self.worksheet[3])
+        #the index can be queried again without rescanning the worksheet
+        self.rows = self.index.rows(date(2011, 9, 1), date(2011, 9, 2))
+        self.assertEquals(self.rows.keys(), [5])
+        self.assertEquals(self.index.rows(date(2011, 8, 2), date(2011, 8, 9)),
+                          {})
+
+
+class ExpiringCacheTestCase(TestCase):
+    """Testing the cache of resolved spreadsheet keys"""
+
+    def test_expiry(self):
+        """Test that entries expire after the timeout."""
+        self.cache = ExpiringCache(60)
+        self.cache.set(('spreadsheet', 'Praekelt'), 'key')
+        self.assertEquals(self.cache.get(('spreadsheet', 'Praekelt')), 'key')
+        self.assertEquals(self.cache.get(('spreadsheet', 'Other')), None)
+        self.cache.timeout = -1
+        self.cache.set(('spreadsheet', 'Praekelt'), 'key')
+        self.assertEquals(self.cache.get(('spreadsheet', 'Praekelt')), None)
+
+
+class FakeReader(object):
+    """Stands in for SimpleCRUD, the worksheets are kept in memory"""
+
+    def __init__(self, worksheets, enrolled):
+        self.worksheets = worksheets
+        self.enrolled = enrolled
+        self.enrollment_downloads = 0
+
+    def run_appointment(self, doc_name, start, until):
+        return self.worksheets.get(doc_name, False)
+
+    def enrolled_file_numbers(self, doc_name):
+        self.enrollment_downloads = self.enrollment_downloads + 1
+        return self.enrolled.get(doc_name)
+
+
+class OfflineImporterTestCase(TestCase):
+    """Testing the import loop without logging in to google"""
+
+    fixtures = ['patient', 'visit', 'clinic']
+
+    def setUp(self):
+        self.email = 'offline@txtalert.com'
+        self.password = 'testtest'
+        self.spreadsheet = 'Praekelt'
+        self.start = date(2011, 7, 31)
+        self.until = date(2011, 8, 14)
+        self.user = User.objects.all()[0]
+        #a logged in session, so the importer doesn't log in to google
+        spreadsheetReader.sessions.set((self.email, self.password), object())
+        self.importer = Importer(self.user, self.email, self.password)
+        self.worksheet = {
+                            1: {
+                                'appointmentdate1': date(2011, 8, 1),
+                                'fileno': 1111111,
+                                'appointmentstatus1': 'Missed',
+                                'phonenumber': 123456789
+                            },
+                            3: {
+                                'appointmentdate1': date(2011, 8, 10),
+                                'fileno': 5555555,
+                                'appointmentstatus1': 'Scheduled',
+                                'phonenumber': 821234567
+                            },
+        }
+        self.reader = FakeReader(
+                    {self.spreadsheet: {'Aug 2011': self.worksheet}},
+                    {self.spreadsheet: set(['1111111'])}
+        )
+        self.importer.reader = self.reader
+
+    def tearDown(self):
+        spreadsheetReader.sessions.clear()
+        cache.clear()
+
+    def import_spread_sheet(self):
+        return self.importer.import_spread_sheet(self.spreadsheet,
+                                                 self.start, self.until)
+
+    def test_enrollment_changes_are_imported(self):
+        """Test that newly enrolled patients are imported with an
+        unchanged worksheet."""
+        self.assertEqual(self.import_spread_sheet(), (1, 1))
+        #nothing changed, the worksheet is skipped
+        self.assertEqual(self.import_spread_sheet(), (0, 0))
+        self.assertFalse(Patient.objects.filter(te_id='5555555').exists())
+        self.reader.enrolled[self.spreadsheet].add('5555555')
+        self.assertEqual(self.import_spread_sheet(), (2, 2))
+        self.assertTrue(Patient.objects.filter(te_id='5555555').exists())
+
+    def test_failed_rows_are_retried(self):
+        """Test that a worksheet with failed rows isn't skipped."""
+        self.reader.enrolled[self.spreadsheet].add('5555555')
+        self.worksheet[3]['phonenumber'] = 12345
+        self.assertEqual(self.import_spread_sheet(), (2, 1))
+        watermark = ImportWatermark.objects.get(feed='Aug 2011')
+        self.assertEqual(watermark.content_hash, '')
+        self.assertEqual(watermark.until, None)
+        #the worksheet is imported again once the row is fixed
+        self.worksheet[3]['phonenumber'] = 821234567
+        self.assertEqual(self.import_spread_sheet(), (2, 2))
+        watermark = ImportWatermark.objects.get(feed='Aug 2011')
+        self.assertNotEqual(watermark.content_hash, '')
+
+    def test_enrolled_file_numbers(self):
+        """Test that the enrollment worksheet is downloaded once a run."""
+        self.assertEqual(self.importer.enrolled_file_numbers(
+                                    self.spreadsheet), set(['1111111']))
+        self.assertIs(self.importer.set_cache_enrollement_status(
+                        self.spreadsheet, 1111111, self.start, self.until),
+                      True)
+        self.assertIs(self.importer.set_cache_enrollement_status(
+                        self.spreadsheet, 5555555, self.start, self.until),
+                      False)
+        self.assertIs(self.importer.get_cache_enrollement_status(1111111),
+                      True)
+        self.assertEqual(self.reader.enrollment_downloads, 1)
+        #a spreadsheet without an enrollment worksheet has no one enrolled
+        self.assertEqual(self.importer.enrolled_file_numbers('Empty'),
+                         set())
+        #every import run downloads the worksheet afresh
+        self.import_spread_sheet()
+        self.import_spread_sheet()
+        self.assertEqual(self.reader.enrollment_downloads, 4)
+
+    def test_enrollment_snapshot(self):
+        """Test that the enrolled file numbers are shared between runs
+        with a snapshot timeout."""
+        timeout = importer.ENROLLMENT_SNAPSHOT_TIMEOUT
+        importer.ENROLLMENT_SNAPSHOT_TIMEOUT = 60
+        try:
+            self.import_spread_sheet()
+            self.import_spread_sheet()
+            self.assertEqual(self.reader.enrollment_downloads, 1)
+            #other accounts have their own snapshot
+            spreadsheetReader.sessions.set(('other@txtalert.com',
+                                            self.password), object())
+            other = Importer(self.user, 'other@txtalert.com', self.password)
+            other.reader = self.reader
+            other.enrolled_file_numbers(self.spreadsheet)
+            self.assertEqual(self.reader.enrollment_downloads, 2)
+        finally:
+            importer.ENROLLMENT_SNAPSHOT_TIMEOUT = timeout
+
+    def add_worksheet_rows(self):
+        """Adds an existing patient with a new phone number, a patient
+        who isn't enrolled and another new patient to the worksheet."""
+        self.worksheet.update({
+                            2: {
+                                'appointmentdate1': date(2011, 8, 5),
+                                'fileno': 9999999,
+                                'appointmentstatus1': 'Scheduled',
+                                'phonenumber': 829999999
+                            },
+                            4: {
+                                'appointmentdate1': date(2011, 8, 11),
+                                'fileno': 7777777,
+                                'appointmentstatus1': 'Scheduled',
+                                'phonenumber': 827777777
+                            },
+                            5: {
+                                'appointmentdate1': date(2011, 8, 12),
+                                'fileno': 6666666,
+                                'appointmentstatus1': 'Scheduled',
+                                'phonenumber': 826666666
+                            },
+        })
+        self.reader.enrolled[self.spreadsheet].update(
+                                        ['9999999', '5555555', '6666666'])
+
+    def assert_worksheet_imported(self, update_patients):
+        self.add_worksheet_rows()
+        self.assertEqual(update_patients(self.worksheet, self.spreadsheet,
+                                         self.start, self.until), (4, 4))
+        self.assertEqual(Visit.objects.get(te_visit_id='01-1111111').status,
+                         'm')
+        patient = Patient.objects.get(te_id='9999999')
+        self.assertTrue(patient.msisdns.filter(
+                                        msisdn='27829999999').exists())
+        self.assertEqual(Visit.objects.get(te_visit_id='02-9999999').patient,
+                         patient)
+        for file_no, phone, visit_id in [('5555555', '27821234567',
+                                          '03-5555555'),
+                                         ('6666666', '27826666666',
+                                          '05-6666666')]:
+            patient = Patient.objects.get(te_id=file_no)
+            self.assertEqual(patient.active_msisdn.msisdn, phone)
+            self.assertEqual(
+                list(patient.msisdns.values_list('msisdn', flat=True)),
+                [phone])
+            visit = Visit.objects.get(te_visit_id=visit_id)
+            self.assertEqual((visit.patient, visit.status), (patient, 's'))
+        self.assertFalse(Patient.objects.filter(te_id='7777777').exists())
+        self.assertFalse(MSISDN.objects.filter(msisdn='27827777777').exists())
+
+    def test_update_patients(self):
+        """Test that a worksheet is imported row by row."""
+        self.assert_worksheet_imported(self.importer.update_patients)
+
+    def test_update_patients_in_bulk(self):
+        """Test that the bulk import makes the changes update_patients
+        does for the same rows."""
+        self.assert_worksheet_imported(self.importer.update_patients_in_bulk)
+
+    def test_update_patients_in_bulk_msisdn_created_meanwhile(self):
+        """Test that a phone number created by another import after the
+        worksheet's numbers were loaded is used rather than failing."""
+        self.add_worksheet_rows()
+        create = MSISDN.objects.create
+        def create_concurrently(**kwargs):
+            #the other import gets there first
+            create(**kwargs)
+            return create(**kwargs)
+        MSISDN.objects.create = create_concurrently
+        try:
+            self.assertEqual(self.importer.update_patients_in_bulk(
+                                        self.worksheet, self.spreadsheet,
+                                        self.start, self.until), (4, 4))
+        finally:
+            del MSISDN.objects.create
+        self.assertEqual(
+                Patient.objects.get(te_id='5555555').active_msisdn.msisdn,
+                '27821234567')
+        self.assertEqual(
+                MSISDN.objects.filter(msisdn='27821234567').count(), 1)
+
+    def test_update_patients_in_bulk_visit_failure(self):
+        """Test that a visit which can't be created is rolled back
+        without losing the other rows."""
+        self.add_worksheet_rows()
+        self.worksheet[3]['appointmentdate1'] = None
+        self.assertEqual(self.importer.update_patients_in_bulk(
+                                        self.worksheet, self.spreadsheet,
+                                        self.start, self.until), (4, 3))
+        #the patient is kept, as update_patients does, but not the visit
+        self.assertTrue(Patient.objects.filter(te_id='5555555').exists())
+        self.assertFalse(
+                Visit.objects.filter(te_visit_id='03-5555555').exists())
+        self.assertTrue(
+                Visit.objects.filter(te_visit_id='05-6666666').exists())
@@ -0,0 +1,121 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from txtalert.apps.googledoc.models import SpreadSheet, GoogleAccount
+from txtalert.apps.googledoc import runner
+from datetime import timedelta, date
+import threading
+
+
+class FakeImporter(object):
+    """Stands in for the Importer, without logging in to Google"""
+    imported = []
+
+    def __init__(self, owner, email, password):
+        if password == 'wrong':
+            raise Exception('Invalid loggin values')
+        self.email = email
+
+    def import_spread_sheet(self, doc_name, start, until, force=False):
+        self.imported.append((self.email, doc_name))
+        if doc_name == 'Broken':
+            raise Exception('Worksheet has no fileno column')
+        if doc_name == 'Missing':
+            return doc_name, False
+        return 3, 2
+
+
+class FakeConnection(object):
+    """Records the threads closing their database connection"""
+
+    def __init__(self):
+        self.closed_by = []
+
+    def close(self):
+        self.closed_by.append(threading.current_thread())
+
+
+class RunnerTestCase(TestCase):
+    """Testing the import of all the google accounts"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('googledoc',
+                                             'googledoc@txtalert.com')
+        self.start = date.today() - timedelta(days=1)
+        self.until = date.today() + timedelta(days=14)
+        FakeImporter.imported = []
+
+    def add_account(self, username, password, *spreadsheets):
+        account = GoogleAccount.objects.create(user=self.user,
+                                               username=username,
+                                               password=password)
+        for spreadsheet in spreadsheets:
+            SpreadSheet.objects.create(account=account,
+                                       spreadsheet=spreadsheet)
+        return account
+
+    def test_failures_are_isolated(self):
+        """Test a failing account or spreadsheet doesn't stop the others."""
+        self.add_account('wrong@txtalert.com', 'wrong', 'Praekelt')
+        self.add_account('clinics@txtalert.com', 'testtest', 'Broken',
+                         'Missing', 'Praekelt', 'Partner')
+        self.add_account('empty@txtalert.com', 'testtest')
+        results = runner.run(self.start, self.until, concurrency=1,
+                             importer_class=FakeImporter)
+        # the spreadsheets after the failing ones are still imported
+        self.assertEqual(sorted(FakeImporter.imported), [
+            ('clinics@txtalert.com', 'Broken'),
+            ('clinics@txtalert.com', 'Missing'),
+            ('clinics@txtalert.com', 'Partner'),
+            ('clinics@txtalert.com', 'Praekelt'),
+        ])
+        self.assertEqual(len(results), 6)
+        failed = [(result.account.username, result.spreadsheet)
+                    for result in results if result.failed]
+        self.assertEqual(sorted(failed), [
+            ('clinics@txtalert.com', 'Broken'),
+            ('clinics@txtalert.com', 'Missing'),
+            ('empty@txtalert.com', None),
+            ('wrong@txtalert.com', None),
+        ])
+        # the accounts are imported newest first
+        self.assertEqual(unicode(results[0]),
+                         u'empty@txtalert.com: account failed: '
+                         u'no spreadsheets')
+        imported = [result for result in results if not result.failed]
+        self.assertEqual([(result.enrolled, result.updated)
+                            for result in imported], [(3, 2), (3, 2)])
+        self.assertEqual(unicode(imported[0]), u'clinics@txtalert.com: '
+                         u'%s enrolled 3, updated 2' % imported[0].spreadsheet)
+
+    def test_concurrent_import(self):
+        """Test the accounts are imported from a pool of threads."""
+        self.add_account('wrong@txtalert.com', 'wrong', 'Praekelt')
+        self.add_account('clinics@txtalert.com', 'testtest', 'Broken',
+                         'Praekelt')
+        self.add_account('partner@txtalert.com', 'testtest', 'Partner')
+        self.add_account('empty@txtalert.com', 'testtest')
+        connection = runner.connection
+        runner.connection = FakeConnection()
+        try:
+            results = runner.run(self.start, self.until, concurrency=3,
+                                 importer_class=FakeImporter)
+            closed_by = runner.connection.closed_by
+        finally:
+            runner.connection = connection
+        self.assertEqual(sorted(FakeImporter.imported), [
+            ('clinics@txtalert.com', 'Broken'),
+            ('clinics@txtalert.com', 'Praekelt'),
+            ('partner@txtalert.com', 'Partner'),
+        ])
+        # the results are in the order of the accounts, newest first
+        self.assertEqual([(result.account.username, result.spreadsheet,
+                            result.failed) for result in results], [
+            ('empty@txtalert.com', None, True),
+            ('partner@txtalert.com', 'Partner', False),
+            ('clinics@txtalert.com', 'Praekelt', False),
+            ('clinics@txtalert.com', 'Broken', True),
+            ('wrong@txtalert.com', None, True),
+        ])
+        # every account's thread closed its database connection
+        self.assertEqual(len(closed_by), 4)
+        self.assertFalse(threading.current_thread() in closed_by)
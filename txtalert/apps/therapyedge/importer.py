@@ -1,9 +1,13 @@
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from txtalert.apps.therapyedge.xmlrpc.client import Client
-from txtalert.core.models import Patient, MSISDN, Visit, Clinic
+from txtalert.core.models import Patient, MSISDN, Visit, Clinic, ImportWatermark
+from txtalert.core.signals import (deferred_risk_profiles, counted_status,
+                                    status_delta, update_risk_profile, 
+                                    invalidate_visit_statistics)
 
 import iso8601
 import re
+import time
 import logging
 from datetime import datetime, date
 
@@ -22,6 +26,9 @@ MSISDN_RE = re.compile(r'[+]?(0|27)([0-9]{9})')
 IMPORT_CUTOFF = datetime(2009, 01, 01)
 IMPORT_DAY_INTERVAL = 10
 
+# maximum number of values passed in a single `__in` lookup when prefetching
+BULK_CHUNK_SIZE = 500
+
 MESSAGE_PATIENTID_INCONSISTENT = "Patient ID '%s' is inconsistent with previous ID '%s' for visit '%s'."
 MESSAGE_PATIENT_NOTFOUND = "Patient with the ID '%s' could not be found for visit '%s'."
 MESSAGE_VISIT_NOTFOUND = "Visit with the ID '%s' could not be found."
@@ -77,6 +84,74 @@ MSISDN_RE = re.compile(r'[+]?(0|27)([0-9]{9})')
 
 class VisitException(Exception): pass
 
+class ImportTimeout(Exception): pass
+
+
+def filter_in_chunks(queryset, field, values, size=BULK_CHUNK_SIZE):
+    """Iterate over all records in the queryset where `field` is in `values`,
+    splitting the `__in` lookup into chunks to stay clear of the database's
+    maximum number of query parameters"""
+    values = list(values)
+    for offset in range(0, len(values), size):
+        lookup = {'%s__in' % field: values[offset:offset + size]}
+        for record in queryset.filter(**lookup):
+            yield record
+
+
+def coming_visit_transition(visit, created, coming_date):
+    """Apply a coming visit's date to the visit, setting the status
+    accordingly. Returns False if nothing needs to change."""
+    # check if something actually changed in the visit, if not, immediately
+    # return - no use continuing
+    if coming_date == visit.date:
+        return False
+    
+    # it's a new visit
+    if created:
+        if coming_date <= date.today():
+            visit.status = 'm'
+        else:
+            visit.status = 's'
+    # it's an existing visit
+    else:
+        if coming_date > visit.date:
+            visit.status = 'r'
+        else:
+            visit.status = 'm'
+    visit.date = coming_date
+    return True
+
+
+def missed_visit_transition(visit, created, missed_date):
+    """Apply a missed visit's date to the visit, setting the status
+    accordingly. Returns False if nothing needs to change."""
+    # check if something actually changed in the visit, if not, immediately
+    # return - no use continuing
+    if missed_date == visit.date and visit.status == 'm':
+        return False
+    
+    # it's a new visit
+    if created:
+        if missed_date <= date.today():
+            visit.status = 'm'
+        else:
+            visit.status = 'r'
+    # it's an existing visit
+    else:
+        if missed_date > visit.date:
+            visit.status = 'r'
+        else:
+            visit.status = 'm'
+    visit.date = missed_date
+    return True
+
+
+def done_visit_transition(visit, created, done_date):
+    """Done events we flag as a for 'attended'"""
+    visit.status = 'a'
+    visit.date = done_date
+    return True
+
 
 class Update(object):
     def __init__(self, klass):
@@ -104,8 +179,21 @@ class Update(object):
 
 class Importer(object):
         
-    def __init__(self, uri=None, verbose=False):
-        self.client = Client(uri, verbose)
+    # the feeds fetched from TherapyEdge, in the order they're applied
+    FEEDS = (
+        ('updated_patients', 'get_updated_patients'),
+        ('coming_visits', 'get_coming_visits'),
+        ('missed_visits', 'get_missed_visits'),
+        ('done_visits', 'get_done_visits'),
+        ('deleted_visits', 'get_deleted_visits'),
+    )
+    
+    def __init__(self, uri=None, verbose=False, timeout=None):
+        self.client = Client(uri, verbose, timeout)
+        # number of remote records processed, used for reporting throughput
+        self.processed = 0
+        # number of remote records that failed to apply
+        self.failed = 0
     
     def import_all_patients(self, clinic):
         # all_patients = self.client.get_all_patients(clinic.te_id)
@@ -127,10 +215,12 @@ class Importer(object):
     
     def update_local_patients(self, user, remote_patients):
         for remote_patient in remote_patients:
+            self.processed += 1
             try:
                 yield self.update_local_patient(user, remote_patient)
             except IntegrityError, e:
                 logger.exception('Failed to create Patient for: %s' % (remote_patient,))
+                self.failed += 1
     
     def update_local_patient(self, owner, remote_patient):
         logger.debug('Processing: %s' % remote_patient._asdict())
@@ -158,34 +248,35 @@ class Importer(object):
         if created or updated:
             return patient
     
-    def import_coming_visits(self, user, clinic, since, until):
+    def import_coming_visits(self, user, clinic, since, until, bulk=False):
         coming_visits = self.client.get_coming_visits(clinic.te_id, since, until)
         logger.info('Receiving coming visits for %s between %s and %s' % (
             clinic.name,
             since,
             until
         ))
+        if bulk:
+            return self.bulk_update_local_coming_visits(user, clinic, coming_visits)
         return self.update_local_coming_visits(user, clinic, coming_visits)
     
     def update_local_coming_visits(self, user, clinic, visits):
         for visit in visits:
+            self.processed += 1
             logger.debug('Processing coming Visit %s' % visit._asdict())
             try:
                 yield self.update_local_coming_visit(user, clinic, visit)
             except IntegrityError, e:
                 logger.exception('Failed to create upcoming Visit')
+                self.failed += 1
             except Patient.DoesNotExist, e:
                 logger.exception('Could not find Patient for Visit.te_id')
+                self.failed += 1
     
     def update_local_coming_visit(self, owner, clinic, remote_visit):
         # I'm assuming we'll always have the patient being referenced
         # in the Visit object, if not - raise hell
         patient = Patient.objects.get(te_id=remote_visit.te_id, owner=owner)
-        coming_date = iso8601.parse_date(remote_visit.scheduled_visit_date)
-        
-        # FIXME:    a lot of duplication between update_local_coming_visit and
-        #           update_local_missed_visits with regard to the status of
-        #           of the messages.
+        coming_date = iso8601.parse_date(remote_visit.scheduled_visit_date).date()
         
         try:
             visit = Visit.objects.get(te_visit_id=remote_visit.key_id)
@@ -194,27 +285,11 @@ class Importer(object):
             visit = Visit(te_visit_id=remote_visit.key_id)
             created = True
         
-        # check if something actually changed in the visit, if not, immediately
-        # return the visit - no use continuing
-        if coming_date.date() == visit.date:
+        if not coming_visit_transition(visit, created, coming_date):
             return
         
-        # it's a new visit
-        if created:
-            if coming_date.date() <= date.today():
-                visit.status = 'm'
-            else:
-                visit.status = 's'
-        # it's an existing visit
-        else:
-            if coming_date.date() > visit.date:
-                visit.status = 'r'
-            else:
-                visit.status = 'm'
-        
         visit.clinic = clinic
         visit.patient = patient
-        visit.date = coming_date
         if visit.is_dirty():
             visit.save()
         
@@ -224,26 +299,32 @@ class Importer(object):
             logger.debug('Updating existing Visit: %s / (%s vs %s)' % (visit.id, visit.get_dirty_fields(), visit._original_state))
         return visit
     
-    def import_missed_visits(self, user, clinic, since, until):
+    def import_missed_visits(self, user, clinic, since, until, bulk=False):
         missed_visits = self.client.get_missed_visits(clinic.te_id, since, until)
         logger.info('Receiving missed visits for %s between %s and %s' % (
             clinic.name,
             since,
             until
         ))
+        if bulk:
+            return self.bulk_update_local_missed_visits(user, clinic, missed_visits)
         return self.update_local_missed_visits(user, clinic, missed_visits)
     
     def update_local_missed_visits(self, user, clinic, missed_visits):
         for visit in missed_visits:
+            self.processed += 1
             logger.debug('Processing missed Visit: %s' % visit._asdict())
             try:
                 yield self.update_local_missed_visit(user, clinic, visit)
             except IntegrityError, e:
                 logger.exception('Failed to create Visit')
+                self.failed += 1
             except Patient.DoesNotExist, e:
                 logger.exception('Could not find Patient for Visit.te_id')
+                self.failed += 1
             except VisitException, e:
                 logger.exception('VisitException')
+                self.failed += 1
     
     def update_local_missed_visit(self, owner, clinic, remote_visit):
         # get the patient or raise error
@@ -257,27 +338,11 @@ class Importer(object):
             visit = Visit(te_visit_id=remote_visit.key_id)
             created = True
         
-        # check if something actually changed in the visit, if not, immediately
-        # return the visit - no use continuing
-        if missed_date == visit.date and visit.status == 'm':
+        if not missed_visit_transition(visit, created, missed_date):
             return
         
-        # it's a new visit
-        if created:
-            if missed_date <= date.today():
-                visit.status = 'm'
-            else:
-                visit.status = 'r'
-        # it's an existing visit
-        else:
-            if missed_date > visit.date:
-                visit.status = 'r'
-            else:
-                visit.status = 'm'
-        
         visit.clinic = clinic
         visit.patient = patient
-        visit.date = missed_date
         if visit.is_dirty():
             visit.save()
         
@@ -292,24 +357,29 @@ class Importer(object):
         
         return visit
     
-    def import_done_visits(self, user, clinic, since, until):
+    def import_done_visits(self, user, clinic, since, until, bulk=False):
         done_visits = self.client.get_done_visits(clinic.te_id, since, until)
         logger.info('Receiving done visits for %s between %s and %s' % (
             clinic.name,
             since,
             until
         ))
+        if bulk:
+            return self.bulk_update_local_done_visits(user, clinic, done_visits)
         return self.update_local_done_visits(user, clinic, done_visits)
     
     def update_local_done_visits(self, user, clinic, remote_visits):
         for remote_visit in remote_visits:
+            self.processed += 1
             logger.debug('Processing done Visit: %s' % remote_visit._asdict())
             try:
                 yield self.update_local_done_visit(user, clinic, remote_visit)
             except IntegrityError, e:
                 logger.exception('Failed to create visit')
+                self.failed += 1
             except Patient.DoesNotExist, e:
                 logger.exception('Could not find Patient for Visit.te_id')
+                self.failed += 1
         
     
     def update_local_done_visit(self, owner, clinic, remote_visit):
@@ -341,6 +411,128 @@ class Importer(object):
             ))
             return visit
     
+    def prefetch(self, owner, remote_visits):
+        """Load all the patients & visits referenced by a batch of remote
+        visits with one `__in` query each. Returns two dicts, patients keyed by
+        `te_id` and visits keyed by `te_visit_id`."""
+        te_ids = set([remote_visit.te_id for remote_visit in remote_visits])
+        key_ids = set([remote_visit.key_id for remote_visit in remote_visits])
+        patients = dict([(patient.te_id, patient) for patient in
+            filter_in_chunks(Patient.objects.filter(owner=owner), 'te_id',
+                                te_ids)])
+        visits = dict([(visit.te_visit_id, visit) for visit in
+            filter_in_chunks(Visit.objects.all(), 'te_visit_id', key_ids)])
+        return patients, visits
+    
+    def bulk_update_local_visits(self, owner, clinic, remote_visits, 
+                                    date_field, transition):
+        """Reconcile a batch of remote visits in one go. All the patients and
+        visits referenced are prefetched, the status transitions are computed
+        in memory and written back in one transaction; new visits are 
+        inserted, changed visits are updated grouped by the values that 
+        changed. Should leave `Visit.status` and `Visit.date` in exactly the
+        same state as the per-row `update_local_*_visit` methods would.
+        
+        Returns the list of visits created or updated."""
+        remote_visits = list(remote_visits)
+        patients, visits = self.prefetch(owner, remote_visits)
+        created, changed = [], {}
+        for remote_visit in remote_visits:
+            self.processed += 1
+            patient = patients.get(remote_visit.te_id)
+            if patient is None:
+                logger.error('Could not find Patient for Visit.te_id %s' % 
+                                remote_visit.te_id)
+                self.failed += 1
+                continue
+            
+            visit = visits.get(remote_visit.key_id)
+            is_new = visit is None
+            if is_new:
+                visit = Visit(te_visit_id=remote_visit.key_id)
+                visits[remote_visit.key_id] = visit
+                created.append(visit)
+            
+            visit_date = iso8601.parse_date(
+                                getattr(remote_visit, date_field)).date()
+            if not transition(visit, is_new, visit_date):
+                continue
+            
+            visit.clinic = clinic
+            visit.patient = patient
+            if visit.pk:
+                changed[visit.pk] = visit
+        
+        updated = [visit for visit in changed.values() if visit.is_dirty()]
+        self.write_visits(created, updated)
+        return [visit for visit in created if visit.pk] + updated
+    
+    @transaction.commit_on_success
+    def write_visits(self, created, updated):
+        """Insert the new visits and write the changed ones back with one
+        UPDATE per distinct set of changed values. Grouped updates don't fire
+        the `post_save` signals so the history records are written explicitly
+        and the risk profile is adjusted and the visit statistics are marked
+        stale once per affected patient."""
+        # Django 1.3 has no bulk insert, these are individual INSERTs but
+        # they all go out in the same transaction
+        for visit in created:
+            sid = transaction.savepoint()
+            try:
+                visit.save()
+                transaction.savepoint_commit(sid)
+            except IntegrityError, e:
+                transaction.savepoint_rollback(sid)
+                visit.pk = None
+                self.failed += 1
+                logger.exception('Failed to create Visit %s' % 
+                                    visit.te_visit_id)
+        
+        now = datetime.now()
+        groups, deltas = {}, {}
+        for visit in updated:
+            dirty = visit.get_dirty_fields()
+            missed, attended = status_delta(
+                counted_status(dirty.get('status', visit.status), 
+                                dirty.get('deleted', visit.deleted)),
+                counted_status(visit.status, visit.deleted))
+            delta = deltas.setdefault(visit.patient_id, [0, 0])
+            delta[0] += missed
+            delta[1] += attended
+            
+            values = dirty.keys()
+            values = dict([(key, getattr(visit, key)) for key in values])
+            values['clinic'] = visit.clinic_id
+            values['patient'] = visit.patient_id
+            groups.setdefault(tuple(sorted(values.items())), []).append(visit)
+        
+        for values, visits in groups.items():
+            Visit.objects.filter(pk__in=[visit.pk for visit in visits]) \
+                .update(updated_at=now, **dict(values))
+            for visit in visits:
+                visit.updated_at = now
+                Visit.history.create(history_type='~', **dict([
+                    (field.attname, getattr(visit, field.attname))
+                        for field in visit._meta.fields]))
+                visit._reset_state()
+        
+        for patient_id, (missed, attended) in deltas.items():
+            if missed or attended:
+                update_risk_profile(patient_id, missed, attended)
+        invalidate_visit_statistics(deltas.keys())
+    
+    def bulk_update_local_coming_visits(self, user, clinic, visits):
+        return self.bulk_update_local_visits(user, clinic, visits, 
+                            'scheduled_visit_date', coming_visit_transition)
+    
+    def bulk_update_local_missed_visits(self, user, clinic, missed_visits):
+        return self.bulk_update_local_visits(user, clinic, missed_visits, 
+                            'missed_date', missed_visit_transition)
+    
+    def bulk_update_local_done_visits(self, user, clinic, remote_visits):
+        return self.bulk_update_local_visits(user, clinic, remote_visits, 
+                            'done_date', done_visit_transition)
+    
     def import_deleted_visits(self, user, clinic, since, until):
         deleted_visits = self.client.get_deleted_visits(clinic.te_id, since, until)
         logger.info('Receiving deleted visits between %s and %s' % (
@@ -351,11 +543,13 @@ class Importer(object):
     
     def update_local_deleted_visits(self, user, remote_visits):
         for remote_visit in remote_visits:
+            self.processed += 1
             logger.debug('Processing deleted Visit: %s' % remote_visit._asdict())
             try:
                 yield self.update_local_deleted_visit(user, remote_visit)
             except Visit.DoesNotExist, e:
                 logger.exception('Could not find Visit to delete')
+                self.failed += 1
     
     def update_local_deleted_visit(self, owner, remote_visit):
         visit = Visit.objects.get(te_visit_id=remote_visit.key_id, patient__owner=owner)
@@ -363,16 +557,81 @@ class Importer(object):
         logger.debug('Deleted Visit: %s' % visit.id)
         return visit
     
-    def import_all_changes(self, user, clinic, since, until):
-        # I set these because they all are generators, listing them forces
-        # them to be iterated over
-        return {
-            # 'all_patients': list(self.import_all_patients(clinic)),
-            'updated_patients': filter(None, self.import_updated_patients(user, clinic, since, until)),
-            'coming_visits': filter(None, self.import_coming_visits(user, clinic, since, until)),
-            'missed_visits': filter(None, self.import_missed_visits(user, clinic, since, until)),
-            'done_visits': filter(None, self.import_done_visits(user, clinic, since, until)),
-            'deleted_visits': filter(None, self.import_deleted_visits(user, clinic, since, until))
+    def fetch_all_changes(self, clinic, since, until, deadline=None):
+        """Fetch all the feeds for a clinic from TherapyEdge without touching
+        the database, this is safe to call from a worker thread. If a 
+        `deadline` (as a `time.time()` value) is given and is passed before
+        all feeds have been fetched an `ImportTimeout` is raised."""
+        changes = {}
+        for key, method in self.FEEDS:
+            if deadline and time.time() > deadline:
+                raise ImportTimeout, 'Timed out fetching %s for %s' % (key, 
+                                                                clinic.name)
+            changes[key] = list(getattr(self.client, method)(clinic.te_id, 
+                                                                since, until))
+            logger.info('Received %s %s for %s between %s and %s' % (
+                len(changes[key]),
+                key,
+                clinic.name,
+                since,
+                until
+            ))
+        return changes
+    
+    def update_all_changes(self, user, clinic, changes, bulk=False, 
+                            until=None, force=False):
+        """Apply the feeds as returned by `fetch_all_changes` to the local
+        database. A feed whose payload is identical to the one received in
+        the previous run for this clinic is skipped unless `force` is set,
+        the clinic's watermarks are advanced to `until` as feeds are applied.
+        A feed with records that failed to apply isn't advanced and its hash
+        is forgotten, so it is applied again on the next run."""
+        if bulk:
+            coming, missed, done = (self.bulk_update_local_coming_visits,
+                                    self.bulk_update_local_missed_visits,
+                                    self.bulk_update_local_done_visits)
+        else:
+            coming, missed, done = (self.update_local_coming_visits,
+                                    self.update_local_missed_visits,
+                                    self.update_local_done_visits)
+        updaters = {
+            'updated_patients': lambda records: self.update_local_patients(user, records),
+            'coming_visits': lambda records: coming(user, clinic, records),
+            'missed_visits': lambda records: missed(user, clinic, records),
+            'done_visits': lambda records: done(user, clinic, records),
+            'deleted_visits': lambda records: self.update_local_deleted_visits(user, records),
         }
+        
+        watermarks = ImportWatermark.objects.for_clinic(clinic)
+        results = {}
+        # the risk profiles are adjusted once per patient after all the 
+        # feeds have been applied rather than for every visit saved
+        with deferred_risk_profiles():
+            for key, method in self.FEEDS:
+                content_hash = ImportWatermark.hash_payload(changes[key])
+                watermark = watermarks.get(key, 
+                                ImportWatermark(clinic=clinic, feed=key))
+                if watermark.is_unchanged(content_hash) and not force:
+                    logger.info('Skipping unchanged %s for %s' % (key, 
+                                                                clinic.name))
+                    results[key] = []
+                else:
+                    failed = self.failed
+                    results[key] = filter(None, 
+                                            updaters[key](changes[key]))
+                    if self.failed > failed:
+                        logger.error('%s of the %s for %s failed, retrying '
+                                        'next run' % (self.failed - failed,
+                                                        key, clinic.name))
+                        watermark.forget()
+                        continue
+                watermark.advance(until, content_hash)
+        return results
+    
+    def import_all_changes(self, user, clinic, since, until, bulk=False, 
+                            force=False):
+        return self.update_all_changes(user, clinic, 
+            self.fetch_all_changes(clinic, since, until), bulk=bulk, 
+            until=until, force=force)
     
     
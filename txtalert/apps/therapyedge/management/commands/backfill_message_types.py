@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from txtalert.apps.therapyedge import reminders
+
+class Command(BaseCommand):
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', dest='batch', type='int', 
+            default=reminders.REMINDER_BATCH_SIZE,
+            help='Number of messages classified at a time.'),
+    )
+    help = "Tags the messages sent before reminders were tagged with their " \
+            "message type by matching their text against the message types."
+    
+    def handle(self, *args, **options):
+        tagged, untagged = reminders.backfill_message_types(options['batch'])
+        print 'Tagged %s messages, %s left untagged' % (tagged, untagged)
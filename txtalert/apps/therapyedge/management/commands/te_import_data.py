@@ -4,53 +4,66 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 from optparse import make_option
 from txtalert.apps.general.settings.models import Setting
-from txtalert.apps.therapyedge.importer import Importer
+from txtalert.apps.therapyedge.scheduler import ImportScheduler
 from txtalert.core.models import Clinic
-from xml.parsers.expat import ExpatError
-import sys, traceback
+import sys, time
 
 class Command(BaseCommand):
     help = "Can be run as a cronjob or directly to send import TherapyEdge data."
     option_list = BaseCommand.option_list + (
         make_option('--username', dest='username',
             help='Specifies the user to import for.'),
+        make_option('--bulk', dest='bulk', action='store_true', default=False,
+            help='Reconcile visits in bulk instead of row by row.'),
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of clinics to fetch from TherapyEdge concurrently.'),
+        make_option('--timeout', dest='timeout', type='int', default=300,
+            help='Seconds allowed for each call to TherapyEdge, a clinic '
+                    'gives up fetching after twice this.'),
+        make_option('--force', dest='force', action='store_true', 
+            default=False, help='Apply feeds even if they are unchanged '
+                                'since the previous run.'),
     )
     
     def handle(self, *args, **kwargs):
-        importer = Importer(
+        scheduler = ImportScheduler(
             uri='https://%s:%s@41.0.13.99/tools/ws/sms/patients/server.php' % (
                 Setting.objects.get(name='THERAPYEDGE_USERNAME').value,
                 Setting.objects.get(name='THERAPYEDGE_PASSWORD').value
             ),
-            verbose=settings.DEBUG
+            verbose=settings.DEBUG,
+            workers=kwargs.get('workers'),
+            timeout=kwargs.get('timeout')
         )
         username = kwargs.get('username')
         if not username:
             sys.exit('Please provide --username')
         
         user = User.objects.get(username=username)
-        for clinic in Clinic.objects.filter(active=True, user=user):
-            # from midnight
-            midnight = datetime.now().replace(
-                hour=0,
-                minute=0,
-                second=0,
-                microsecond=0
-            )
-            since = midnight - timedelta(days=1)
-            # until 30 days later
-            until = midnight + timedelta(days=30)
+        # from midnight
+        midnight = datetime.now().replace(
+            hour=0,
+            minute=0,
+            second=0,
+            microsecond=0
+        )
+        since = midnight - timedelta(days=1)
+        # until 30 days later
+        until = midnight + timedelta(days=30)
+        
+        start, total = time.time(), 0
+        for clinic, results, exception, processed in scheduler.run(user, 
+                Clinic.objects.filter(active=True, user=user), since=since,
+                until=until, bulk=kwargs.get('bulk'),
+                force=kwargs.get('force')):
             print clinic.name, 'from', since, 'until', until
-            try:
-                for key, value in importer.import_all_changes(
-                        user,
-                        clinic, 
-                        since=since,
-                        until=until
-                    ).items():
-                    print "\t%s: %s" % (key, len(value))
-            except ExpatError, e:
-                print "Exception during processing XML for clinic ", clinic
-                traceback.print_exc()
-            
-                
\ No newline at end of file
+            if exception:
+                print "\tFailed importing clinic %s: %r" % (clinic, exception)
+                continue
+            for key, value in results.items():
+                print "\t%s: %s" % (key, len(value))
+            total += processed
+        
+        elapsed = time.time() - start
+        print "%s rows in %.2fs (%.1f rows/s)" % (total, elapsed,
+            total / max(elapsed, 0.001))
@@ -18,7 +18,8 @@ from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.core import mail
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import User, Group
+from django.db.models import Q
 
 from txtalert.apps.general.settings.models import Setting
 from txtalert.apps.gateway.models import SendSMS
@@ -47,14 +48,96 @@ Pending in 2 weeks- %(two_weeks)s
 """
 
 
+# the number of SMSs handed to the gateway in one go
+REMINDER_BATCH_SIZE = 500
+
+
 from itertools import groupby
 def group_by_language(patients):
     grouper = lambda patient: patient.language
+    # groupby only groups consecutive patients
+    patients = sorted(patients, key=lambda patient: patient.language_id)
     return dict(
         [(language, list(patients_per_language)) for \
                 language, patients_per_language in groupby(patients, grouper)]
     )
 
+def chunks(items, size=None):
+    size = size or REMINDER_BATCH_SIZE
+    items = list(items)
+    for offset in range(0, len(items), size):
+        yield items[offset:offset + size]
+
+def get_message_types(group):
+    """Load all the message types for a group with one query, keyed by 
+    (name, language_id)"""
+    return dict([((message_type.name, message_type.language_id), message_type)
+                    for message_type in MessageType.objects.filter(group=group)])
+
+def get_message_type(message_types, name, language_id):
+    try:
+        return message_types[(name, language_id)]
+    except KeyError:
+        raise MessageType.DoesNotExist('No %s MessageType for language %s' % (
+                                        name, language_id))
+
+def tag_message_type(send_smses, message_type):
+    """Record which message type the SendSMS records were sent for, with a 
+    single UPDATE. Returns the SendSMS records as a list."""
+    send_smses = list(send_smses)
+    SendSMS.objects.filter(pk__in=[send_sms.pk for send_sms in send_smses]) \
+        .update(message_type=message_type)
+    for send_sms in send_smses:
+        send_sms.message_type = message_type
+    return send_smses
+
+def message_type_prefix(message):
+    """The part of a message type's text that doesn't depend on the patient
+    or the date, everything up to the first placeholder"""
+    return message.split('%(')[0].strip()
+
+def backfill_message_types(batch_size=None):
+    """Tag SendSMS records sent before they were tagged with the message
+    type whose text they start with. Only the message types of the groups
+    the sending user is in are considered, the longest match wins. Returns
+    a tuple with the number of records tagged and left untagged."""
+    batch_size = batch_size or REMINDER_BATCH_SIZE
+    prefixes_per_group = {}
+    for pk, group_id, message in MessageType.objects.values_list('pk', 
+                                                        'group', 'message'):
+        prefix = message_type_prefix(message)
+        if prefix:
+            prefixes_per_group.setdefault(group_id, []).append((prefix, pk))
+    prefixes_per_user = {}
+    for user_id, group_id in User.objects.filter(groups__isnull=False) \
+                                .values_list('pk', 'groups'):
+        prefixes_per_user.setdefault(user_id, []).extend(
+                                        prefixes_per_group.get(group_id, []))
+    for prefixes in prefixes_per_user.values():
+        prefixes.sort(key=lambda (prefix, pk): len(prefix), reverse=True)
+    
+    tagged = untagged = last_pk = 0
+    while True:
+        send_smses = list(SendSMS.objects.filter(message_type__isnull=True,
+                            pk__gt=last_pk).order_by('pk').values_list('pk',
+                            'user', 'smstext')[:batch_size])
+        if not send_smses:
+            break
+        last_pk = send_smses[-1][0]
+        matches = {}
+        for pk, user_id, smstext in send_smses:
+            for prefix, message_type_id in prefixes_per_user.get(user_id, []):
+                if smstext.startswith(prefix):
+                    matches.setdefault(message_type_id, []).append(pk)
+                    break
+            else:
+                untagged += 1
+        for message_type_id, pks in matches.items():
+            SendSMS.objects.filter(pk__in=pks).update(
+                                            message_type=message_type_id)
+            tagged += len(pks)
+    return tagged, untagged
+
 def send_stats(gateway, group_names, today):
     for group in Group.objects.filter(name__in=group_names):
         send_stats_for_group(gateway, today, group)
@@ -115,22 +198,24 @@ def send_stats_for_group(gateway, today, group):
     
 
 
-def send_messages(gateway, group, user, message_key, patients, message_formatter=lambda x: x):
+def send_messages(gateway, group, user, message_key, patients, message_formatter=lambda x: x, message_types=None):
+    if message_types is None:
+        message_types = get_message_types(group)
     send_sms_per_language = {}
     for language, patients in group_by_language(patients).items():
         # We only can send messages to patients with an active msisdn
-        patients = filter(lambda p:p.active_msisdn, patients)
-        message_type = MessageType.objects.get(group=group, name=message_key,
-            language=language)
+        patients = filter(lambda p:p.active_msisdn_id, patients)
+        message_type = get_message_type(message_types, message_key, 
+                                        language and language.pk)
         message = message_formatter(message_type.message)
         # we make a set out of it to avoid having duplicate MSISDNs, this can
         # happen if a patient has two different visits on the same day
         msisdns = set([patient.active_msisdn.msisdn for patient in patients])
-        send_sms_per_language[language] = gateway.send_sms(
-            user,
-            msisdns, 
-            [message] * len(msisdns)
-        )
+        send_sms_per_language[language] = []
+        for batch in chunks(msisdns):
+            send_sms_per_language[language].extend(tag_message_type(
+                gateway.send_sms(user, batch, [message] * len(batch)),
+                message_type))
     return send_sms_per_language
 
 def tomorrow(gateway, group, user, visits, today):
@@ -188,18 +273,67 @@ def missed(gateway, group, user, visits, today):
     )
 
 
+# the order in which the reminders are sent out
+REMINDER_KEYS = ('tomorrow_message', 'twoweeks_message', 'attended_message',
+                    'missed_message')
+
+def reminder_cohorts(group, today):
+    """Find the patients that need a reminder for all users in the group in
+    one pass over Visit. Returns a dict of msisdns keyed by (user_id, 
+    message_key, language_id)"""
+    yesterday = today - timedelta(days=1)
+    tomorrow = today + timedelta(days=1)
+    twoweeks = today + timedelta(weeks=2)
+    
+    visits = Visit.objects.filter(
+        Q(date=tomorrow) | Q(date=twoweeks) | 
+        Q(date=yesterday, status__in=['a', 'm']),
+        patient__opted_in=True,
+        patient__owner__in=group.user_set.all(),
+        # We only can send messages to patients with an active msisdn
+        patient__active_msisdn__isnull=False,
+    ).values_list('patient__owner', 'patient__language', 
+                    'patient__active_msisdn__msisdn', 'date', 'status')
+    
+    cohorts = {}
+    for user_id, language_id, msisdn, visit_date, status in visits.iterator():
+        if visit_date == tomorrow:
+            message_key = 'tomorrow_message'
+        elif visit_date == twoweeks:
+            message_key = 'twoweeks_message'
+        elif status == 'a':
+            message_key = 'attended_message'
+        else:
+            message_key = 'missed_message'
+        # sets avoid duplicate MSISDNs, this can happen if a patient has two 
+        # different visits on the same day
+        cohorts.setdefault((user_id, message_key, language_id), set()).add(
+                                                                        msisdn)
+    return cohorts
+
 def all(gateway, group_names):
     groups = Group.objects.filter(name__in=group_names)
     for group in groups:
+        today = datetime.now().date()
+        twoweeks = today + timedelta(weeks=2)
+        formatters = {
+            'twoweeks_message': lambda msg: msg % {
+                                    'date': twoweeks.strftime('%A %d %b')},
+        }
+        message_types = get_message_types(group)
+        cohorts = reminder_cohorts(group, today)
         for user in group.user_set.all():
-            visits = Visit.objects.filter(patient__opted_in=True,
-                                            patient__owner=user)
-            today = datetime.now().date()
-            logger.debug('Sending reminders for %s: tomorrow' % user)
-            tomorrow(gateway, group, user, visits, today)
-            logger.debug('Sending reminders for %s: two weeks' % user)
-            two_weeks(gateway, group, user, visits, today)
-            logger.debug('Sending reminders for %s: attended yesterday' % user)
-            attended(gateway, group, user, visits, today)
-            logger.debug('Sending reminders for %s: missed yesterday' % user)
-            missed(gateway, group, user, visits, today)
+            for message_key in REMINDER_KEYS:
+                logger.debug('Sending reminders for %s: %s' % (user, 
+                                                                message_key))
+                for (user_id, key, language_id), msisdns in cohorts.items():
+                    if user_id != user.pk or key != message_key:
+                        continue
+                    message_type = get_message_type(message_types, 
+                                                    message_key, language_id)
+                    formatter = formatters.get(message_key, lambda msg: msg)
+                    message = formatter(message_type.message)
+                    for batch in chunks(msisdns):
+                        tag_message_type(gateway.send_sms(user, batch, 
+                                            [message] * len(batch)),
+                                            message_type)
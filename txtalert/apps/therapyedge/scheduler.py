@@ -0,0 +1,107 @@
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+from txtalert.apps.therapyedge.importer import Importer, ImportTimeout
+from txtalert.core.models import ImportWatermark
+
+import time
+import logging
+
+logger = logging.getLogger("importer")
+
+class ImportScheduler(object):
+    """Runs the TherapyEdge imports for a number of clinics. The feeds for
+    each clinic are fetched from a bounded pool of worker threads, each with
+    its own XML-RPC client, since the import window is mostly spent waiting
+    on the network. The fetched feeds are applied to the database one clinic
+    at a time in the calling thread, in the order the fetches complete.
+
+    A clinic that fails to fetch is reported and skipped, it doesn't hold up
+    the other clinics. The `timeout` is checked before every feed and is
+    also the socket timeout of every call, so a clinic that is slow to
+    respond gives up after at most twice the `timeout`. The fetches are
+    waited for no longer than that for every `workers` clinics, a clinic
+    whose worker is stuck beyond it is reported as timed out."""
+
+    def __init__(self, uri=None, verbose=False, workers=4, timeout=300,
+                    importer_class=Importer):
+        self.uri = uri
+        self.verbose = verbose
+        self.workers = workers
+        self.timeout = timeout
+        self.importer_class = importer_class
+
+    def create_importer(self):
+        return self.importer_class(uri=self.uri, verbose=self.verbose,
+                                    timeout=self.timeout)
+
+    def fetch_timeout(self, clinics):
+        """The seconds to wait for the fetches of all the clinics, each
+        round of `workers` clinics takes at most twice the `timeout`"""
+        rounds = (len(clinics) + self.workers - 1) // self.workers
+        return 2 * self.timeout * max(rounds, 1)
+
+    def fetch(self, clinic, since, until):
+        """Runs in a worker thread, returns a tuple of (changes, exception)
+        so that a failing clinic doesn't take down the pool."""
+        deadline = time.time() + self.timeout
+        try:
+            importer = self.create_importer()
+            return importer.fetch_all_changes(clinic, since, until,
+                                                deadline=deadline), None
+        except Exception, e:
+            logger.exception('Failed to fetch changes for %s' % clinic.name)
+            return None, e
+
+    def run(self, user, clinics, since, until, bulk=False, force=False):
+        """Import all changes for the given clinics. Yields a tuple of
+        (clinic, results, exception, processed) for each clinic as it is
+        completed. `results` is the dict as returned by
+        `Importer.import_all_changes` or None if the clinic failed.
+
+        Clinics for which runs have been missed are imported from the day
+        of their last successful import instead of `since`."""
+        clinics = list(clinics)
+        deadline = time.time() + self.fetch_timeout(clinics)
+        pending = set(clinics)
+        queue = Queue()
+        pool = ThreadPool(min(self.workers, len(clinics)) or 1)
+        try:
+            for clinic in clinics:
+                clinic_since = ImportWatermark.objects.since(clinic, since)
+                pool.apply_async(self.fetch, (clinic, clinic_since, until),
+                    callback=lambda result, clinic=clinic: queue.put(
+                                                    (clinic,) + result))
+            pool.close()
+
+            while pending:
+                try:
+                    clinic, changes, exception = queue.get(
+                                timeout=max(deadline - time.time(), 0))
+                except Empty:
+                    break
+                pending.discard(clinic)
+                if exception:
+                    yield clinic, None, exception, 0
+                    continue
+
+                importer = self.create_importer()
+                try:
+                    results = importer.update_all_changes(user, clinic,
+                                changes, bulk=bulk, until=until, force=force)
+                except Exception, e:
+                    logger.exception('Failed to update changes for %s' %
+                                        clinic.name)
+                    yield clinic, None, e, importer.processed
+                    continue
+                yield clinic, results, None, importer.processed
+
+            for clinic in pending:
+                logger.error('Timed out fetching changes for %s' %
+                                clinic.name)
+                yield clinic, None, ImportTimeout('Timed out fetching '
+                                            'changes for %s' % clinic.name), 0
+        finally:
+            # terminating the pool waits for its threads, leave stuck ones
+            # behind rather than hang the import
+            if not pending:
+                pool.terminate()
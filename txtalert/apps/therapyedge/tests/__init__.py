@@ -1,3 +1,4 @@
 from importing import *
 from importer import *
 from reminders import *
+from scheduler import *
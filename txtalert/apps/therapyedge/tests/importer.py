@@ -2,10 +2,12 @@ from django.test import TestCase
 from django.contrib.auth.models import User
 from txtalert.apps.therapyedge.importer import Importer, SEX_MAP
 from txtalert.apps.therapyedge.xmlrpc import client
-from txtalert.core.models import Patient, MSISDN, Visit, Clinic
+from txtalert.core.models import Patient, MSISDN, Visit, Clinic, ImportWatermark
 from txtalert.apps.therapyedge.tests.utils import (PatientUpdate, ComingVisit, MissedVisit,
                                         DoneVisit, DeletedVisit, create_instance)
 from datetime import datetime, timedelta, date
+from StringIO import StringIO
+import xmlrpclib
 import random
 import logging
 import iso8601
@@ -374,6 +376,158 @@ class ImporterTestCase(TestCase):
     
 
 
+    def test_bulk_update_local_visits(self):
+        """the bulk reconciliation should end up in the same state as the 
+        per-row import"""
+        patients = Patient.objects.all()
+        coming_visits = map(ComingVisit._make, [(
+            '', '', 'false',
+            '%s 00:00:00' % (date.today() + timedelta(days=(idx+1))),
+            '02-00089421%s' % idx,
+            patient.te_id,
+        ) for idx, patient in enumerate(patients)])
+        local_visits = self.importer.bulk_update_local_coming_visits(
+            self.user, self.clinic, coming_visits)
+        self.assertEquals(len(local_visits), patients.count())
+        for coming_visit in coming_visits:
+            local_visit = Visit.objects.get(te_visit_id=coming_visit.key_id)
+            self.assertEquals(local_visit.status, 's')
+            self.assertEquals(local_visit.history.count(), 1)
+        
+        # reschedules for the first half, missed in the past for the rest
+        future_date = date.today() + timedelta(days=7)
+        past_date = date.today() - timedelta(days=7)
+        missed_visits = map(MissedVisit._make, [(
+            '', '',
+            '%s 00:00:00' % (future_date if idx % 2 else past_date),
+            '',
+            '02-00089421%s' % idx,
+            patient.te_id,
+        ) for idx, patient in enumerate(patients)])
+        local_visits = self.importer.bulk_update_local_missed_visits(
+            self.user, self.clinic, missed_visits)
+        self.assertEquals(len(local_visits), patients.count())
+        for idx, missed_visit in enumerate(missed_visits):
+            local_visit = Visit.objects.get(te_visit_id=missed_visit.key_id)
+            self.assertEquals(local_visit.status, 'r' if idx % 2 else 'm')
+            self.assertEquals(local_visit.date, 
+                                future_date if idx % 2 else past_date)
+            self.assertEquals(local_visit.history.count(), 2)
+        
+        # sending the same batch again shouldn't change anything
+        self.assertEquals(self.importer.bulk_update_local_missed_visits(
+            self.user, self.clinic, missed_visits[::2]), [])
+        
+        done_visits = map(DoneVisit._make, [(
+            '%s 00:00:00' % past_date, '', '', '', 
+            '%s 00:00:00' % past_date,
+            '02-00089421%s' % idx,
+            patient.te_id,
+        ) for idx, patient in enumerate(patients)])
+        local_visits = self.importer.bulk_update_local_done_visits(
+            self.user, self.clinic, done_visits)
+        for done_visit in done_visits:
+            local_visit = Visit.objects.get(te_visit_id=done_visit.key_id)
+            self.assertEquals(local_visit.status, 'a')
+            self.assertEquals(local_visit.date, past_date)
+        
+        # the risk profile is recalculated once per patient at the end
+        for patient in Patient.objects.all():
+            self.assertNotEquals(patient.risk_profile, None)
+    
+    def test_bulk_update_skips_unknown_patients(self):
+        coming_visits = map(ComingVisit._make, [
+            ('', '', 'false', '2009-11-10 00:00:00', '02-000894210', 
+                '02-00000'),
+        ])
+        self.assertEquals(self.importer.bulk_update_local_coming_visits(
+            self.user, self.clinic, coming_visits), [])
+        self.assertEquals(self.importer.processed, 1)
+        self.assertFalse(Visit.objects.filter(
+                            te_visit_id='02-000894210').exists())
+    
+    def test_unchanged_feeds_are_skipped(self):
+        coming_visits = map(ComingVisit._make, [(
+            '', '', 'false', '2009-11-1%s 00:00:00' % idx,
+            '02-00089421%s' % idx,
+            patient.te_id,
+        ) for idx, patient in enumerate(Patient.objects.all())])
+        changes = {
+            'updated_patients': [],
+            'coming_visits': coming_visits,
+            'missed_visits': [],
+            'done_visits': [],
+            'deleted_visits': [],
+        }
+        until = datetime(2009, 12, 1)
+        results = self.importer.update_all_changes(self.user, self.clinic, 
+                                                    changes, until=until)
+        self.assertEquals(len(results['coming_visits']), len(coming_visits))
+        watermark = ImportWatermark.objects.get(clinic=self.clinic, 
+                                                feed='coming_visits')
+        self.assertEquals(watermark.until, until)
+        
+        # the same payload in a different order is skipped
+        changes['coming_visits'] = list(reversed(coming_visits))
+        Visit.objects.all().update(status='a')
+        results = self.importer.update_all_changes(self.user, self.clinic, 
+                                                    changes, until=until)
+        self.assertEquals(results['coming_visits'], [])
+        self.assertFalse(Visit.objects.exclude(status='a').exists())
+        
+        # unless forced
+        Visit.objects.all().update(date=date(2009, 1, 1))
+        results = self.importer.update_all_changes(self.user, self.clinic, 
+                                            changes, until=until, force=True)
+        self.assertEquals(len(results['coming_visits']), len(coming_visits))
+    
+    def test_failed_feeds_are_retried(self):
+        coming_visits = map(ComingVisit._make, [
+            ('', '', 'false', '2009-11-10 00:00:00', '02-000894210', 
+                '02-00000'),
+        ])
+        changes = {
+            'updated_patients': [],
+            'coming_visits': coming_visits,
+            'missed_visits': [],
+            'done_visits': [],
+            'deleted_visits': [],
+        }
+        until = datetime(2009, 12, 1)
+        watermark = ImportWatermark.objects.create(clinic=self.clinic, 
+            feed='coming_visits', until=datetime(2009, 11, 1),
+            content_hash='stale')
+        self.importer.update_all_changes(self.user, self.clinic, changes, 
+                                            until=until, bulk=True)
+        self.assertEquals(self.importer.failed, 1)
+        # the patient is unknown, the watermark isn't advanced and the
+        # same payload is applied again on the next run
+        watermark = ImportWatermark.objects.get(pk=watermark.pk)
+        self.assertEquals(watermark.until, datetime(2009, 11, 1))
+        self.assertEquals(watermark.content_hash, '')
+        self.importer.update_all_changes(self.user, self.clinic, changes, 
+                                            until=until)
+        self.assertEquals(self.importer.failed, 2)
+        # the other feeds applied cleanly
+        self.assertEquals(ImportWatermark.objects.get(clinic=self.clinic,
+                            feed='missed_visits').until, until)
+    
+    def test_watermark_catch_up(self):
+        since = datetime.now().replace(hour=0, minute=0, second=0, 
+                                        microsecond=0) - timedelta(days=1)
+        self.assertEquals(ImportWatermark.objects.since(self.clinic, since), 
+                            since)
+        watermark = ImportWatermark.objects.create(clinic=self.clinic, 
+                                                    feed='coming_visits')
+        # pretend the last successful import was a week ago
+        ImportWatermark.objects.filter(pk=watermark.pk).update(
+            updated_at=datetime.now() - timedelta(days=7))
+        self.assertEquals(ImportWatermark.objects.since(self.clinic, since), 
+                            since - timedelta(days=6))
+        self.assertEquals(ImportWatermark.objects.since(self.clinic, 
+            since.date()), since.date() - timedelta(days=6))
+    
+
 class PatchedClient(client.Client): 
     def __init__(self, **kwargs):
         self.patches = kwargs
@@ -515,3 +669,53 @@ class ImporterXmlRpcClientTestCase(TestCase):
         self.assertTrue(isinstance(deleted_visits[0], Visit))
     
 
+
+class MockResponse(object):
+    """Mimicks the httplib response handed to the transport"""
+    def __init__(self, body):
+        self.stream = StringIO(body)
+    
+    def getheader(self, name, default=None):
+        return default
+    
+    def read(self, size):
+        return self.stream.read(size)
+    
+
+class StreamingTransportTestCase(TestCase):
+    
+    def setUp(self):
+        self.transport = client.StreamingTransport()
+        self.transport.chunk_size = 64
+        self.records = [{
+            'dr_site_name': '',
+            'dr_site_id': '',
+            'dr_status': 'false',
+            'scheduled_visit_date': '2009-11-1%s 00:00:00' % i,
+            'key_id': '02-1234%s' % i,
+            'te_id': '02-1234%s' % i,
+        } for i in range(10)]
+    
+    def test_records_are_streamed(self):
+        response = MockResponse(xmlrpclib.dumps((self.records,), 
+                                                    methodresponse=True))
+        records = self.transport.parse_response(response)[0]
+        self.assertEquals(records.next(), self.records[0])
+        # the first record is available before the response has been read
+        self.assertTrue(response.stream.tell() < len(response.stream.getvalue()))
+        self.assertEquals(list(records), self.records[1:])
+    
+    def test_fault(self):
+        response = MockResponse(xmlrpclib.dumps(xmlrpclib.Fault(1, 'oops'), 
+                                                    methodresponse=True))
+        self.assertRaises(xmlrpclib.Fault, list, 
+                            self.transport.parse_response(response)[0])
+    
+    def test_create_instances(self):
+        patched_client = PatchedClient(comingvisits=iter(self.records))
+        visits = list(patched_client.get_coming_visits('01'))
+        self.assertEquals(len(visits), len(self.records))
+        self.assertEquals(visits[0].__class__.__name__, 'ComingVisit')
+        self.assertEquals(visits[0].key_id, self.records[0]['key_id'])
+        self.assertEquals(list(PatchedClient(comingvisits=iter([]))
+                                .get_coming_visits('01')), [])
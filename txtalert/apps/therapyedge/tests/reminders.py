@@ -90,6 +90,57 @@ class RemindersI18NTestCase(TestCase):
         sms_set = missed_sms_set[self.language]
         self.assertTrue(self.patient.active_msisdn.msisdn in [sms.msisdn for sms in sms_set])
     
+    def test_all_in_batches(self):
+        tomorrow = self.calculate_date(days=1)
+        msisdns = ['2776123456%s' % i for i in range(5)]
+        for msisdn in msisdns:
+            patient = Patient.objects.create(te_id='09-%s' % msisdn[-5:],
+                age=30, sex='m', owner=self.user, language=self.language,
+                active_msisdn=MSISDN.objects.create(msisdn=msisdn))
+            patient.visit_set.create(date=tomorrow, status='s', 
+                clinic=self.clinic, te_visit_id=random_string()[:20])
+        
+        batches = []
+        class RecordingGateway(object):
+            def send_sms(self, user, msisdns, smstexts):
+                batches.append(list(msisdns))
+                return gateway.gateway.send_sms(user, msisdns, smstexts)
+        
+        batch_size = reminders.REMINDER_BATCH_SIZE
+        reminders.REMINDER_BATCH_SIZE = 2
+        try:
+            reminders.all(RecordingGateway(), [self.group.name])
+        finally:
+            reminders.REMINDER_BATCH_SIZE = batch_size
+        
+        self.assertEquals([len(batch) for batch in batches], [2, 2, 1])
+        message = MessageType.objects.get(group=self.group, 
+            name='tomorrow_message', language=self.language).message
+        for msisdn in msisdns:
+            self.assertEquals(SendSMS.objects.get(msisdn=msisdn).smstext, 
+                                message)
+    
+    def test_message_type_tagging(self):
+        self.schedule_visits_for(self.calculate_date(days=1))
+        sms_set = self.send_reminders('tomorrow')[self.language]
+        message_type = MessageType.objects.get(group=self.group, 
+            name='tomorrow_message', language=self.language)
+        for sms in sms_set:
+            self.assertEquals(SendSMS.objects.get(pk=sms.pk).message_type, 
+                                message_type)
+    
+    def test_backfill_message_types(self):
+        twoweeks = self.calculate_date(days=14)
+        self.schedule_visits_for(twoweeks)
+        sms_set = self.send_reminders('two_weeks')[self.language]
+        untagged = gateway.gateway.send_sms(self.user, ['27761234567'], 
+                                            ['Not a reminder'])
+        SendSMS.objects.update(message_type=None)
+        self.assertEquals(reminders.backfill_message_types(), 
+                            (len(sms_set), 1))
+        for sms in SendSMS.objects.filter(pk__in=[s.pk for s in sms_set]):
+            self.assertEquals(sms.message_type.name, 'twoweeks_message')
+    
     def test_send_stats(self):
         today = datetime.now()
         one_day = timedelta(days=1)
@@ -0,0 +1,119 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from txtalert.apps.therapyedge.importer import Importer, ImportTimeout
+from txtalert.apps.therapyedge.scheduler import ImportScheduler
+from txtalert.apps.therapyedge.tests.importer import PatchedClient
+from txtalert.core.models import Patient, Visit, Clinic
+from xml.parsers.expat import ExpatError
+from datetime import datetime, timedelta
+import time
+
+class BrokenClient(PatchedClient):
+    def rpc_call(self, request, *args, **kwargs):
+        raise ExpatError, 'not well-formed (invalid token)'
+
+class ImportSchedulerTestCase(TestCase):
+    
+    fixtures = ['patients', 'clinics']
+    
+    def setUp(self):
+        self.user = User.objects.get(username="kumbu")
+        self.clinic = Clinic.objects.all()[0]
+        self.broken_clinic = Clinic.objects.create(name='Broken Clinic', 
+                                            te_id='99', user=self.user)
+        patients = Patient.objects.all()
+        self.assertTrue(patients.count())
+        
+        patches = dict(
+            patients_update=[],
+            comingvisits=[{
+                    'dr_site_name': '',
+                    'dr_site_id': '',
+                    'dr_status': '',
+                    'scheduled_visit_date': str(datetime.now() + timedelta(days=2)),
+                    'key_id': '02-1234%s' % i,
+                    'te_id': patient.te_id,
+                } for i, patient in enumerate(patients)],
+            missedvisits=[],
+            donevisits=[],
+            deletedvisits=[],
+        )
+        broken_clinic = self.broken_clinic
+        
+        class PatchedImporter(Importer):
+            def __init__(self, *args, **kwargs):
+                super(PatchedImporter, self).__init__(*args, **kwargs)
+                # the broken clinic fails to fetch, the rest get the patches
+                self.client = PatchedClient(**patches)
+            
+            def fetch_all_changes(self, clinic, *args, **kwargs):
+                if clinic == broken_clinic:
+                    self.client = BrokenClient()
+                return super(PatchedImporter, self).fetch_all_changes(
+                                                    clinic, *args, **kwargs)
+        
+        class StuckImporter(PatchedImporter):
+            def fetch_all_changes(self, clinic, *args, **kwargs):
+                # a worker stuck in a call that outlives its socket timeout
+                if clinic == broken_clinic:
+                    time.sleep(1)
+                return super(StuckImporter, self).fetch_all_changes(
+                                                    clinic, *args, **kwargs)
+        
+        self.scheduler = ImportScheduler(workers=2, timeout=10, 
+                                            importer_class=PatchedImporter)
+        self.stuck_scheduler = ImportScheduler(workers=2, timeout=0.1,
+                                            importer_class=StuckImporter)
+    
+    def test_failing_clinic_is_isolated(self):
+        results = dict([(clinic, (results, exception, processed)) 
+            for clinic, results, exception, processed in self.scheduler.run(
+                self.user, [self.broken_clinic, self.clinic], 
+                since=datetime.now() - timedelta(days=1), 
+                until=datetime.now())])
+        
+        results_, exception, processed = results[self.broken_clinic]
+        self.assertEquals(results_, None)
+        self.assertTrue(isinstance(exception, ExpatError))
+        
+        results_, exception, processed = results[self.clinic]
+        self.assertEquals(exception, None)
+        self.assertEquals(len(results_['coming_visits']), 
+                            Patient.objects.count())
+        self.assertEquals(processed, Patient.objects.count())
+        self.assertEquals(Visit.objects.filter(clinic=self.clinic, 
+                            te_visit_id__startswith='02-1234').count(),
+                            Patient.objects.count())
+    
+    def test_fetch_deadline(self):
+        changes, exception = self.scheduler.fetch(self.clinic, 
+            since=datetime.now() - timedelta(days=1), until=datetime.now())
+        self.assertEquals(exception, None)
+        self.assertEquals(len(changes['coming_visits']), 
+                            Patient.objects.count())
+        
+        self.scheduler.timeout = -1
+        changes, exception = self.scheduler.fetch(self.clinic, 
+            since=datetime.now() - timedelta(days=1), until=datetime.now())
+        self.assertEquals(changes, None)
+        self.assertTrue(isinstance(exception, ImportTimeout))
+    
+    def test_stuck_clinic_is_reported(self):
+        started = time.time()
+        results = dict([(clinic, (results, exception)) 
+            for clinic, results, exception, processed in 
+            self.stuck_scheduler.run(self.user, 
+                [self.broken_clinic, self.clinic], 
+                since=datetime.now() - timedelta(days=1), 
+                until=datetime.now())])
+        # the run doesn't wait for the stuck worker
+        self.assertTrue(time.time() - started < 1)
+        
+        results_, exception = results[self.broken_clinic]
+        self.assertEquals(results_, None)
+        self.assertTrue(isinstance(exception, ImportTimeout))
+        
+        results_, exception = results[self.clinic]
+        self.assertEquals(exception, None)
+        self.assertEquals(len(results_['coming_visits']), 
+                            Patient.objects.count())
@@ -1,6 +1,100 @@
-from xmlrpclib import ServerProxy, Error, ProtocolError
+from xmlrpclib import ServerProxy, Transport, SafeTransport, Unmarshaller, \
+                        ExpatParser, GzipDecodedResponse, Error, ProtocolError
 from datetime import datetime, timedelta
-from collections import namedtuple
+from collections import namedtuple, deque
+from itertools import chain
+
+class StreamingUnmarshaller(Unmarshaller):
+    """Unmarshaller that hands the structs in the top level array of a 
+    response to `callback` as soon as they've been parsed instead of 
+    collecting them all in memory"""
+    
+    def __init__(self, callback, use_datetime=0):
+        Unmarshaller.__init__(self, use_datetime)
+        self.callback = callback
+    
+    def end_struct(self, data):
+        Unmarshaller.end_struct(self, data)
+        # only the array of the response itself is still open, this is
+        # one of the records
+        if len(self._marks) == 1:
+            self.callback(self._stack.pop())
+    
+    dispatch = Unmarshaller.dispatch.copy()
+    dispatch["struct"] = end_struct
+    
+
+class StreamingTransportMixin(object):
+    """Parses the XML-RPC response as it is being read from the socket, 
+    returning a generator of the records in the response. The socket is 
+    given a timeout so a slow server can't block an import indefinitely."""
+    
+    chunk_size = 8192
+    
+    def make_connection(self, host):
+        connection = self.transport_class.make_connection(self, host)
+        if self.timeout:
+            connection.timeout = self.timeout
+        return connection
+    
+    def parse_response(self, response):
+        # ServerProxy unpacks single valued responses
+        return (self.iter_response(response),)
+    
+    def iter_response(self, response):
+        if response.getheader("Content-Encoding", "") == "gzip":
+            stream = GzipDecodedResponse(response)
+        else:
+            stream = response
+        
+        records = deque()
+        unmarshaller = StreamingUnmarshaller(records.append, 
+                                                self._use_datetime)
+        parser = ExpatParser(unmarshaller)
+        finished = False
+        try:
+            while 1:
+                data = stream.read(self.chunk_size)
+                if not data:
+                    break
+                parser.feed(data)
+                while records:
+                    yield records.popleft()
+            parser.close()
+            while records:
+                yield records.popleft()
+            # anything that wasn't a struct in an array is returned as is
+            for value in unmarshaller.close():
+                if isinstance(value, list):
+                    for item in value:
+                        yield item
+            finished = True
+        finally:
+            if stream is not response:
+                stream.close()
+            # the connection can't be reused if the response wasn't read
+            # completely
+            if not finished:
+                self.close()
+    
+
+class StreamingTransport(StreamingTransportMixin, Transport):
+    
+    transport_class = Transport
+    
+    def __init__(self, timeout=None, *args, **kwargs):
+        Transport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+    
+
+class SafeStreamingTransport(StreamingTransportMixin, SafeTransport):
+    
+    transport_class = SafeTransport
+    
+    def __init__(self, timeout=None, *args, **kwargs):
+        SafeTransport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+    
 
 class Client(object):
     """A class abstracting the TherapyEdge XML-RPC away into something more
@@ -21,8 +115,13 @@ class Client(object):
     # cache for the generated classes
     CLASS_CACHE = {}
     
-    def __init__(self, uri=None, verbose=False):
-        self.server = ServerProxy(uri or self.DEFAULT_SERVICE_URL, verbose=verbose)
+    def __init__(self, uri=None, verbose=False, timeout=None):
+        uri = uri or self.DEFAULT_SERVICE_URL
+        if uri.startswith('https'):
+            transport = SafeStreamingTransport(timeout)
+        else:
+            transport = StreamingTransport(timeout)
+        self.server = ServerProxy(uri, transport=transport, verbose=verbose)
     
     def dict_to_class(self, name, dict):
         """
@@ -36,7 +135,7 @@ class Client(object):
         return self.CLASS_CACHE.setdefault(name, namedtuple(name, dict.keys()))
     
     def rpc_call(self, request, clinic_id, since='', until=''):
-        """Call the XML-RPC service, returns a list of dicts"""
+        """Call the XML-RPC service, returns an iterator of dicts"""
         # check if the given since & untils are date values, if so check their
         # sequence and manipulate them to the right format
         if isinstance(since, datetime) and isinstance(until, datetime):
@@ -55,34 +154,28 @@ class Client(object):
     
     
     def create_instances_of(self, klass, iterable):
-        """This is sort of kludgy. We get a dict from TherapyEdge and in turn
-        read the values from that dict to populate a class instance. We're 
-        expecting that TherapyEdge will not change the order of the dict and that
-        the order of the values are always consistent. This isn't true and as such
-        we should be populating the instances by explicitly passing in the values
-        instead of iterating over a list of unreliable ordering.
-        
-        Ugh, this is sketchy at best
-        """
+        """We get a dict from TherapyEdge and in turn read the values from 
+        that dict to populate a class instance. Fields missing from the dict
+        default to the name of the field."""
+        fields = klass._fields
         for item in iterable:
-            # create empty instance with empty values
-            instance = klass._make(klass._fields)
-            # named tuples won't allow the setting of variables but will allow
-            # replacing them with a new set of vars and which returns a new
-            # instance of the named tuple
-            yield instance._replace(**item)
-        
+            yield klass._make([item.get(field, field) for field in fields])
     
     def call_method(self, request, *args, **kwargs):
         """Call a method on the XML-RPC service, returning them as named tuples"""
         result_list = self.rpc_call(request, *args, **kwargs)
         if result_list:
+            records = iter(result_list)
+            try:
+                first = records.next()
+            except StopIteration:
+                return []
             # convert 'patients_update' to 'PatientUpdate'
             klass_name = self.TYPE_MAP[request]
             # convert 'PatientUpdate' (str) into PatientUpdate (class)
-            klass = self.dict_to_class(klass_name, result_list[0])
+            klass = self.dict_to_class(klass_name, first)
             # make list of dicts into PatientUpdate instances
-            return self.create_instances_of(klass, result_list)
+            return self.create_instances_of(klass, chain([first], records))
         return result_list
     
     def get_all_patients(self, clinic_id, *args, **kwargs):
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from txtalert.core.models import Patient
+from txtalert.core.signals import recalculate_risk_profiles
+
+class Command(BaseCommand):
+    
+    args = '[te_id te_id ...]'
+    help = "Recounts the visit counters and risk profiles of the given " \
+            "patients, or of all patients, from their visits."
+    
+    def handle(self, *args, **options):
+        patients = Patient.all_objects.all()
+        if args:
+            patients = patients.filter(te_id__in=args)
+        print 'Updated %s patients' % recalculate_risk_profiles(patients)
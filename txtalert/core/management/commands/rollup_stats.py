@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from datetime import datetime, date, timedelta
+from txtalert.core import stats
+
+class Command(BaseCommand):
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=7,
+            help='Number of days up to and including today to recompute, '
+                    'visits change status after the fact so this should '
+                    'cover the days those changes are still expected.'),
+        make_option('--since', dest='since', default=None,
+            help='Recompute all days from this date (YYYY-MM-DD) onwards, '
+                    'for backfilling.'),
+    )
+    help = "Rolls up the daily statistics the dashboards are built on, " \
+            "run it from cron every few minutes."
+    
+    def handle(self, *args, **options):
+        today = date.today()
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--since should be formatted as YYYY-MM-DD')
+        else:
+            since = today - timedelta(days=options['days'] - 1)
+        written = stats.rollup(since, today + timedelta(days=1))
+        print 'Rolled up %s statistics since %s' % (written, since)
@@ -14,13 +14,16 @@
 #  along with TxtAlert.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, Sum
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save, pre_save, post_delete, \
+                                        post_init
 from dirtyfields import DirtyFieldsMixin
 from history.models import HistoricalRecords
 from datetime import datetime, date, timedelta
+import hashlib
 import logging
 
 VISIT_STATUS_CHOICES = (
@@ -33,6 +36,8 @@ VISIT_STATUS_CHOICES = (
 
 class MSISDN(models.Model):
     msisdn = models.CharField('MSISDN', max_length=32, unique=True)
+    # the msisdn without its formatting, kept up to date by a pre_save signal
+    canonical = models.CharField(max_length=32, db_index=True, blank=True)
 
     class Meta:
         verbose_name = 'Mobile Number'
@@ -161,13 +166,17 @@ class Patient(DirtyFieldsMixin, SoftDeleteMixin, models.Model):
     last_clinic = models.ForeignKey(Clinic, verbose_name='Clinic', 
                                         blank=True, null=True)
     risk_profile = models.FloatField('Risk Profile', blank=True, null=True)
+    # running totals the risk profile is calculated from, maintained by
+    # the Visit signal handlers
+    missed_visits = models.IntegerField('Missed Visits', default=0)
+    attended_visits = models.IntegerField('Attended Visits', default=0)
     language = models.ForeignKey(Language, verbose_name='Language', default=1, null=True, blank=True)
     
     # soft delete
     deleted = models.BooleanField(default=False)
     
     # modification audit trail methods
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     # custom manager that excludes all deleted patients
@@ -313,6 +322,102 @@ class Visit(DirtyFieldsMixin, SoftDeleteMixin, models.Model):
     
 
 
+class VisitStatisticsManager(models.Manager):
+    
+    def for_patient(self, patient, today=None):
+        """The patient's statistics, recomputed first if a visit has changed
+        since they were last computed or if they were computed on an earlier
+        day; the past visits & the next visit depend on the date.
+        
+        Concurrent reads are safe, the first one creates the record and the
+        others pick it up. The recomputed numbers are only written if the
+        statistics weren't marked stale while they were being computed,
+        otherwise they're left stale for the next read."""
+        today = today or date.today()
+        try:
+            statistics = self.select_related('next_visit_clinic').get(
+                                                            patient=patient)
+        except VisitStatistics.DoesNotExist:
+            statistics = self.create_for_patient(patient)
+        if statistics.computed_on != today:
+            computed_on = statistics.computed_on
+            statistics.compute(today)
+            values = dict([(field.name, getattr(statistics, field.attname))
+                            for field in statistics._meta.fields
+                            if field.name not in ('id', 'patient')])
+            if not self.filter(pk=statistics.pk, computed_on=computed_on) \
+                    .update(**values):
+                statistics.computed_on = None
+        return statistics
+    
+    def create_for_patient(self, patient):
+        """Create the patient's stale statistics, or get the ones a
+        concurrent read created first"""
+        sid = transaction.savepoint()
+        try:
+            statistics = self.create(patient=patient)
+            transaction.savepoint_commit(sid)
+            return statistics
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return self.get(patient=patient)
+
+class VisitStatistics(models.Model):
+    """Attendance numbers of a patient as shown by the API & the bookings 
+    views. Saving or deleting a visit marks them stale, they're recomputed
+    by `VisitStatistics.objects.for_patient` when next read."""
+    patient = models.OneToOneField(Patient, related_name='visit_statistics')
+    visits = models.IntegerField(default=0)
+    past_visits = models.IntegerField(default=0)
+    attended = models.IntegerField(default=0)
+    missed = models.IntegerField(default=0)
+    rescheduled = models.IntegerField(default=0)
+    next_visit = models.ForeignKey(Visit, null=True, related_name='+', 
+                                    on_delete=models.SET_NULL)
+    next_visit_date = models.DateField(null=True)
+    next_visit_clinic = models.ForeignKey(Clinic, null=True, related_name='+',
+                                            on_delete=models.SET_NULL)
+    # the day these were computed, None if stale
+    computed_on = models.DateField(null=True)
+    
+    objects = VisitStatisticsManager()
+    
+    class Meta:
+        verbose_name = 'Visit Statistics'
+        verbose_name_plural = 'Visit Statistics'
+    
+    def __unicode__(self):
+        return u"Visit Statistics for %s" % self.patient
+    
+    def compute(self, today=None):
+        today = today or date.today()
+        visits = Visit.objects.filter(patient=self.patient_id).order_by()
+        counts = dict(visits.values_list('status').annotate(Count('id')))
+        self.visits = sum(counts.values())
+        self.attended = counts.get('a', 0)
+        self.missed = counts.get('m', 0)
+        self.rescheduled = counts.get('r', 0)
+        self.past_visits = visits.filter(date__lt=today).count()
+        
+        next_visits = visits.filter(status__in=['s', 'r'], date__gte=today) \
+                            .order_by('date', 'id')
+        try:
+            self.next_visit_id, self.next_visit_date, \
+                self.next_visit_clinic_id = next_visits.values_list('pk', 
+                                                    'date', 'clinic')[0]
+        except IndexError:
+            self.next_visit_id = self.next_visit_date = None
+            self.next_visit_clinic_id = None
+        self.computed_on = today
+    
+    @property
+    def attendance(self):
+        """Percentage of past visits attended"""
+        if self.past_visits:
+            return int(float(self.attended) / self.past_visits * 100)
+        return 0
+    
+
 class PleaseCallMe(models.Model):
     REASON_CHOICES = (
         # ('ne', 'Khumbu did not phone back the patient'),
@@ -330,7 +435,8 @@ class PleaseCallMe(models.Model):
     
     user = models.ForeignKey(User)
     msisdn = models.ForeignKey(MSISDN, related_name='pcms', verbose_name='Mobile Number')
-    timestamp = models.DateTimeField('Date & Time', auto_now_add=False)
+    timestamp = models.DateTimeField('Date & Time', auto_now_add=False, 
+                                    db_index=True)
     reason = models.CharField('Reason', max_length=2, choices=REASON_CHOICES, default='ot')
     notes = models.TextField('Notes', blank=True)
     message = models.TextField('Received SMS Message', blank=True)
@@ -374,12 +480,135 @@ class ChangeRequest(models.Model):
         return u"ChangeRequest for %s" % self.visit
 
 
+class ImportWatermarkManager(models.Manager):
+    
+    def for_clinic(self, clinic):
+        """Returns a dict of the watermarks for a clinic, keyed by feed"""
+        return dict([(watermark.feed, watermark) 
+                        for watermark in self.filter(clinic=clinic)])
+    
+    def since(self, clinic, default):
+        """The date to start importing from for a clinic. This is `default`
+        unless runs have been missed since the last successful import, in 
+        which case we catch up from the day of the oldest successful import.
+        `default` can either be a date or a datetime."""
+        timestamps = self.filter(clinic=clinic).values_list('updated_at', 
+                                                                flat=True)
+        if not timestamps:
+            return default
+        oldest = min(timestamps).date()
+        if isinstance(default, datetime):
+            oldest = datetime.combine(oldest, datetime.min.time())
+        return min(oldest, default)
+    
+
+class ImportWatermark(models.Model):
+    """Keeps track of how far a feed has been imported for a clinic and the
+    hash of the last payload received so that unchanged payloads can be 
+    skipped on the next run."""
+    clinic = models.ForeignKey(Clinic, related_name='import_watermarks')
+    feed = models.CharField('Feed', max_length=100)
+    until = models.DateTimeField('Imported until', blank=True, null=True)
+    content_hash = models.CharField('Content hash', max_length=40, 
+                                        blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = ImportWatermarkManager()
+    
+    class Meta:
+        unique_together = ('clinic', 'feed')
+    
+    def __unicode__(self):
+        return u"%s %s until %s" % (self.clinic, self.feed, self.until)
+    
+    @classmethod
+    def hash_payload(cls, payload):
+        """Hash a feed's payload independent of the order of its records 
+        and of the keys in dicts."""
+        def normalize(value):
+            if isinstance(value, dict):
+                return sorted([(k, normalize(v)) for k, v in value.items()])
+            if isinstance(value, tuple):
+                return tuple([normalize(v) for v in value])
+            if isinstance(value, list):
+                return sorted([normalize(v) for v in value])
+            return value
+        return hashlib.sha1(repr(normalize(payload))).hexdigest()
+    
+    def is_unchanged(self, content_hash):
+        return self.content_hash == content_hash
+    
+    def advance(self, until, content_hash):
+        self.until = until
+        self.content_hash = content_hash
+        self.save()
+    
+    def forget(self):
+        """Forget the hash of the last payload without advancing, the feed
+        is applied again in full on the next run. Used when some of its
+        records failed to apply."""
+        self.content_hash = ''
+        if self.pk:
+            # a save() would touch updated_at and spoil the catch up
+            ImportWatermark.objects.filter(pk=self.pk).update(content_hash='')
+    
+
+class DailyStatisticManager(models.Manager):
+    
+    def totals(self, since, until, *metrics):
+        """The values of the given metrics summed per (metric, key) over the
+        days from `since` up to but not including `until`"""
+        return dict([((metric, key), value) for metric, key, value in 
+                        self.filter(metric__in=metrics, date__gte=since, 
+                                    date__lt=until).order_by() \
+                            .values_list('metric', 'key') \
+                            .annotate(Sum('value'))])
+    
+    def daily(self, metric, since, until, key=None):
+        """The values of the metric summed per day over the days from 
+        `since` up to but not including `until`, optionally for a single
+        key only"""
+        statistics = self.filter(metric=metric, date__gte=since, 
+                                    date__lt=until)
+        if key is not None:
+            statistics = statistics.filter(key=key)
+        return dict(statistics.order_by().values_list('date') \
+                        .annotate(Sum('value')))
+
+class DailyStatistic(models.Model):
+    """Counts per day, per metric & key; rolled up from the visits, 
+    messages, PCMs and patients by `txtalert.core.stats.rollup` so the
+    dashboards can be answered by a single query."""
+    date = models.DateField()
+    metric = models.CharField(max_length=40)
+    key = models.CharField(max_length=80, blank=True, default='')
+    value = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = DailyStatisticManager()
+    
+    class Meta:
+        unique_together = ('metric', 'date', 'key')
+        ordering = ['date']
+    
+    def __unicode__(self):
+        return u"%s %s %s: %s" % (self.date, self.metric, self.key, 
+                                    self.value)
+    
+
+
 # signals
 from txtalert.core import signals
 from txtalert.apps.gateway.models import PleaseCallMe as GatewayPleaseCallMe
 
+pre_save.connect(signals.set_canonical_msisdn_handler, sender=MSISDN)
 pre_save.connect(signals.check_for_opt_in_changes_handler, sender=Patient)
 pre_save.connect(signals.find_clinic_for_please_call_me_handler, sender=PleaseCallMe)
 pre_save.connect(signals.update_active_msisdn_handler, sender=Patient)
 post_save.connect(signals.track_please_call_me_handler, sender=GatewayPleaseCallMe)
+post_init.connect(signals.remember_visit_clinic_handler, sender=Visit)
+pre_save.connect(signals.remember_visit_status_handler, sender=Visit)
 post_save.connect(signals.calculate_risk_profile_handler, sender=Visit)
+post_delete.connect(signals.forget_visit_status_handler, sender=Visit)
+post_save.connect(signals.invalidate_visit_statistics_handler, sender=Visit)
+post_delete.connect(signals.invalidate_visit_statistics_handler, sender=Visit)
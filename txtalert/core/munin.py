@@ -0,0 +1,118 @@
+"""
+Munin plugins for txtAlert. The plugins only read, past days come from the
+daily statistics rolled up by the `rollup_stats` cron job and today's
+numbers are counted live, see `stats.live_totals`.
+
+This module can be run directly, without going through `manage.py`, which
+saves Munin from loading every app and management command every five
+minutes:
+
+    DJANGO_SETTINGS_MODULE=environments.production \\
+        python -m txtalert.core.munin sms [config]
+
+The plugin name can also be taken from the name the script is called by,
+`txtalert_sms_stats` runs the `sms` plugin.
+"""
+from datetime import date, timedelta
+import os
+import sys
+
+def sms_stats(today):
+    from txtalert.core import stats
+    tomorrow = today + timedelta(days=1)
+    totals = stats.live_totals(today, tomorrow, 'messages', today)
+    return {
+        'total.value': totals.get((stats.SMS_SENT, ''), 0),
+        'delivered.value': totals.get((stats.SMS_STATUS, 'D'), 0),
+    }
+
+def pcm_stats(today):
+    from txtalert.core import stats
+    tomorrow = today + timedelta(days=1)
+    totals = stats.live_totals(today, tomorrow, 'pcms', today)
+    total = totals.get((stats.GATEWAY_PCMS_RECEIVED, ''), 0)
+    linked = totals.get((stats.PCMS_RECEIVED, ''), 0)
+    return {
+        'total.value': total,
+        'linked.value': linked,
+        'not_linked.value': total - linked,
+    }
+
+def te_stats(today):
+    from txtalert.core import stats
+    yesterday = today - timedelta(days=1)
+    totals = stats.live_totals(yesterday, today, 'visits', today)
+    attended_count = totals.get((stats.OPTED_IN_VISIT_STATUS, 'a'), 0)
+    missed_count = totals.get((stats.OPTED_IN_VISIT_STATUS, 'm'), 0)
+    yesterday_count = missed_count + attended_count
+    if yesterday_count == 0: missed_percentage = 0
+    else: missed_percentage = missed_count * (100.0 / yesterday_count)
+    return {
+        'attended.value': attended_count,
+        'missed.value': missed_count,
+        'percentage.value': '%.1f' % missed_percentage
+    }
+
+PLUGINS = {
+    'sms': ({
+        'graph_title': 'SMS Statistics',
+        'graph_category': 'TxtAlert',
+        'graph_vlabel': 'Count',
+        'graph_order': 'total delivered',
+        'total.label': 'SMSs Sent',
+        'delivered.label': 'SMSs that have been delivered successfully',
+    }, sms_stats),
+    'pcm': ({
+        'graph_title': 'PCM Statistics',
+        'graph_category': 'TxtAlert',
+        'graph_vlabel': 'Count',
+        'graph_order': 'total linked not_linked',
+        'total.label': 'Total amount of PCMs received',
+        'linked.label': 'PCMs from known Patient MSISDNs',
+        'not_linked.label': 'PCMs from unknown Patient MSISDNs',
+    }, pcm_stats),
+    'te': ({
+        'graph_title': 'TherapyEdge Statistics',
+        'graph_category': 'TxtAlert',
+        'graph_vlabel': 'Count',
+        'graph_order': 'attended missed percentage',
+        'attended.label': 'Attended',
+        'missed.label': 'Missed',
+        'percentage.label': 'Percentage Missed'
+    }, te_stats),
+}
+
+def config(name):
+    return PLUGINS[name][0]
+
+def values(name, today=None):
+    return PLUGINS[name][1](today or date.today())
+
+def output(_dict):
+    return "\n".join(["%s %s" % (k,v) for k,v in _dict.items()])
+
+def plugin_name(argv):
+    """The plugin to run, either the first argument or taken from the name
+    of the script as in `txtalert_sms_stats`"""
+    if len(argv) > 1 and argv[1] in PLUGINS:
+        return argv.pop(1)
+    name = os.path.basename(argv[0])
+    if name.startswith('txtalert_'):
+        name = name[len('txtalert_'):]
+    if name.endswith('_stats'):
+        name = name[:-len('_stats')]
+    return name
+
+def main(argv=None):
+    argv = list(argv or sys.argv)
+    name = plugin_name(argv)
+    if name not in PLUGINS:
+        sys.exit('Usage: %s %s [config]' % (argv[0], '|'.join(PLUGINS)))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'txtalert.env.settings')
+    if argv[1:] == ['config']:
+        print output(config(name))
+    else:
+        print output(values(name))
+
+if __name__ == '__main__':
+    main()
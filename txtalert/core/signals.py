@@ -1,108 +1,409 @@
-from txtalert.core.models import PleaseCallMe, MSISDN, Visit, Patient
+from txtalert.core.models import (PleaseCallMe, MSISDN, Visit, Patient, 
+                                    VisitStatistics)
+from txtalert.core.utils import canonical_msisdn
 from datetime import datetime
-from django.db.models import Q
+from contextlib import contextmanager
+from django.db.models import Q, Count, Max
+import threading
 import logging
 
+# whether the MSISDN is the active MSISDN of, or has been used by, a patient
+# that hasn't been deleted
+PATIENT_FOR_MSISDN_SQL = """EXISTS (SELECT 1 FROM %(patient)s 
+    WHERE %(patient)s.active_msisdn_id = %(msisdn)s.id 
+    AND NOT %(patient)s.deleted)""" % {
+        'patient': Patient._meta.db_table,
+        'msisdn': MSISDN._meta.db_table,
+    }
+CONTACT_FOR_MSISDN_SQL = """EXISTS (SELECT 1 FROM %(contacts)s 
+    INNER JOIN %(patient)s ON %(patient)s.id = %(contacts)s.patient_id
+    WHERE %(contacts)s.msisdn_id = %(msisdn)s.id 
+    AND NOT %(patient)s.deleted)""" % {
+        'contacts': Patient.msisdns.through._meta.db_table,
+        'patient': Patient._meta.db_table,
+        'msisdn': MSISDN._meta.db_table,
+    }
+
 def track_please_call_me_handler(sender, **kwargs):
     if kwargs.get('created', False):
+        pcms = getattr(_deferred, 'pcms', None)
+        if pcms is not None:
+            return pcms.append(kwargs['instance'])
         return track_please_call_me(kwargs['instance'])
 
+def set_canonical_msisdn_handler(sender, **kwargs):
+    instance = kwargs['instance']
+    instance.canonical = canonical_msisdn(instance.msisdn)
+
 def sloppy_get_or_create_possible_msisdn(sloppy_formatted_msisdn):
+    return sloppy_get_or_create_possible_msisdns(
+        [sloppy_formatted_msisdn])[sloppy_formatted_msisdn]
+
+def sloppy_get_or_create_possible_msisdns(sloppy_formatted_msisdns, 
+                                            chunk_size=500):
+    """Returns a dict of sloppy formatted MSISDN -> the MSISDN record it is
+    most likely to refer to, creating those that don't exist yet."""
+    sloppy_formatted_msisdns = set(sloppy_formatted_msisdns)
     # if the msisdn is of fewer characters than 9 then don't normalize
     # as it's a shortcode or a special number like 121 / voicemail.
-    if len(sloppy_formatted_msisdn) < 9:
-        msisdn, created = MSISDN.objects.get_or_create(msisdn=sloppy_formatted_msisdn)
-        return msisdn
+    canonicals = dict([(sloppy, canonical_msisdn(sloppy)) 
+                        for sloppy in sloppy_formatted_msisdns
+                        if len(sloppy) >= 9])
     
-    # Assume the MSISDNs are always formatted as +27761234567, normalize
-    # to 761234567
-    end_of_msisdn = sloppy_formatted_msisdn[-9:]
-    
-    # it could be formatted as 27761234567,+27761234567 or 0761234567
-    possible_msisdns = MSISDN.objects.filter(msisdn__endswith=end_of_msisdn)
-    if possible_msisdns.exists():
-        # priority for an MSISDN with a patient set
-        for msisdn in possible_msisdns:
-            if msisdn.patient_set.exists():
-                return msisdn # just so you know what's going on
-        # otherwise we'll settle for a patient that has used this MSISDN 
-        # previously
+    # it could be formatted as 27761234567,+27761234567 or 0761234567, all of
+    # which have the same canonical number. Of the possible MSISDNs the one
+    # with a patient set has priority, otherwise we'll settle for one that a
+    # patient has used previously and otherwise the most recent MSISDN 
+    # registered for the number. This is resolved in a single query.
+    preferred = {}
+    canonical_numbers = list(set(canonicals.values()))
+    for i in range(0, len(canonical_numbers), chunk_size):
+        possible_msisdns = MSISDN.objects.filter(
+            canonical__in=canonical_numbers[i:i + chunk_size]).extra(select={
+                'has_patient': PATIENT_FOR_MSISDN_SQL,
+                'has_contact': CONTACT_FOR_MSISDN_SQL,
+            }).order_by('-has_patient', '-has_contact', '-id')
         for msisdn in possible_msisdns:
-            if msisdn.contacts.exists():
-                return msisdn
-        
-        # all possible MSISDNs have no patients linked to them
-        # if that's the case then just default to the most recent
-        # MSISDN registered for that given number.
-        return possible_msisdns.latest('id')
-    # nothing matches, so create one
-    else:
-        msisdn, created = MSISDN.objects.get_or_create(msisdn=sloppy_formatted_msisdn)
-        return msisdn
+            preferred.setdefault(msisdn.canonical, msisdn)
+    
+    msisdns = {}
+    for sloppy in sloppy_formatted_msisdns:
+        canonical = canonicals.get(sloppy)
+        if canonical in preferred:
+            msisdns[sloppy] = preferred[canonical]
+        else:
+            # nothing matches, so create one
+            msisdns[sloppy], created = MSISDN.objects.get_or_create(
+                                                            msisdn=sloppy)
+            if canonical:
+                preferred[canonical] = msisdns[sloppy]
+    return msisdns
 
 
 def track_please_call_me(opera_pcm):
     """Track a MSISDN we receive from a PCM back to a specific contact. This is
     tricky because MSISDNs in txtAlert are involved in all sorts of ManyToMany 
     relationships."""
-    msisdn = sloppy_get_or_create_possible_msisdn(opera_pcm.sender_msisdn)
-    patients = Patient.objects.filter(active_msisdn=msisdn) or \
-                msisdn.contacts.all()
-    if patients.count() == 1:
-        patient = patients[0]
-        clinic = patient.last_clinic or patient.get_last_clinic()
+    return track_please_call_mes([opera_pcm])[0]
+
+def track_please_call_mes(opera_pcms, chunk_size=500):
+    """Track a list of PCMs back to their contacts, the MSISDNs, patients and
+    clinics are looked up for all of them at once. Returns the list of 
+    PleaseCallMe records created."""
+    msisdns = sloppy_get_or_create_possible_msisdns(
+                            [opera_pcm.sender_msisdn for opera_pcm in opera_pcms])
     
-        pcm = PleaseCallMe.objects.create(msisdn=msisdn,
-                                            timestamp=datetime.now(),
-                                            clinic=clinic,
-                                            user=opera_pcm.user,
-                                            message=opera_pcm.message)
-        logging.info("track_please_call_me: PCM registered for %s at %s for clinic %s from opera PCM: %s" % (
-            pcm.msisdn,
-            pcm.timestamp,
-            pcm.clinic,
-            opera_pcm
-        ))
-        # msg = 'Thank you for your Please Call Me. ' + \
-        #         'An administrator will phone you back within 24 hours ' + \
-        #         'to offer assistance.'
-        # from gateway import gateway
-        # gateway.send_sms([msisdn.msisdn],[msg])
-    elif patients.count() == 0:
-        # not sure what to do in this situation yet, lets minimally store the PCM
-        # so we don't loose track of any.
-        pcm = PleaseCallMe.objects.create(msisdn=msisdn,
-                                            timestamp=datetime.now(),
-                                            user=opera_pcm.user, 
-                                            message=opera_pcm.message)
-        logging.info('track_please_call_me: No contacts found for MSISDN: %s, registering without clinic.' % msisdn)
-    else:
-        # not sure what to do in this situation yet, lets minimally store the PCM
-        # so we don't loose track of any.
-        pcm = PleaseCallMe.objects.create(msisdn=msisdn,
-                                            timestamp=datetime.now(),
-                                            user=opera_pcm.user,
-                                            message=opera_pcm.message)
-        logging.info("track_please_call_me: More than one contact found for MSISDN: %s" % msisdn)
+    # the patients for each MSISDN, those that have it set as active or 
+    # otherwise those that have it as one of their numbers
+    patients = {}
+    msisdn_ids = list(set([msisdn.pk for msisdn in msisdns.values()]))
+    for i in range(0, len(msisdn_ids), chunk_size):
+        for msisdn_id, patient_id in Patient.objects.filter(
+                active_msisdn__in=msisdn_ids[i:i + chunk_size]) \
+                .values_list('active_msisdn', 'pk'):
+            patients.setdefault(msisdn_id, []).append(patient_id)
+    without_patient = [pk for pk in msisdn_ids if pk not in patients]
+    for i in range(0, len(without_patient), chunk_size):
+        for msisdn_id, patient_id in Patient.msisdns.through.objects.filter(
+                msisdn__in=without_patient[i:i + chunk_size],
+                patient__deleted=False).values_list('msisdn', 'patient'):
+            patients.setdefault(msisdn_id, []).append(patient_id)
+    
+    # the clinics of the MSISDNs that belong to a single patient
+    single_patient_ids = list(set([patient_ids[0] 
+                                    for patient_ids in patients.values()
+                                    if len(patient_ids) == 1]))
+    clinics = {}
+    for i in range(0, len(single_patient_ids), chunk_size):
+        for patient in Patient.objects.filter(
+                pk__in=single_patient_ids[i:i + chunk_size]) \
+                .select_related('last_clinic'):
+            clinics[patient.pk] = patient.last_clinic or \
+                                    patient.get_last_clinic()
+    
+    pcms = []
+    for opera_pcm in opera_pcms:
+        msisdn = msisdns[opera_pcm.sender_msisdn]
+        patient_ids = patients.get(msisdn.pk, [])
+        if len(patient_ids) == 1:
+            pcm = PleaseCallMe.objects.create(msisdn=msisdn,
+                                        timestamp=datetime.now(),
+                                        clinic=clinics[patient_ids[0]],
+                                        user=opera_pcm.user,
+                                        message=opera_pcm.message)
+            logging.info("track_please_call_me: PCM registered for %s at %s for clinic %s from opera PCM: %s" % (
+                pcm.msisdn,
+                pcm.timestamp,
+                pcm.clinic,
+                opera_pcm
+            ))
+            # msg = 'Thank you for your Please Call Me. ' + \
+            #         'An administrator will phone you back within 24 hours ' + \
+            #         'to offer assistance.'
+            # from gateway import gateway
+            # gateway.send_sms([msisdn.msisdn],[msg])
+        else:
+            # not sure what to do in this situation yet, lets minimally store
+            # the PCM so we don't loose track of any.
+            pcm = PleaseCallMe.objects.create(msisdn=msisdn,
+                                        timestamp=datetime.now(),
+                                        user=opera_pcm.user, 
+                                        message=opera_pcm.message)
+            if patient_ids:
+                logging.info("track_please_call_me: More than one contact found for MSISDN: %s" % msisdn)
+            else:
+                logging.info('track_please_call_me: No contacts found for MSISDN: %s, registering without clinic.' % msisdn)
+        pcms.append(pcm)
+    return pcms
 
+@contextmanager
+def deferred_pcm_tracking():
+    """Collect the gateway PCMs created in the block and track them all at
+    once when leaving it, see `track_please_call_mes`. Nested blocks are 
+    tracked by the outermost one."""
+    if getattr(_deferred, 'pcms', None) is not None:
+        yield
+        return
+    _deferred.pcms = []
+    try:
+        yield
+    finally:
+        pcms, _deferred.pcms = _deferred.pcms, None
+        track_please_call_mes(pcms)
 
-def calculate_risk_profile_handler(sender, **kwargs):
-    return calculate_risk_profile(kwargs['instance'])
-
-def calculate_risk_profile(visit):
-    """Calculate the risk profile of the patient after the latest visit has been
-    saved to the database. This MUST be a post_save signal handler otherwise 
-    the calculation will always be one visit short."""
-    patient = visit.patient
-    patient.last_clinic = patient.get_last_clinic()
-    missed_visits = Visit.history.filter(patient=patient, status='m').count()
-    attended_visits = Visit.history.filter(patient=patient, status='a').count()
+
+def counted_status(status, deleted):
+    """The status a visit counts as towards the risk profile, deleted visits
+    don't count."""
+    if deleted:
+        return None
+    return status
+
+def counted_clinic(clinic_id, deleted):
+    """The clinic a visit counts as towards the patient's last clinic, 
+    deleted visits don't count."""
+    if deleted:
+        return None
+    return clinic_id
+
+def status_delta(previous_status, status):
+    """The change to a patient's (missed, attended) visit counters when one
+    of their visits goes from `previous_status` to `status`"""
+    return ((status == 'm') - (previous_status == 'm'), 
+            (status == 'a') - (previous_status == 'a'))
+
+def risk_profile(missed_visits, attended_visits):
     total_visits = missed_visits + attended_visits
     if total_visits == 0:
-        patient.risk_profile = 0
+        return 0
+    return float(missed_visits) / total_visits
+
+
+def remember_visit_clinic_handler(sender, **kwargs):
+    return remember_visit_clinic(kwargs['instance'])
+
+def remember_visit_clinic(visit):
+    """Remember the clinic of the visit as loaded, the dirty state doesn't
+    track foreign keys. This MUST be a post_init signal handler."""
+    visit._saved_clinic_id = visit.clinic_id
+
+
+def remember_visit_status_handler(sender, **kwargs):
+    return remember_visit_status(kwargs['instance'])
+
+def remember_visit_status(visit):
+    """Remember what the visit counted as before the save. This MUST be a 
+    pre_save signal handler otherwise the dirty state tells us nothing."""
+    if visit.pk is None:
+        visit._counted_status = None
+        visit._counted_clinic_id = None
+    else:
+        dirty = visit.get_dirty_fields()
+        deleted = dirty.get('deleted', visit.deleted)
+        visit._counted_status = counted_status(
+            dirty.get('status', visit.status), deleted)
+        visit._counted_clinic_id = counted_clinic(
+            getattr(visit, '_saved_clinic_id', visit.clinic_id), deleted)
+
+
+def calculate_risk_profile_handler(sender, **kwargs):
+    return calculate_risk_profile(kwargs['instance'], 
+                                    kwargs.get('created', False))
+
+def calculate_risk_profile(visit, created=False):
+    """Update the risk profile of the patient after the visit has been saved
+    to the database. The patient's missed & attended counters are adjusted
+    for the visit's change in status, saves that don't change what the visit
+    counts as don't touch the patient at all. This MUST be a post_save signal
+    handler with `remember_visit_status` as its pre_save counterpart."""
+    status = counted_status(visit.status, visit.deleted)
+    previous = not created and getattr(visit, '_counted_status', None) \
+                    or None
+    missed, attended = status_delta(previous, status)
+    visit._counted_status = status
+    visit._reset_state()
+    # the patient's last clinic is that of their latest visit, a new visit
+    # is the latest; if the visit moved clinic or was (un)deleted the latest
+    # visit is looked up again
+    clinic = counted_clinic(visit.clinic_id, visit.deleted)
+    if created:
+        clinic_id = clinic
+    elif clinic != getattr(visit, '_counted_clinic_id', clinic):
+        clinic_id = latest_clinic_id(visit.patient_id)
     else:
-        patient.risk_profile =  float(missed_visits) / total_visits
-    patient.save()
+        clinic_id = None
+    visit._saved_clinic_id = visit.clinic_id
+    if missed or attended or clinic_id:
+        values = update_risk_profile(visit.patient_id, missed, attended, 
+                                        clinic_id)
+        # keep the patient instance the visit holds on to in step with the
+        # database so saving it later doesn't undo the adjustment
+        patient = getattr(visit, 
+                    visit._meta.get_field('patient').get_cache_name(), None)
+        if patient is not None and values:
+            for key, value in values.get(patient.pk, {}).items():
+                setattr(patient, Patient._meta.get_field(key).attname, value)
+
+
+def latest_clinic_id(patient_id):
+    """The clinic of the patient's latest visit that hasn't been deleted, 
+    None if there is none in which case the last clinic is kept."""
+    clinic_ids = list(Visit.objects.filter(patient=patient_id) \
+                        .order_by('-id').values_list('clinic', flat=True)[:1])
+    return clinic_ids and clinic_ids[0] or None
+
+
+def forget_visit_status_handler(sender, **kwargs):
+    return forget_visit_status(kwargs['instance'])
+
+def forget_visit_status(visit):
+    """Take a visit that's been deleted from the database out of its 
+    patient's counters"""
+    missed, attended = status_delta(counted_status(visit.status, 
+                                                    visit.deleted), None)
+    if missed or attended:
+        update_risk_profile(visit.patient_id, missed, attended)
+
+
+def invalidate_visit_statistics_handler(sender, **kwargs):
+    return invalidate_visit_statistics([kwargs['instance'].patient_id])
+
+def invalidate_visit_statistics(patient_ids, chunk_size=500):
+    """Mark the visit statistics of the given patients as stale, or record
+    them as such if the calculation is being deferred."""
+    stale = getattr(_deferred, 'stale', None)
+    if stale is not None:
+        return stale.update(patient_ids)
+    patient_ids = list(patient_ids)
+    for i in range(0, len(patient_ids), chunk_size):
+        VisitStatistics.objects.filter(
+            patient__in=patient_ids[i:i + chunk_size]).update(computed_on=None)
+
+
+_deferred = threading.local()
+
+def update_risk_profile(patient_id, missed=0, attended=0, clinic_id=None):
+    """Adjust the patient's visit counters and risk profile, or record the
+    adjustment if the calculation is being deferred. Returns the values
+    written as returned by `apply_risk_profile_changes` or None if 
+    deferred."""
+    changes = getattr(_deferred, 'changes', None)
+    if changes is None:
+        return apply_risk_profile_changes({
+            patient_id: [missed, attended, clinic_id]})
+    change = changes.setdefault(patient_id, [0, 0, None])
+    change[0] += missed
+    change[1] += attended
+    change[2] = clinic_id or change[2]
+
+def apply_risk_profile_changes(changes, chunk_size=500):
+    """Apply a dict of patient pk -> [missed, attended, clinic pk] counter
+    adjustments, the patient is written with a single UPDATE which doesn't
+    fire the patient's save signals nor write a history record. Returns a 
+    dict of patient pk -> the values written."""
+    written = {}
+    patient_ids = changes.keys()
+    for i in range(0, len(patient_ids), chunk_size):
+        counters = Patient.all_objects.filter(
+                        pk__in=patient_ids[i:i + chunk_size]).values_list(
+                        'pk', 'missed_visits', 'attended_visits')
+        for pk, missed_visits, attended_visits in counters:
+            missed, attended, clinic_id = changes[pk]
+            values = {
+                'missed_visits': missed_visits + missed,
+                'attended_visits': attended_visits + attended,
+                'risk_profile': risk_profile(missed_visits + missed, 
+                                                attended_visits + attended),
+            }
+            if clinic_id:
+                values['last_clinic'] = clinic_id
+            Patient.all_objects.filter(pk=pk).update(**values)
+            written[pk] = values
+    return written
+
+@contextmanager
+def deferred_risk_profiles():
+    """Collect the risk profile adjustments for all visits saved in the block
+    and apply them once per patient when leaving it, the visit statistics of
+    the patients are marked stale in one go as well. The adjustments are
+    applied even if the block raises an exception so that visits already
+    committed are accounted for; when the block runs in a transaction that
+    is rolled back they are rolled back with it. Nested blocks are applied 
+    by the outermost one."""
+    if getattr(_deferred, 'changes', None) is not None:
+        yield
+        return
+    _deferred.changes, _deferred.stale = {}, set()
+    try:
+        yield
+    finally:
+        changes, _deferred.changes = _deferred.changes, None
+        stale, _deferred.stale = _deferred.stale, None
+        apply_risk_profile_changes(changes)
+        invalidate_visit_statistics(stale)
+
+def recalculate_risk_profiles(patients=None, chunk_size=500):
+    """Recount the visit counters, risk profile and last clinic of the given
+    queryset of patients, or all patients, from their visits. Returns the 
+    number of patients that were out of date."""
+    if patients is None:
+        patients = Patient.all_objects.all()
+    visits = Visit.objects.filter(patient__in=patients).order_by()
+    counts = {}
+    for patient_id, status, count in visits.filter(
+            status__in=['m', 'a']).values_list('patient', 'status').annotate(
+            Count('id')):
+        counts[(patient_id, status)] = count
+    latest = dict(visits.values_list('patient').annotate(Max('id')))
+    clinics = {}
+    visit_ids = latest.values()
+    for i in range(0, len(visit_ids), chunk_size):
+        clinics.update(Visit.all_objects.filter(
+            pk__in=visit_ids[i:i + chunk_size]).values_list('pk', 'clinic'))
+    
+    updated = 0
+    for pk, missed_visits, attended_visits, profile, last_clinic_id in \
+            patients.values_list('pk', 'missed_visits', 'attended_visits', 
+                                    'risk_profile', 'last_clinic'):
+        values = {
+            'missed_visits': counts.get((pk, 'm'), 0),
+            'attended_visits': counts.get((pk, 'a'), 0),
+            # patients without visits keep the clinic they were given
+            'last_clinic': clinics.get(latest.get(pk), last_clinic_id),
+        }
+        if values['missed_visits'] or values['attended_visits'] or \
+                profile is not None:
+            values['risk_profile'] = risk_profile(values['missed_visits'],
+                                                    values['attended_visits'])
+        else:
+            values['risk_profile'] = None
+        if (missed_visits, attended_visits, profile, last_clinic_id) == (
+                values['missed_visits'], values['attended_visits'], 
+                values['risk_profile'], values['last_clinic']):
+            continue
+        Patient.all_objects.filter(pk=pk).update(**values)
+        updated += 1
+    return updated
 
 
 def check_for_opt_in_changes_handler(sender, **kwargs):
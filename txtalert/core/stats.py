@@ -0,0 +1,138 @@
+"""
+Rolls the visits, messages, PCMs and patients up into DailyStatistic
+records, the dashboards and the Munin plugins read their numbers from those
+instead of counting the underlying tables on every request.
+
+Visits change status after the fact so the rollup recomputes a trailing
+window of days on every run rather than only the days it hasn't seen yet,
+see the `rollup_stats` management command. All datetime columns are
+queried with half-open [midnight, next midnight) ranges so their indexes
+can be used.
+"""
+from datetime import datetime, date, time, timedelta
+from django.db import transaction
+from django.db.models import Count
+from txtalert.core.models import Visit, Patient, PleaseCallMe, DailyStatistic
+from txtalert.apps.gateway.models import SendSMS, \
+                                    PleaseCallMe as GatewayPleaseCallMe
+
+VISIT_STATUS = 'visit_status'
+VISIT_CLINIC = 'visit_clinic'
+OPTED_IN_VISIT_STATUS = 'opted_in_visit_status'
+SMS_SENT = 'sms_sent'
+SMS_STATUS = 'sms_status'
+SMS_MESSAGE_TYPE = 'sms_message_type'
+PCMS_RECEIVED = 'pcms_received'
+GATEWAY_PCMS_RECEIVED = 'gateway_pcms_received'
+PATIENTS_CREATED = 'patients_created'
+
+def day_range(since, until):
+    """The datetimes bounding the days from `since` up to but not
+    including `until`"""
+    return datetime.combine(since, time.min), datetime.combine(until, time.min)
+
+def days(since, until):
+    day = since
+    while day < until:
+        yield day
+        day += timedelta(days=1)
+
+def add(counts, metric, day, key, value):
+    counts[(metric, day, key)] = counts.get((metric, day, key), 0) + value
+
+def count_per_day(counts, metric, queryset, field, since, until):
+    """Count the records in the queryset per day of the datetime `field`,
+    one COUNT over a half-open range per day"""
+    for day in days(since, until):
+        start, end = day_range(day, day + timedelta(days=1))
+        count = queryset.filter(**{
+            '%s__gte' % field: start,
+            '%s__lt' % field: end,
+        }).count()
+        if count:
+            add(counts, metric, day, '', count)
+
+def collect_visits(since, until):
+    counts = {}
+    visits = Visit.objects.filter(date__gte=since, date__lt=until).order_by()
+    for day, status, opted_in, count in visits.values_list('date', 'status',
+                                    'patient__opted_in').annotate(Count('id')):
+        add(counts, VISIT_STATUS, day, status, count)
+        if opted_in:
+            add(counts, OPTED_IN_VISIT_STATUS, day, status, count)
+    for day, clinic_id, count in visits.values_list('date', 'clinic') \
+                                    .annotate(Count('id')):
+        add(counts, VISIT_CLINIC, day, str(clinic_id), count)
+    return counts
+
+def collect_messages(since, until):
+    # one GROUP BY per day, messages are grouped by the name of their message
+    # type so reminders in different languages add up
+    counts = {}
+    for day in days(since, until):
+        start, end = day_range(day, day + timedelta(days=1))
+        for message_type, status, count in SendSMS.objects.filter(
+                delivery__gte=start, delivery__lt=end).order_by() \
+                .values_list('message_type__name', 'status') \
+                .annotate(Count('id')):
+            add(counts, SMS_SENT, day, '', count)
+            add(counts, SMS_STATUS, day, status, count)
+            if message_type:
+                add(counts, SMS_MESSAGE_TYPE, day, message_type, count)
+    return counts
+
+def collect_pcms(since, until):
+    counts = {}
+    count_per_day(counts, PCMS_RECEIVED, PleaseCallMe.objects.all(),
+                    'timestamp', since, until)
+    count_per_day(counts, GATEWAY_PCMS_RECEIVED,
+                    GatewayPleaseCallMe.objects.all(), 'created_at', since,
+                    until)
+    return counts
+
+def collect_patients(since, until):
+    counts = {}
+    count_per_day(counts, PATIENTS_CREATED, Patient.objects.all(),
+                    'created_at', since, until)
+    return counts
+
+# the metrics rolled up from each source and the function that counts them
+SOURCES = {
+    'visits': ((VISIT_STATUS, VISIT_CLINIC, OPTED_IN_VISIT_STATUS),
+                collect_visits),
+    'messages': ((SMS_SENT, SMS_STATUS, SMS_MESSAGE_TYPE), collect_messages),
+    'pcms': ((PCMS_RECEIVED, GATEWAY_PCMS_RECEIVED), collect_pcms),
+    'patients': ((PATIENTS_CREATED,), collect_patients),
+}
+
+def live_totals(since, until, source, today=None):
+    """The totals per (metric, key) of the source's metrics over the days
+    from `since` up to but not including `until`. The days before today are
+    read from the DailyStatistic records rolled up by `rollup_stats`, today
+    and later are counted from the underlying tables. Nothing is written."""
+    today = today or date.today()
+    metrics, collect = SOURCES[source]
+    totals = DailyStatistic.objects.totals(since, min(until, today), *metrics)
+    if until > today:
+        for (metric, day, key), value in collect(max(since, today),
+                                                    until).items():
+            totals[(metric, key)] = totals.get((metric, key), 0) + value
+    return totals
+
+@transaction.commit_on_success
+def rollup(since, until=None, sources=None):
+    """Recompute the statistics for the days from `since` up to but not
+    including `until`, which defaults to tomorrow, for the given sources or
+    all of them. Returns the number of DailyStatistic records written."""
+    until = until or (date.today() + timedelta(days=1))
+    written = 0
+    for source in (sources or SOURCES.keys()):
+        metrics, collect = SOURCES[source]
+        counts = collect(since, until)
+        DailyStatistic.objects.filter(metric__in=metrics, date__gte=since,
+                                        date__lt=until).delete()
+        for (metric, day, key), value in counts.items():
+            DailyStatistic.objects.create(metric=metric, date=day, key=key,
+                                            value=value)
+        written += len(counts)
+    return written
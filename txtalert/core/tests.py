@@ -1,7 +1,7 @@
 from django.test import TestCase
 from txtalert.core.models import *
 from django.contrib.auth.models import Group
-from datetime import datetime
+from datetime import datetime, date, timedelta
 
 class PermissionsTestCase(TestCase):
     
@@ -58,6 +58,179 @@ class ModelTestCase(TestCase):
         self.assertEquals(visit.clinic, patient.get_last_clinic())
 
 
+
+class RiskProfileTestCase(TestCase):
+    
+    fixtures = ['patients', 'clinics', 'visits']
+    
+    def setUp(self):
+        self.patient = Patient.objects.filter(last_clinic=None)[0]
+        self.clinic = Clinic.objects.all()[0]
+    
+    def reload_patient(self):
+        return Patient.objects.get(pk=self.patient.pk)
+    
+    def create_visit(self, status):
+        return self.patient.visit_set.create(clinic=self.clinic, 
+                                                date=datetime.now(), 
+                                                status=status)
+    
+    def test_incremental_counters(self):
+        visit = self.create_visit('m')
+        self.create_visit('a')
+        patient = self.reload_patient()
+        self.assertEquals((patient.missed_visits, patient.attended_visits),
+                            (1, 1))
+        self.assertEquals(patient.risk_profile, 0.5)
+        self.assertEquals(patient.last_clinic, self.clinic)
+        # the instance the visits were created through is kept in step
+        self.assertEquals(self.patient.risk_profile, 0.5)
+        
+        visit.status = 'a'
+        visit.save()
+        self.assertEquals(self.reload_patient().risk_profile, 0.0)
+        visit.save()
+        self.assertEquals(self.reload_patient().attended_visits, 2)
+        visit.delete()
+        self.assertEquals(self.reload_patient().attended_visits, 1)
+    
+    def test_last_clinic_follows_latest_visit(self):
+        other_clinic = Clinic.objects.create(te_id='99', name='Other')
+        first = self.create_visit('s')
+        latest = self.create_visit('s')
+        self.assertEquals(self.reload_patient().last_clinic, self.clinic)
+        latest.clinic = other_clinic
+        latest.save()
+        self.assertEquals(self.reload_patient().last_clinic, other_clinic)
+        # visits loaded from the database know their original clinic too
+        latest = Visit.objects.get(pk=latest.pk)
+        latest.clinic = self.clinic
+        latest.save()
+        self.assertEquals(self.reload_patient().last_clinic, self.clinic)
+        # moving an earlier visit doesn't change the last clinic
+        first.clinic = other_clinic
+        first.save()
+        self.assertEquals(self.reload_patient().last_clinic, self.clinic)
+        # when the latest visit is deleted the one before it is the latest
+        latest.delete()
+        self.assertEquals(self.reload_patient().last_clinic, other_clinic)
+    
+    def test_saves_without_changes_dont_touch_the_patient(self):
+        visit = self.create_visit('s')
+        history = self.patient.history.count()
+        visit.comment = 'rescheduled'
+        visit.save()
+        self.assertEquals(self.patient.history.count(), history)
+    
+    def test_deferred_risk_profiles(self):
+        from txtalert.core.signals import deferred_risk_profiles
+        with deferred_risk_profiles():
+            self.create_visit('m')
+            self.create_visit('m')
+            self.assertEquals(self.reload_patient().missed_visits, 0)
+        patient = self.reload_patient()
+        self.assertEquals(patient.missed_visits, 2)
+        self.assertEquals(patient.risk_profile, 1.0)
+    
+    def test_recalculate_risk_profiles(self):
+        from txtalert.core.signals import recalculate_risk_profiles
+        self.create_visit('m')
+        self.create_visit('a')
+        Patient.objects.filter(pk=self.patient.pk).update(missed_visits=5,
+                                    attended_visits=0, risk_profile=1.0)
+        self.assertEquals(recalculate_risk_profiles(), 1)
+        patient = self.reload_patient()
+        self.assertEquals((patient.missed_visits, patient.attended_visits),
+                            (1, 1))
+        self.assertEquals(patient.risk_profile, 0.5)
+        self.assertEquals(recalculate_risk_profiles(), 0)
+
+
+
+class VisitStatisticsTestCase(TestCase):
+    
+    fixtures = ['patients', 'clinics', 'visits']
+    
+    def setUp(self):
+        self.patient = Patient.objects.filter(last_clinic=None)[0]
+        self.clinic = Clinic.objects.all()[0]
+        self.today = date.today()
+    
+    def create_visit(self, status, days):
+        return self.patient.visit_set.create(clinic=self.clinic, 
+                    date=self.today + timedelta(days=days), status=status)
+    
+    def statistics(self):
+        return VisitStatistics.objects.for_patient(self.patient, self.today)
+    
+    def test_statistics(self):
+        self.create_visit('a', -2)
+        self.create_visit('m', -1)
+        next_visit = self.create_visit('s', 1)
+        self.create_visit('r', 2)
+        statistics = self.statistics()
+        self.assertEquals(statistics.visits, 4)
+        self.assertEquals(statistics.past_visits, 2)
+        self.assertEquals((statistics.attended, statistics.missed, 
+                            statistics.rescheduled), (1, 1, 1))
+        self.assertEquals(statistics.attendance, 50)
+        self.assertEquals(statistics.next_visit, next_visit)
+        self.assertEquals(statistics.next_visit_clinic, self.clinic)
+    
+    def test_visit_changes_mark_statistics_stale(self):
+        visit = self.create_visit('s', 1)
+        self.assertEquals(self.statistics().next_visit, visit)
+        # a fresh set of statistics is a single lookup
+        self.assertNumQueries(1, self.statistics)
+        visit.status = 'a'
+        visit.save()
+        statistics = self.statistics()
+        self.assertEquals(statistics.next_visit, None)
+        self.assertEquals(statistics.attended, 1)
+        visit.delete()
+        self.assertEquals(self.statistics().attended, 0)
+    
+    def test_statistics_are_recomputed_daily(self):
+        visit = self.create_visit('s', 1)
+        self.assertEquals(self.statistics().past_visits, 0)
+        self.today += timedelta(days=2)
+        statistics = self.statistics()
+        self.assertEquals(statistics.past_visits, 1)
+        self.assertEquals(statistics.next_visit, None)
+    
+    def test_concurrent_first_reads(self):
+        first = VisitStatistics.objects.create_for_patient(self.patient)
+        # a read that lost the race to create them gets the same record
+        second = VisitStatistics.objects.create_for_patient(self.patient)
+        self.assertEquals(first.pk, second.pk)
+        self.assertEquals(VisitStatistics.objects.filter(
+                            patient=self.patient).count(), 1)
+    
+    def test_invalidation_while_computing(self):
+        self.create_visit('s', 1)
+        self.statistics()
+        VisitStatistics.objects.filter(patient=self.patient).update(
+                            computed_on=self.today - timedelta(days=1))
+        compute = VisitStatistics.compute
+        def compute_and_invalidate(statistics, today=None):
+            compute(statistics, today)
+            # a visit is saved while the statistics are being computed
+            VisitStatistics.objects.filter(pk=statistics.pk).update(
+                                                            computed_on=None)
+        VisitStatistics.compute = compute_and_invalidate
+        try:
+            self.assertEquals(self.statistics().visits, 1)
+        finally:
+            VisitStatistics.compute = compute
+        # the invalidation isn't overwritten, the next read recomputes
+        self.assertEquals(VisitStatistics.objects.get(
+                            patient=self.patient).computed_on, None)
+        self.create_visit('a', -1)
+        self.assertEquals(self.statistics().visits, 2)
+        self.assertEquals(VisitStatistics.objects.get(
+                            patient=self.patient).computed_on, self.today)
+
+
 from django.test import TestCase
 from txtalert.apps.gateway.models import PleaseCallMe as GatewayPleaseCallMe
 from txtalert.core.models import PleaseCallMe, Patient, Clinic, MSISDN
@@ -123,6 +296,26 @@ class PleaseCallMeTestCase(TestCase):
         # been specified automatically yet
         self.assertEquals(pcm.clinic, Clinic.objects.get(name='Test Clinic'))
     
+    def test_deferred_please_call_me_tracking(self):
+        from txtalert.core.signals import deferred_pcm_tracking
+        with deferred_pcm_tracking():
+            for sender_msisdn in [self.patient.active_msisdn.msisdn, 
+                                    '27123456789']:
+                GatewayPleaseCallMe.objects.create(
+                    sms_id='sms_id',
+                    sender_msisdn=sender_msisdn,
+                    user=self.user,
+                    message='Please Call Me',
+                )
+            # nothing is tracked until leaving the block
+            self.assertEquals(PleaseCallMe.objects.count(), 0)
+        
+        self.assertEquals(PleaseCallMe.objects.count(), 2)
+        pcm = PleaseCallMe.objects.get(msisdn=self.patient.active_msisdn)
+        self.assertEquals(pcm.clinic, self.patient.last_clinic)
+        pcm = PleaseCallMe.objects.get(msisdn__msisdn='27123456789')
+        self.assertEquals(pcm.clinic, None)
+    
     def test_pcm_for_nonexistent_msisdn(self):
         # verify this nr doesn't exist in the db
         self.assertRaises(
@@ -180,6 +373,19 @@ class PleaseCallMeTestCase(TestCase):
             '27123456121'
         )
     
+    def test_sloppy_msisdn_prefers_the_patients_msisdn(self):
+        from txtalert.core.signals import sloppy_get_or_create_possible_msisdn
+        msisdn = MSISDN.objects.create(msisdn='0761234567')
+        self.assertEquals(msisdn.canonical, '761234567')
+        self.patient.active_msisdn = msisdn
+        self.patient.save()
+        # a more recent one in a different format without a patient
+        MSISDN.objects.create(msisdn='27761234567')
+        self.assertEquals(
+            sloppy_get_or_create_possible_msisdn('+27761234567'),
+            msisdn
+        )
+    
     def test_voicemail_notification_handling(self):
         from txtalert.apps.api.handlers import handle_voicemail_message
         sample_messages = [
@@ -193,3 +399,69 @@ class PleaseCallMeTestCase(TestCase):
         msisdn, date = handle_voicemail_message(sample_messages[1])
         self.assertEquals(msisdn, '07123456788')
         self.assertEquals(date, datetime(2010,4,11,15,17))
+
+
+class StatsRollupTestCase(TestCase):
+    
+    fixtures = ['patients', 'clinics', 'visits']
+    
+    def setUp(self):
+        from txtalert.apps.gateway.models import SendSMS
+        self.patient = Patient.objects.all()[0]
+        self.clinic = Clinic.objects.all()[0]
+        self.today = date.today()
+        for status in ['a', 'a', 'm']:
+            self.patient.visit_set.create(clinic=self.clinic, 
+                date=self.today - timedelta(days=1), status=status)
+        user = User.objects.get(username='kumbu')
+        message_type = MessageType.objects.create(name='missed_message', 
+            message='You missed your visit', language=self.patient.language,
+            group=Group.objects.create(name='Stats'))
+        for smstext, message_type in [('You missed your visit', message_type),
+                                        ('Hello', None)]:
+            SendSMS.objects.create(user=user, msisdn='27123456789',
+                smstext=smstext, delivery=datetime.now(), 
+                expiry=datetime.now(), identifier='a', 
+                message_type=message_type)
+    
+    def test_rollup(self):
+        from txtalert.core import stats
+        since, until = self.today - timedelta(days=1), self.today
+        stats.rollup(since, self.today + timedelta(days=1))
+        totals = DailyStatistic.objects.totals(since, until, 
+                                                stats.VISIT_STATUS)
+        self.assertEquals(totals[(stats.VISIT_STATUS, 'a')], 
+            Visit.objects.filter(date=since, status='a').count())
+        self.assertEquals(DailyStatistic.objects.daily(stats.SMS_SENT, 
+            self.today, self.today + timedelta(days=1)), {self.today: 2})
+        totals = DailyStatistic.objects.totals(self.today, 
+            self.today + timedelta(days=1), stats.SMS_MESSAGE_TYPE)
+        self.assertEquals(totals, {
+            (stats.SMS_MESSAGE_TYPE, 'missed_message'): 1})
+        
+        # rolling up again replaces the previous numbers
+        Visit.objects.filter(date=since, status='m').update(status='a')
+        stats.rollup(since, self.today + timedelta(days=1))
+        totals = DailyStatistic.objects.totals(since, until, 
+                                                stats.VISIT_STATUS)
+        self.assertEquals(totals.get((stats.VISIT_STATUS, 'm')), None)
+    
+    def test_munin_plugins(self):
+        from txtalert.core import munin, stats
+        # today is counted live
+        self.assertEquals(munin.values('sms', self.today), {
+            'total.value': 2,
+            'delivered.value': 0,
+        })
+        # the plugins don't write, past days are rolled up by cron
+        self.assertFalse(DailyStatistic.objects.exists())
+        stats.rollup(self.today - timedelta(days=1), self.today)
+        yesterday = self.today - timedelta(days=1)
+        visits = Visit.objects.filter(date=yesterday, 
+                                        patient__opted_in=True)
+        values = munin.values('te', self.today)
+        self.assertEquals(values['attended.value'], 
+                            visits.filter(status='a').count())
+        self.assertEquals(values['missed.value'], 
+                            visits.filter(status='m').count())
+        self.assertEquals(munin.plugin_name(['txtalert_pcm_stats']), 'pcm')
@@ -13,6 +13,16 @@ def random_string(val=None):
     m.update(str(val))
     return m.hexdigest()
 
+def canonical_msisdn(raw):
+    """The last 9 digits of a mobile number, which is all that numbers 
+    formatted as 0761234567, 27761234567 or +27761234567 have in common.
+    Shorter numbers, short codes or voicemail, are left as they are."""
+    raw = str(raw)
+    digits = ''.join([c for c in raw if c.isdigit()])
+    if len(digits) < 9:
+        return raw
+    return digits[-9:]
+
 def normalize_msisdn(raw):
     raw = ''.join([c for c in str(raw) if c.isdigit()])
     if raw.startswith('0'):
@@ -132,8 +132,16 @@ INSTALLED_APPS = (
 )
 
 SMS_GATEWAY_CLASS = 'txtalert.apps.gateway.backends.vumi'
+# The messages of bulk SMS jobs submitted through the API are always queued
+# and submitted via SMS_QUEUE_BACKEND by `manage.py send_queued_sms`, which
+# has to be running whatever the SMS_GATEWAY_CLASS. To queue all outbound
+# messages instead of submitting them while the request is being handled
+# set SMS_GATEWAY_CLASS to the queued backend as well.
+SMS_QUEUE_BACKEND = 'txtalert.apps.gateway.backends.vumi'
 VUMI_USERNAME = ''
 VUMI_PASSWORD = ''
+# the maximum number of concurrent submissions to Vumi
+VUMI_CONCURRENCY = 8
 
 BOOKING_TOOL_RISK_LEVELS = {
     # pc is for patient count
@@ -142,5 +150,29 @@ BOOKING_TOOL_RISK_LEVELS = {
     'low': lambda pc: pc < 50,
 }
 
+# seconds the Geckoboard widgets are cached for, the statistics behind
+# them are rolled up by `manage.py rollup_stats`
+GECKOBOARD_CACHE_TIMEOUT = 60
+
+# the most SendSMS / PleaseCallMe records returned by a single API list
+# read, clients page through the rest with `since_id`
+API_PAGE_SIZE = 1000
+
+# the most parts a message submitted through the bulk SMS API may be sent
+# as, longer messages are sent as concatenated SMSs
+SMS_MAX_PARTS = 6
+
+# API requests allowed per user as (requests, seconds), by handler method,
+# see txtalert.apps.api.throttling
+API_RATE_LIMITS = {
+    'default': (10, 60),
+}
+# the buckets are kept in files shared by the worker processes on this host.
+# For several hosts use the CacheBackend with a shared CACHE_BACKEND such as
+# memcached; it only approximates the buckets with a counter per window and
+# lets bursts of up to twice the limit through at the window edges
+API_RATE_LIMIT_BACKEND = 'txtalert.apps.api.throttling.FileBackend'
+API_RATE_LIMIT_DIR = '/tmp/txtalert-rate-limits'
+
 SOUTH_TESTS_MIGRATE = False 
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'